@@ -23,6 +23,8 @@ static volatile uint32_t *fpga;
 static uint32_t bram_addr;
 static int wordsReady;
 
+int requireFpga(void);
+
 #define STATES_MASK 0xffff8000
 #define DURATION_MASK (0xffffffff & ~STATES_MASK)
 
@@ -67,6 +69,103 @@ int sendAllOpcodes(uint32_t *states, uint16_t *durations, int cnt)
   return 1;
 }
 
+// sendProgram(words, cnt) loads a complete packed program (states | duration) into block RAM,
+// starting at address 0.
+//
+int sendProgram(const uint32_t *words, int cnt)
+{
+  if (!requireFpga())
+    return 0;
+
+  for (int i=0; i<cnt; i++) {
+    fpga[R_BR_ADDR] = i*4;
+    fpga[R_BR_WR_DATA] = words[i];
+  }
+  bram_addr = cnt*4;
+
+  return 1;
+}
+
+// The zlib CRC-32.
+//
+static uint32_t crc32(const uint8_t *buf, size_t len)
+{
+  uint32_t crc = 0xffffffff;
+
+  for (size_t i=0; i<len; i++) {
+    crc ^= buf[i];
+    for (int b=0; b<8; b++)
+      crc = (crc >> 1) ^ (0xedb88320 & -(crc & 1));
+  }
+
+  return ~crc;
+}
+
+// loadProgramFile(path, program) reads a compiled clock program file,
+// as written by python/clocks/progfile.py. Call freeProgram() when done.
+//
+int loadProgramFile(const char *path, clockProgram *program)
+{
+  FILE *f;
+  size_t nbytes;
+
+  memset(program, 0, sizeof(*program));
+  f = fopen(path, "rb");
+  if (!f) {
+    fprintf(stderr, "cannot open clock program %s (%s)\n", path, strerror(errno));
+    return 0;
+  }
+
+  if (fread(&program->header, sizeof(program->header), 1, f) != 1) {
+    fprintf(stderr, "cannot read clock program header from %s\n", path);
+    fclose(f);
+    return 0;
+  }
+  if (memcmp(program->header.magic, CLOCK_PROGRAM_MAGIC, sizeof(CLOCK_PROGRAM_MAGIC)) != 0) {
+    fprintf(stderr, "%s is not a clock program\n", path);
+    fclose(f);
+    return 0;
+  }
+  if (program->header.version > CLOCK_PROGRAM_VERSION ||
+      program->header.headerSize < sizeof(program->header)) {
+    fprintf(stderr, "%s: unknown clock program version %d (header size %d)\n",
+            path, program->header.version, program->header.headerSize);
+    fclose(f);
+    return 0;
+  }
+  program->header.name[sizeof(program->header.name)-1] = '\0';
+
+  nbytes = program->header.nOpcodes * sizeof(uint32_t);
+  program->words = malloc(nbytes);
+  if (!program->words) {
+    fprintf(stderr, "cannot allocate %zu bytes for %s\n", nbytes, path);
+    fclose(f);
+    return 0;
+  }
+  if (fseek(f, program->header.headerSize, SEEK_SET) != 0 ||
+      fread(program->words, 1, nbytes, f) != nbytes) {
+    fprintf(stderr, "cannot read %d opcodes from %s\n", program->header.nOpcodes, path);
+    fclose(f);
+    freeProgram(program);
+    return 0;
+  }
+  fclose(f);
+
+  if (crc32((const uint8_t *)program->words, nbytes) != program->header.dataCrc) {
+    fprintf(stderr, "%s failed its CRC check\n", path);
+    freeProgram(program);
+    return 0;
+  }
+
+  return 1;
+}
+
+void freeProgram(clockProgram *program)
+{
+  free(program->words);
+  program->words = 0;
+}
+
 int configureFpga(const char *mmapname)
 {
   const char *mapfile;
@@ -48,6 +48,36 @@ extern void finishReadout(void);
 
 extern int sendAllOpcodes(uint32_t *states, uint16_t *durations, int cnt);
 extern int sendOneOpcode(uint32_t states, uint16_t duration);
+extern int sendProgram(const uint32_t *words, int cnt);
+
+// Compiled clock program files, as written by python/clocks/progfile.py.
+// All fields are little-endian. Readers must skip to headerSize.
+#define CLOCK_PROGRAM_MAGIC "PFSCLKP"
+#define CLOCK_PROGRAM_VERSION 1
+
+typedef struct {
+  char magic[8];
+  uint16_t version;
+  uint16_t headerSize;
+  uint32_t nOpcodes;
+  uint32_t ncols;       // (binned) pixels per amp per row
+  uint32_t nrows;       // (binned) rows to read, or 0 if not specified
+  uint16_t rowBinning;
+  uint16_t colBinning;
+  uint32_t tickTimeNs;
+  uint64_t rowTicks;    // sum of all durations
+  uint32_t flags;
+  char name[32];
+  uint32_t dataCrc;     // CRC-32 (zlib) of the opcode words
+} clockProgramHeader;
+
+typedef struct {
+  clockProgramHeader header;
+  uint32_t *words;      // states | duration, as written to block RAM
+} clockProgram;
+
+extern int loadProgramFile(const char *path, clockProgram *program);
+extern void freeProgram(clockProgram *program);
 
 extern uint32_t readWord(void);
 extern int readRawLine(int nwords, uint32_t *rowbuf, uint32_t *dataCrc,
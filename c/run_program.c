@@ -0,0 +1,82 @@
+/* Load a compiled clock program file, run it, and write the raw image to stdout.
+ *
+ * The program files are written by python/clocks/progfile.py, so this runs
+ * exactly the production clocking without needing python.
+ *
+ * Usage: run_program [-n nrows] [-a adc18bit] [-t] program.clk > image.raw
+ */
+#include <stdint.h>
+#include <stdlib.h>
+#include <stdio.h>
+#include <unistd.h>
+
+#include "fpga.h"
+
+static void usage(const char *name)
+{
+  fprintf(stderr, "usage: %s [-n nrows] [-a adc18bit] [-t] program.clk > image.raw\n", name);
+  fprintf(stderr, "   -n nrows    : rows to read. Default is the program's, or %d\n", PIX_H);
+  fprintf(stderr, "   -a adc18bit : ADC bit selection, 1..3. Default is 3\n");
+  fprintf(stderr, "   -t          : read the FPGA test pattern\n");
+  exit(2);
+}
+
+int main(int argc, char **argv)
+{
+  clockProgram program;
+  int nrows = 0, adc18bit = 3, doTest = 0;
+  int ncols, npixels, ret, opt;
+  uint16_t *imageBuf;
+
+  while ((opt = getopt(argc, argv, "n:a:t")) != -1) {
+    switch (opt) {
+    case 'n':
+      nrows = atoi(optarg);
+      break;
+    case 'a':
+      adc18bit = atoi(optarg);
+      break;
+    case 't':
+      doTest = 1;
+      break;
+    default:
+      usage(argv[0]);
+    }
+  }
+  if (optind != argc-1)
+    usage(argv[0]);
+
+  if (!loadProgramFile(argv[optind], &program))
+    exit(1);
+
+  if (nrows <= 0)
+    nrows = program.header.nrows ? program.header.nrows : PIX_H;
+  ncols = program.header.ncols;
+  npixels = nrows * ncols * N_AMPS;
+  fprintf(stderr, "program %s: %d opcodes, %d rows of %d cols, %0.6f s/row\n",
+          program.header.name, program.header.nOpcodes, nrows, ncols,
+          program.header.rowTicks * program.header.tickTimeNs * 1e-9);
+
+  imageBuf = calloc(npixels, sizeof(uint16_t));
+  if (!imageBuf) {
+    fprintf(stderr, "cannot allocate image buffer\n");
+    exit(1);
+  }
+
+  if (!configureFpga(PFS_FPGA_MMAP_FILE))
+    exit(1);
+  if (!resetReadout(1))
+    exit(1);
+  if (!sendProgram(program.words, program.header.nOpcodes))
+    exit(1);
+  freeProgram(&program);
+
+  if (!armReadout(nrows, doTest, adc18bit))
+    exit(1);
+
+  ret = readImage(nrows, ncols, N_AMPS, imageBuf);
+  fwrite(imageBuf, sizeof(uint16_t), npixels, stdout);
+  free(imageBuf);
+
+  exit(ret ? 1 : 0);
+}
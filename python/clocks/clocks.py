@@ -500,14 +500,30 @@ def genSetClocks(turnOn=None, turnOff=None):
             np.array(opcodes, dtype='u4'),
             0)
 
-def genRowClocks(ncols, clocksFunc, rowBinning=1):
+def genRowClocks(ncols, clocksFunc, rowBinning=1, colBinning=1):
     """ Instantiate a complete row of clock times and opcodes. 
+
+    Args
+    ----
+    ncols : int
+       The number of pixels to convert per amp. When binning, this
+       is the number of binned pixels.
+    clocksFunc : callable
+       Returns the pre-, pixel and parallel Clocks.
+    rowBinning : int
+       The number of parallel clockings per row.
+    colBinning : int
+       The number of serial pixels summed per conversion. Passed to
+       clocksFunc, which must then accept a colBinning argument.
     """
 
     ticksList = []
     opcodesList = []
 
-    pre, pix, par = clocksFunc()
+    if colBinning == 1:
+        pre, pix, par = clocksFunc()
+    else:
+        pre, pix, par = clocksFunc(colBinning=colBinning)
 
     preTicks, opcodes = pre.genClocks()
     ticksList.extend(preTicks)
@@ -5,6 +5,10 @@ from .clockIDs import *
 
 from .read import insertIdlePixels
 
+# Our pixel has the original 2-tick CNV->I_M settle, so the idle
+# pixels must match it.
+idleTiming = dict(irSettle=2)
+
 def readClocks():
     pre = Clocks()
     pre.changeFor(duration=120,
@@ -64,27 +68,27 @@ def readClocks():
     par = Clocks(initFrom=pix, logLevel=20)
     par.changeAt(at=0,
                  turnOff=[P1])
-    insertIdlePixels(par, parPhasePixCnt)
+    insertIdlePixels(par, parPhasePixCnt, timing=idleTiming)
     
     par.changeAt(at=1*parPhaseTicks,
                  turnOn= [P3,TG,CRC])
-    insertIdlePixels(par, parPhasePixCnt)
+    insertIdlePixels(par, parPhasePixCnt, timing=idleTiming)
 
     par.changeAt(at=2*parPhaseTicks,
                  turnOff=[P2,CRC])
-    insertIdlePixels(par, parPhasePixCnt)
+    insertIdlePixels(par, parPhasePixCnt, timing=idleTiming)
 
     par.changeAt(at=3*parPhaseTicks,
                  turnOn=[P1])
-    insertIdlePixels(par, parPhasePixCnt)
+    insertIdlePixels(par, parPhasePixCnt, timing=idleTiming)
 
     par.changeAt(at=4*parPhaseTicks,
                  turnOff=[P3,TG])
-    insertIdlePixels(par, parPhasePixCnt)
+    insertIdlePixels(par, parPhasePixCnt, timing=idleTiming)
 
     par.changeAt(at=5*parPhaseTicks,
                  turnOn=[P2])
-    insertIdlePixels(par, 1)
+    insertIdlePixels(par, 1, timing=idleTiming)
 
     return pre, pix, par
 
@@ -2,6 +2,7 @@ from importlib import reload
 
 from . import clocks
 from .clockIDs import *
+from .read import insertBinnedShifts
 
 reload(clocks)
 
@@ -45,7 +46,10 @@ def insertIdlePixels(clks, cnt):
         clks.changeFor(duration=12,
                        turnOff= [RG])
 
-def readClocks(holdOn=None, holdOff=None):
+def readClocks(holdOn=None, holdOff=None, colBinning=1):
+    if colBinning < 1:
+        raise ValueError("colBinning must be >= 1, not %s" % (colBinning))
+
     pre = clocks.Clocks(holdOn=holdOn, holdOff=holdOff)
     pre.changeFor(duration=120,
                   turnOff=[IR],
@@ -69,6 +73,10 @@ def readClocks(holdOn=None, holdOff=None):
                   turnOff=[S2],
                   turnOn= [S1])
 
+    # Serial binning: sum the additional pixels into SW before we
+    # start integrating.
+    insertBinnedShifts(pix, colBinning-1)
+
     pix.changeFor(duration=2,
                   turnOff=[DCR])
 
@@ -0,0 +1,345 @@
+""" Named readout presets: a clocking, the FEE mode it needs, and its timing model.
+
+Each preset wraps one of the clock modules (clocks.read, clocks.wipe,
+etc.) with fixed arguments, and caches the compiled FPGA programs it
+generates. The expected per-row and per-frame times come from the
+programs themselves, and are used by ccd.readImage() to sanity check
+the actual readout time.
+
+Like clocks.timing, this module is not reloaded by the readout code, so
+the program cache survives between exposures. Call clearCaches() after
+editing a clock module.
+
+Examples
+--------
+
+>>> p = presets.getPreset('fast-bias')
+>>> p.rowTime(552), p.frameTime(4300, 552)
+>>> ccdFuncs.readout('bias', preset='fast-bias')
+"""
+
+from importlib import import_module, reload
+import glob
+import logging
+import os
+
+from . import clocks
+
+logger = logging.getLogger('clocks')
+
+class ReadTimeModel(object):
+    """ The expected wall-clock time for a readout, and how far off it can be.
+
+    Args
+    ----
+    rowOverhead : float
+       Seconds added to each row by the host: the PCI transfer and the row callback.
+       Not yet measured on real readouts, so 0 by default.
+    fracTolerance : float
+       The allowed fractional error. The default, 10%, is the tolerance of
+       the old fixed readTime check, and covers the unmodelled host
+       overhead; tighten it only along with a measured rowOverhead.
+    minTolerance : float
+       The smallest allowed error, in seconds. Covers short reads.
+    """
+
+    def __init__(self, rowOverhead=0.0, fracTolerance=0.10, minTolerance=0.25):
+        self.rowOverhead = rowOverhead
+        self.fracTolerance = fracTolerance
+        self.minTolerance = minTolerance
+
+    def __str__(self):
+        return ("ReadTimeModel(rowOverhead=%g, fracTolerance=%g, minTolerance=%g)" %
+                (self.rowOverhead, self.fracTolerance, self.minTolerance))
+
+    def expected(self, rowTime, nrows):
+        """ Return the expected time to read nrows rows, each taking rowTime on the FPGA. """
+
+        return nrows * (rowTime + self.rowOverhead)
+
+    def tolerance(self, expectedTime):
+        return max(self.minTolerance, self.fracTolerance * expectedTime)
+
+    def check(self, elapsedTime, rowTime, nrows):
+        """ Compare an actual readout time with the model.
+
+        Returns
+        -------
+        ok : bool
+           Whether elapsedTime is within the tolerance.
+        expectedTime : float
+           What the model predicted.
+        """
+
+        expectedTime = self.expected(rowTime, nrows)
+        ok = abs(elapsedTime - expectedTime) <= self.tolerance(expectedTime)
+
+        return ok, expectedTime
+
+defaultTimeModel = ReadTimeModel()
+
+class ReadoutPreset(object):
+    """ A named readout mode.
+
+    Args
+    ----
+    name : str
+       What the preset is registered as.
+    clockModule : str
+       The clock module, e.g. 'clocks.read'
+    clockFuncName : str
+       The clocking function in that module, e.g. 'readClocks'
+    clockArgs : dict
+       Fixed keyword arguments to the clocking function.
+    feeMode : str
+       The FEE mode to set before clocking.
+    rowBinning : int
+       The default row binning.
+    acceptsHolds : bool
+       Whether the clocking function takes holdOn/holdOff arguments.
+    supportsColBinning : bool
+       Whether the clocking function takes a colBinning argument.
+    newAdc : bool or None
+       The ADC the clocking requires, or None if it does not matter.
+    timeModel : ReadTimeModel
+       The wall-clock time model for readouts.
+    description : str
+    """
+
+    def __init__(self, name, clockModule, clockFuncName,
+                 clockArgs=None, feeMode='read',
+                 rowBinning=1, acceptsHolds=True, supportsColBinning=True,
+                 newAdc=True, timeModel=None, description=''):
+        self.name = name
+        self.clockModule = clockModule
+        self.clockFuncName = clockFuncName
+        self.clockArgs = dict() if clockArgs is None else dict(clockArgs)
+        self.feeMode = feeMode
+        self.rowBinning = rowBinning
+        self.acceptsHolds = acceptsHolds
+        self.supportsColBinning = supportsColBinning
+        self.newAdc = newAdc
+        self.timeModel = defaultTimeModel if timeModel is None else timeModel
+        self.description = description
+
+        self._programs = dict()
+
+    def __str__(self):
+        return ("ReadoutPreset(%s: %s.%s%s, fee=%s, rowBinning=%d)" %
+                (self.name, self.clockModule, self.clockFuncName,
+                 self.clockArgs if self.clockArgs else '',
+                 self.feeMode, self.rowBinning))
+
+    def __repr__(self):
+        return str(self)
+
+    def clearCache(self):
+        self._programs.clear()
+
+    def clockFunc(self, holdOn=None, holdOff=None, doReload=False):
+        """ Return the clocking function, with all our arguments bound in.
+
+        Args
+        ----
+        holdOn, holdOff : sets of clockID signal names
+           Clocks to hold on or off for the entire read.
+        doReload : bool
+           Whether to reload the clock module first.
+        """
+
+        mod = import_module(self.clockModule)
+        if doReload:
+            reload(mod)
+        func = getattr(mod, self.clockFuncName)
+
+        kwargs = dict(self.clockArgs)
+        if holdOn or holdOff:
+            if not self.acceptsHolds:
+                raise RuntimeError(f'readout preset {self.name} cannot hold clocks')
+            kwargs.update(holdOn=holdOn, holdOff=holdOff)
+
+        def boundClockFunc(**moreArgs):
+            return func(**kwargs, **moreArgs)
+
+        return boundClockFunc
+
+    def checkColBinning(self, colBinning):
+        """ Raise a RuntimeError if we cannot clock with the given column binning. """
+
+        if colBinning != 1 and not self.supportsColBinning:
+            raise RuntimeError(f'readout preset {self.name} cannot bin columns (colBinning={colBinning})')
+
+    def program(self, ncols, rowBinning=None, colBinning=1,
+                holdOn=None, holdOff=None):
+        """ Return the compiled program for one row, possibly cached.
+
+        Args
+        ----
+        ncols : int
+           The number of (binned) pixels per amp.
+        rowBinning, colBinning : int
+           The binning. rowBinning defaults to the preset's.
+        holdOn, holdOff : sets of clockID signal names
+           Clocks to hold on or off for the entire read.
+
+        Returns
+        -------
+        ticks, opcodes, rowTime
+           As from clocks.genRowClocks
+        """
+
+        if rowBinning is None:
+            rowBinning = self.rowBinning
+        self.checkColBinning(colBinning)
+        holdOn = frozenset(holdOn) if holdOn else frozenset()
+        holdOff = frozenset(holdOff) if holdOff else frozenset()
+
+        key = (ncols, rowBinning, colBinning, holdOn, holdOff)
+        try:
+            return self._programs[key]
+        except KeyError:
+            pass
+
+        program = clocks.genRowClocks(ncols,
+                                      self.clockFunc(holdOn=holdOn, holdOff=holdOff),
+                                      rowBinning=rowBinning, colBinning=colBinning)
+        logger.info('compiled %s for ncols=%d binning=%d,%d: %d opcodes, rowTime=%0.6f',
+                    self.name, ncols, rowBinning, colBinning,
+                    len(program[0]), program[2])
+        self._programs[key] = program
+
+        return program
+
+    def rowTime(self, ncols, rowBinning=None, colBinning=1):
+        """ Return the FPGA time for one (binned) row. """
+
+        return self.program(ncols, rowBinning=rowBinning, colBinning=colBinning)[2]
+
+    def frameTime(self, nrows, ncols, rowBinning=None, colBinning=1):
+        """ Return the FPGA time for nrows (binned) rows. """
+
+        return nrows * self.rowTime(ncols, rowBinning=rowBinning, colBinning=colBinning)
+
+    def expectedReadTime(self, nrows, ncols, rowBinning=None, colBinning=1):
+        """ Return the wall-clock time we expect to read nrows (binned) rows in. """
+
+        return self.timeModel.expected(self.rowTime(ncols, rowBinning=rowBinning,
+                                                    colBinning=colBinning),
+                                       nrows)
+
+# The registered presets, by name.
+presets = dict()
+
+def registerPreset(preset):
+    """ Add or replace a ReadoutPreset. """
+
+    presets[preset.name] = preset
+    return preset
+
+def getPreset(name):
+    """ Return a ReadoutPreset. Passes ReadoutPresets through unchanged. """
+
+    if isinstance(name, ReadoutPreset):
+        return name
+    try:
+        return presets[name]
+    except KeyError:
+        raise KeyError("unknown readout preset %s. Known: %s" % (name, sorted(presets)))
+
+def _presetNames(colBinning=1):
+    """ Return the names of the presets which can clock with the given colBinning. """
+
+    return [name for name, p in presets.items() if colBinning == 1 or p.supportsColBinning]
+
+def clearCaches():
+    """ Drop all compiled programs. Call after changing any clock module. """
+
+    for p in presets.values():
+        p.clearCache()
+
+def precompile(ncols, names=None, colBinning=1):
+    """ Compile and cache the programs for some presets.
+
+    By default, all the presets which can clock with the given colBinning.
+    """
+
+    if names is None:
+        names = _presetNames(colBinning)
+    for name in names:
+        getPreset(name).program(ncols, colBinning=colBinning)
+
+def programFileName(name, ncols, rowBinning, colBinning):
+    return '%s-%dx%dx%d.clk' % (name, ncols, rowBinning, colBinning)
+
+def savePrograms(directory, ncols, names=None, colBinning=1):
+    """ Write the programs for some presets, for the C tools or for loadPrograms().
+
+    By default, all the presets which can clock with the given colBinning.
+    Returns the list of file paths.
+    """
+
+    from . import progfile
+
+    if names is None:
+        names = _presetNames(colBinning)
+    paths = []
+    for name in names:
+        preset = getPreset(name)
+        program = preset.program(ncols, colBinning=colBinning)
+        path = os.path.join(directory, programFileName(preset.name, ncols,
+                                                       preset.rowBinning, colBinning))
+        progfile.writeProgram(path, program, ncols=ncols,
+                              rowBinning=preset.rowBinning, colBinning=colBinning,
+                              name=preset.name)
+        paths.append(path)
+
+    return paths
+
+def loadPrograms(directory):
+    """ Load all preset program files in a directory into the preset caches.
+
+    Only programs without held clocks are saved or loaded. Files for
+    unknown presets are skipped.
+    """
+
+    from . import progfile
+
+    for path in sorted(glob.glob(os.path.join(directory, '*.clk'))):
+        ticks, opcodes, rowTime, meta = progfile.readProgram(path)
+        preset = presets.get(meta['name'])
+        if preset is None:
+            logger.warn('skipping program for unknown preset %s in %s', meta['name'], path)
+            continue
+        key = (meta['ncols'], meta['rowBinning'], meta['colBinning'], frozenset(), frozenset())
+        preset._programs[key] = (ticks, opcodes, rowTime)
+        logger.info('loaded %s from %s', preset.name, path)
+
+# The pixel time is ~10us with the shorter integrations, so four pixels per ~40us parallel phase.
+_fastTiming = dict(integrate=54, parPhasePixCnt=4)
+# Without the serial clocking during the parallel phases, those phases
+# are ~40us by construction; but the pixel is ~7.8us, so use six.
+_engineeringTiming = dict(integrate=24, parPhasePixCnt=6)
+
+registerPreset(ReadoutPreset('normal', 'clocks.read', 'readClocks',
+                             description='the science readout'))
+registerPreset(ReadoutPreset('fast-bias', 'clocks.read', 'readClocks',
+                             clockArgs=dict(timing=_fastTiming),
+                             description='halved integrations: for biases, where readnoise matters less'))
+registerPreset(ReadoutPreset('engineering-fast', 'clocks.read', 'readClocks',
+                             clockArgs=dict(timing=_engineeringTiming, insertSerials=False),
+                             description='very short integrations, no serial clocking during parallel transfers'))
+registerPreset(ReadoutPreset('reverse', 'clocks.fastrevread', 'readClocks',
+                             acceptsHolds=False, supportsColBinning=False,
+                             description='parallel clocks run backwards'))
+registerPreset(ReadoutPreset('old-adc', 'clocks.oldAdcRead', 'readClocks',
+                             newAdc=False,
+                             description='the science readout, for the old ADC boards'))
+registerPreset(ReadoutPreset('wipe', 'clocks.wipe', 'wipeClocks',
+                             feeMode='wipe', acceptsHolds=False, newAdc=None,
+                             supportsColBinning=False,
+                             description='the standard wipe'))
+registerPreset(ReadoutPreset('wipe-fast', 'clocks.wipe', 'wipeClocks',
+                             feeMode='wipe', acceptsHolds=False, newAdc=None,
+                             supportsColBinning=False,
+                             rowBinning=8,
+                             description='wipe, with 8 parallel transfers per serial flush'))
@@ -0,0 +1,154 @@
+""" Read and write compiled clock programs as binary files.
+
+The same format is read by the C loader (loadProgramFile() in
+c/fpga.c), so that the C tools run exactly the programs which the
+Python clock modules generate.
+
+A file is a fixed header followed by the packed opcode words, exactly as
+written to the FPGA block RAM: states | duration. All values are
+little-endian.
+
+  offset  type      name
+  0       char[8]   magic: "PFSCLKP\\0"
+  8       uint16    version
+  10      uint16    headerSize: offset of the first opcode word
+  12      uint32    nOpcodes
+  16      uint32    ncols: (binned) pixels per amp per row
+  20      uint32    nrows: (binned) rows to read, or 0 if not specified
+  24      uint16    rowBinning
+  26      uint16    colBinning
+  28      uint32    tickTimeNs
+  32      uint64    rowTicks: sum of all durations
+  40      uint32    flags: reserved, 0
+  44      char[32]  name: NUL-padded
+  76      uint32    dataCrc: CRC-32 (zlib) of the opcode words
+  80      uint32[nOpcodes]
+
+Readers must skip to headerSize, so that later versions can append
+header fields.
+
+Examples
+--------
+
+>>> program = clocks.genRowClocks(552, read.readClocks)
+>>> progfile.writeProgram('normal.clk', program, ncols=552, nrows=4300, name='normal')
+>>> ticks, opcodes, rowTime, meta = progfile.readProgram('normal.clk')
+"""
+
+import logging
+import struct
+import zlib
+
+import numpy as np
+
+from .clocks import Clocks
+
+logger = logging.getLogger('clocks')
+
+MAGIC = b'PFSCLKP\0'
+VERSION = 1
+STATES_MASK = 0xffff8000
+DURATION_MASK = 0x00007fff
+
+_header = struct.Struct('<8sHHIIIHHIQI32sI')
+headerSize = _header.size
+
+def packProgram(ticks, opcodes):
+    """ Combine the durations and states into the FPGA opcode words. """
+
+    ticks = np.asarray(ticks, dtype='u4')
+    opcodes = np.asarray(opcodes, dtype='u4')
+    if len(ticks) != len(opcodes):
+        raise ValueError("ticks and opcodes must have the same length")
+    if np.any(ticks & ~np.uint32(DURATION_MASK)):
+        raise ValueError("some durations do not fit in %d bits" % (DURATION_MASK.bit_length()))
+    if np.any(opcodes & ~np.uint32(STATES_MASK)):
+        raise ValueError("some states overlap the duration bits")
+
+    return opcodes | ticks
+
+def unpackProgram(words):
+    """ Split FPGA opcode words into (ticks, opcodes), as from genRowClocks. """
+
+    words = np.asarray(words, dtype='u4')
+    return ((words & DURATION_MASK).astype('u2'),
+            words & np.uint32(STATES_MASK))
+
+def writeProgram(path, program, ncols, nrows=0,
+                 rowBinning=1, colBinning=1, name=''):
+    """ Write a compiled program to a file.
+
+    Args
+    ----
+    path : str
+       The file to write.
+    program : (ticks, opcodes[, rowTime])
+       As from clocks.genRowClocks.
+    ncols, nrows : int
+       The (binned) readout geometry, recorded for the loaders.
+    rowBinning, colBinning : int
+       The binning the program was compiled for.
+    name : str
+       A label, at most 31 bytes. Usually the preset or read mode.
+    """
+
+    words = packProgram(*program[:2]).astype('<u4')
+    data = words.tobytes()
+    encodedName = name.encode('latin-1')
+    if len(encodedName) > 31:
+        raise ValueError("program name (%s) must be at most 31 bytes" % (name))
+
+    header = _header.pack(MAGIC, VERSION, headerSize, len(words),
+                          ncols, nrows, rowBinning, colBinning,
+                          int(round(Clocks.tickTime * 1e9)),
+                          int(np.sum(words & DURATION_MASK, dtype='u8')),
+                          0, encodedName, zlib.crc32(data))
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(data)
+
+    logger.info('wrote %d opcodes for %s (ncols=%d nrows=%d binning=%d,%d) to %s',
+                len(words), name, ncols, nrows, rowBinning, colBinning, path)
+
+def readProgram(path):
+    """ Read a compiled program from a file.
+
+    Returns
+    -------
+    ticks, opcodes, rowTime
+       As from clocks.genRowClocks.
+    meta : dict
+       The other header fields.
+    """
+
+    with open(path, 'rb') as f:
+        raw = f.read()
+
+    if len(raw) < headerSize:
+        raise RuntimeError("%s is too short to be a clock program" % (path))
+    (magic, version, hdrSize, nOpcodes,
+     ncols, nrows, rowBinning, colBinning,
+     tickTimeNs, rowTicks, flags, name, dataCrc) = _header.unpack_from(raw)
+
+    if magic != MAGIC:
+        raise RuntimeError("%s is not a clock program (magic=%r)" % (path, magic))
+    if version > VERSION:
+        raise RuntimeError("%s is a version %d clock program; we only know up to %d" %
+                           (path, version, VERSION))
+    if len(raw) != hdrSize + 4*nOpcodes:
+        raise RuntimeError("%s has %d bytes, expected %d" % (path, len(raw), hdrSize + 4*nOpcodes))
+
+    data = raw[hdrSize:]
+    if zlib.crc32(data) != dataCrc:
+        raise RuntimeError("%s failed its CRC check" % (path))
+
+    words = np.frombuffer(data, dtype='<u4').astype('u4')
+    ticks, opcodes = unpackProgram(words)
+    rowTime = rowTicks * tickTimeNs * 1e-9
+
+    meta = dict(version=version, ncols=ncols, nrows=nrows,
+                rowBinning=rowBinning, colBinning=colBinning,
+                tickTimeNs=tickTimeNs, rowTicks=rowTicks, flags=flags,
+                name=name.rstrip(b'\0').decode('latin-1'))
+
+    return ticks, opcodes, rowTime, meta
@@ -1,11 +1,12 @@
 from importlib import reload
 
 from . import clocks
+from . import timing as clockTiming
 from .clockIDs import *
 
 reload(clocks)
 
-def insertIdlePixels(clks, cnt):
+def insertIdlePixels(clks, cnt, timing=None):
     """ Insert a number of complete pixel clockings, without shift or conversion. 
 
     Args:
@@ -14,127 +15,188 @@ def insertIdlePixels(clks, cnt):
        The clocking which we insert into.
     cnt : int
        The number of pixels to insert..
+    timing : dict
+       Step durations, as in clockTiming.defaultReadTiming.
 
     We want to run the serial clocks during parallel clocking, so that
     charge does not accumulate. Of course we don't want to actually _read_
     the pixels.
     """
 
+    t = clockTiming.fullTiming(timing)
     for i in range(cnt):
-        clks.changeFor(duration=8,
+        clks.changeFor(duration=t['shift'],
                        turnOff=[IR])
 
-        clks.changeFor(duration=4,
+        clks.changeFor(duration=t['swOn'],
                        turnOn=[SW])
 
-        clks.changeFor(duration=4+8+12,
+        clks.changeFor(duration=t['dcrOn']+t['sckTail']+t['serialSettle'],
                        turnOn=[DCR])
 
-        clks.changeFor(duration=2,
+        clks.changeFor(duration=t['dcrOff'],
                        turnOff=[DCR])
 
-        clks.changeFor(duration=16+108,
+        clks.changeFor(duration=t['irSettle']+t['integrate'],
                        turnOn=[IR])
 
-        clks.changeFor(duration=20+108+16+32,
+        clks.changeFor(duration=t['swDump']+t['integrate']+t['ipSettle']+t['cnvSettle'],
                        turnOff=[SW])
 
-        clks.changeFor(duration=12,
+        clks.changeFor(duration=t['rgOn'],
                        turnOn= [RG])
 
-        clks.changeFor(duration=12,
+        clks.changeFor(duration=t['rgOff'],
                        turnOff= [RG])
 
-def readClocks(holdOn=None, holdOff=None, insertSerials=True):
+def insertBinnedShifts(clks, cnt, timing=None):
+    """ Insert a number of extra serial shifts into the summing well.
+
+    Args:
+    -----
+    clks : a Clocks instance
+       The clocking which we insert into.
+    cnt : int
+       The number of extra serial pixels to shift.
+    timing : dict
+       Step durations, as in clockTiming.defaultReadTiming.
+
+    For serial (column) binning we shift extra pixels onto the summing
+    well, which is held high until the end of the reference
+    integration. The charge from all the shifted pixels is then dumped
+    onto the output node together and converted once.
+    """
+
+    t = clockTiming.fullTiming(timing)
+    for i in range(cnt):
+        clks.changeFor(duration=t['shift'],
+                       turnOff=[S1],
+                       turnOn= [S2])
+
+        clks.changeFor(duration=t['serialSettle'],
+                       turnOff=[S2],
+                       turnOn= [S1])
+
+def readClocks(holdOn=None, holdOff=None, insertSerials=True, colBinning=1,
+               timing=None):
+    """ Return the pre-, pixel and parallel clockings for a normal read.
+
+    Args:
+    -----
+    holdOn, holdOff : None or sets of clockID signal names
+       Clocks to hold on or off for the entire read.
+    insertSerials : bool
+       Whether to run idle serial clocks during the parallel clocking.
+    colBinning : int
+       The number of serial pixels to sum in the summing well for each
+       conversion.
+    timing : dict
+       Step durations, as in clockTiming.defaultReadTiming. Missing
+       steps take the default durations. See clocks.timing for the
+       named read modes and the optimizer which generates them.
+    """
+
+    if colBinning < 1:
+        raise ValueError("colBinning must be >= 1, not %s" % (colBinning))
+    t = clockTiming.fullTiming(timing)
+
     pre = clocks.Clocks(holdOn=holdOn, holdOff=holdOff)
-    pre.changeFor(duration=120,
+    pre.changeFor(duration=t['pre'],
                   turnOn= [P1,P3,S1,CNV,IR])
     
     pix = clocks.Clocks(initFrom=pre, logLevel=20)
-    pix.changeFor(duration=8,
+    pix.changeFor(duration=t['shift'],
                   turnOff=[S1,IR],
                   turnOn= [S2,SCK])
 
-    pix.changeFor(duration=4,
+    pix.changeFor(duration=t['swOn'],
                   turnOn=[SW])
 
-    pix.changeFor(duration=4,
+    pix.changeFor(duration=t['dcrOn'],
                   turnOn=[DCR])
 
-    pix.changeFor(duration=8,
+    pix.changeFor(duration=t['sckTail'],
                   turnOff=[SCK])
 
-    pix.changeFor(duration=12,
+    pix.changeFor(duration=t['serialSettle'],
                   turnOff=[S2],
                   turnOn= [S1])
 
-    pix.changeFor(duration=2,
+    # Serial binning: sum the additional pixels into SW before we
+    # start integrating.
+    insertBinnedShifts(pix, colBinning-1, timing=t)
+
+    pix.changeFor(duration=t['dcrOff'],
                   turnOff=[DCR])
 
-    pix.changeFor(duration=16, # was 2
+    pix.changeFor(duration=t['irSettle'], # was 2
                   turnOff=[CNV],
                   turnOn=[IR])
 
-    pix.changeFor(duration=108,
+    pix.changeFor(duration=t['integrate'],
                   turnOn= [I_M])
 
-    pix.changeFor(duration=20,
+    pix.changeFor(duration=t['swDump'],
                   turnOff=[I_M, SW])
 
-    pix.changeFor(duration=108,
+    pix.changeFor(duration=t['integrate'],
                   turnOn=[I_P])
 
-    pix.changeFor(duration=16,
+    pix.changeFor(duration=t['ipSettle'],
                   turnOff=[I_P])
 
-    pix.changeFor(duration=32,
+    pix.changeFor(duration=t['cnvSettle'],
                   turnOn= [CNV])
 
-    pix.changeFor(duration=12,
+    pix.changeFor(duration=t['rgOn'],
                   turnOn= [RG])
 
-    pix.changeFor(duration=12,
+    pix.changeFor(duration=t['rgOff'],
                   turnOff= [RG])
 
     # We want each phase of the parallel clocking to take ~40us.
     # We also want each phase to consist of an integral number of
     # complete pixels clockings. With the current pixel time
-    # of 14.48 us, we make it 3.
+    # of 14.48 us, the default is 3. clockTiming.optimizeReadTiming
+    # recomputes it for faster pixels.
     #
     pixTicks = pix.ticks[-1]
-    parPhasePixCnt = 3 # np.int(np.ceil(40000 / (pixTicks * 40)))
+    parPhasePixCnt = t['parPhasePixCnt']
     parPhaseTicks = pixTicks * parPhasePixCnt
 
     par = clocks.Clocks(initFrom=pix, logLevel=20)
     par.changeAt(at=0,
                  turnOff=[P1])
     if insertSerials:
-        insertIdlePixels(par, parPhasePixCnt)
+        insertIdlePixels(par, parPhasePixCnt, timing=t)
     
     par.changeAt(at=1*parPhaseTicks,
                  turnOn= [P2,TG,CRC])
     if insertSerials:
-        insertIdlePixels(par, parPhasePixCnt)
+        insertIdlePixels(par, parPhasePixCnt, timing=t)
 
     par.changeAt(at=2*parPhaseTicks,
                  turnOff=[P3,CRC])
     if insertSerials:
-        insertIdlePixels(par, parPhasePixCnt)
+        insertIdlePixels(par, parPhasePixCnt, timing=t)
 
     par.changeAt(at=3*parPhaseTicks,
                  turnOn=[P1])
     if insertSerials:
-        insertIdlePixels(par, parPhasePixCnt)
+        insertIdlePixels(par, parPhasePixCnt, timing=t)
 
     par.changeAt(at=4*parPhaseTicks,
                  turnOff=[P2,TG])
     if insertSerials:
-        insertIdlePixels(par, parPhasePixCnt)
+        insertIdlePixels(par, parPhasePixCnt, timing=t)
 
     par.changeAt(at=5*parPhaseTicks,
                  turnOn=[P3])
     if insertSerials:
-        insertIdlePixels(par, 1)
+        insertIdlePixels(par, 1, timing=t)
+    else:
+        # The final state still needs a duration.
+        par.changeFor(duration=pixTicks)
 
     return pre, pix, par
 
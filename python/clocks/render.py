@@ -0,0 +1,348 @@
+""" Render compiled clock programs as sampled waveforms, and line them up with scope traces.
+
+A compiled program is the (ticks, opcodes) pair from Clocks.genClocks()
+or genRowClocks(): each opcode's high bits are the signal states, held
+for the matching number of ticks.
+
+Rendering expands the program into boolean samples, one row per signal,
+at any sample period: the opcode bit planes are unpacked once per opcode
+and then np.repeat()ed by the number of samples each opcode covers. A
+full row at scope sampling rates is a few million samples per signal, so
+iterRender() yields fixed size chunks, and renderProgram() refuses to
+build very large arrays unless asked to.
+
+Examples
+--------
+
+>>> program = clocks.genRowClocks(552, read.readClocks)
+>>> t, samples = render.renderProgram(program, samplePeriod=20e-9,
+...                                   signals=['S1', 'S2', 'RG'], tmax=100e-6)
+>>> offset, score = render.alignToWave(program, 'IR', x, y)
+>>> rising, falling = render.programEdges(program, 'IR')
+>>> waveRising, waveFalling = render.waveEdges(x, y)
+>>> matches, delays = render.matchEdges(rising, waveRising, offset)
+"""
+
+import logging
+
+import numpy as np
+
+from . import clockIDs
+from .clocks import Clocks
+
+logger = logging.getLogger('clocks')
+
+def _asProgram(program):
+    """ Return (ticks, opcodes) from a Clocks instance or a (ticks, opcodes[, rowTime]) tuple. """
+
+    if isinstance(program, Clocks):
+        ticks, opcodes = program.genClocks()
+    else:
+        ticks, opcodes = program[:2]
+
+    return np.asarray(ticks), np.asarray(opcodes, dtype='u4')
+
+def _asSignals(signals=None):
+    """ Return a list of clockID Signals, from Signals or names. Defaults to all real clocks. """
+
+    if signals is None:
+        return [s for s in clockIDs.signals if s is not clockIDs.IRQ]
+    if isinstance(signals, (str, clockIDs.Signal)):
+        signals = [signals]
+
+    return [clockIDs.signalsByName[s] if isinstance(s, str) else s for s in signals]
+
+def bitPlanes(opcodes, signals=None):
+    """ Return the per-opcode state of some signals.
+
+    Args
+    ----
+    opcodes : array of u4
+       The compiled opcodes.
+    signals : list of Signals or names
+       Which signals to extract. Default is all of them.
+
+    Returns
+    -------
+    planes : bool array, shape (len(opcodes), len(signals))
+    """
+
+    signals = _asSignals(signals)
+    opcodes = np.asarray(opcodes, dtype='<u4')
+    allBits = np.unpackbits(opcodes.view('u1').reshape(-1, 4),
+                            axis=1, bitorder='little')
+
+    return allBits[:, [s.bit for s in signals]].astype(bool)
+
+def edgeTimes(ticks, tickTime=None):
+    """ Return the start time of each opcode, plus the end of the program, in seconds. """
+
+    if tickTime is None:
+        tickTime = Clocks.tickTime
+
+    edges = np.zeros(len(ticks)+1, dtype='f8')
+    np.cumsum(ticks, dtype='f8', out=edges[1:])
+    return edges * tickTime
+
+def sampleCounts(ticks, samplePeriod, t0=0.0, tmax=None, tickTime=None):
+    """ Return the number of samples each opcode covers.
+
+    Sample i is taken at t0 + i*samplePeriod, and is in the opcode
+    which contains that time.
+    """
+
+    edges = edgeTimes(ticks, tickTime=tickTime)
+    if tmax is not None:
+        edges = np.minimum(edges, tmax)
+    # Index of the first sample at or after each edge. The epsilon
+    # keeps samples landing exactly on an edge in the following opcode.
+    firstSample = np.ceil((edges - t0) / samplePeriod - 1e-9)
+    firstSample = np.maximum(firstSample, 0).astype('i8')
+
+    return np.diff(firstSample)
+
+def iterRender(program, samplePeriod, signals=None,
+               t0=0.0, tmax=None, tickTime=None,
+               chunkSamples=1<<20):
+    """ Render a program in chunks of at most chunkSamples.
+
+    Args
+    ----
+    program : Clocks or (ticks, opcodes)
+       The program to render.
+    samplePeriod : float
+       The time between samples, in seconds.
+    signals : list of Signals or names
+       Which signals to render. Default is all of them.
+    t0, tmax : float
+       The time range, relative to the start of the program.
+    tickTime : float
+       The duration of one tick, by default Clocks.tickTime.
+    chunkSamples : int
+       The largest number of samples to yield at once.
+
+    Yields
+    ------
+    start : int
+       The index of the first sample in this chunk.
+    samples : bool array, shape (len(signals), n)
+       The signal states.
+    """
+
+    ticks, opcodes = _asProgram(program)
+    planes = bitPlanes(opcodes, signals)
+    counts = sampleCounts(ticks, samplePeriod, t0=t0, tmax=tmax, tickTime=tickTime)
+    sampleEnds = np.cumsum(counts)
+    nSamples = sampleEnds[-1] if len(sampleEnds) else 0
+
+    for start in range(0, nSamples, chunkSamples):
+        end = min(start + chunkSamples, nSamples)
+
+        # The opcodes which overlap [start, end), and how many of the
+        # chunk's samples each covers.
+        op0 = np.searchsorted(sampleEnds, start, side='right')
+        op1 = np.searchsorted(sampleEnds, end-1, side='right') + 1
+        opStarts = sampleEnds[op0:op1] - counts[op0:op1]
+        chunkCounts = (np.minimum(sampleEnds[op0:op1], end) -
+                       np.maximum(opStarts, start))
+
+        yield start, np.repeat(planes[op0:op1], chunkCounts, axis=0).T
+
+def renderProgram(program, samplePeriod, signals=None,
+                  t0=0.0, tmax=None, tickTime=None,
+                  maxSamples=1<<24):
+    """ Render a program as one array.
+
+    See iterRender() for the arguments.
+
+    Returns
+    -------
+    times : float array
+       The sample times, relative to the start of the program.
+    samples : bool array, shape (len(signals), len(times))
+       The signal states.
+
+    Raises RuntimeError if the output would have more than maxSamples
+    samples; limit the time range, or use iterRender().
+    """
+
+    ticks, opcodes = _asProgram(program)
+    counts = sampleCounts(ticks, samplePeriod, t0=t0, tmax=tmax, tickTime=tickTime)
+    nSamples = int(counts.sum())
+    if maxSamples is not None and nSamples > maxSamples:
+        raise RuntimeError("rendering would need %d samples (> %d). Limit the time range or use iterRender()" %
+                           (nSamples, maxSamples))
+
+    nSignals = len(_asSignals(signals))
+    samples = np.empty((nSignals, nSamples), dtype=bool)
+    for start, chunk in iterRender((ticks, opcodes), samplePeriod, signals=signals,
+                                   t0=t0, tmax=tmax, tickTime=tickTime):
+        samples[:, start:start+chunk.shape[1]] = chunk
+
+    first = max(int(np.ceil(-t0/samplePeriod - 1e-9)), 0)
+    times = t0 + samplePeriod * (first + np.arange(nSamples))
+
+    return times, samples
+
+def programEdges(program, signal, tickTime=None):
+    """ Return the rising and falling edge times of one signal, without rendering.
+
+    Returns
+    -------
+    rising, falling : float arrays
+       Edge times in seconds, relative to the start of the program.
+       The program is treated as running once: there is no edge at
+       t=0 or at the end.
+    """
+
+    ticks, opcodes = _asProgram(program)
+    plane = bitPlanes(opcodes, [signal])[:, 0].astype('i1')
+    starts = edgeTimes(ticks, tickTime=tickTime)[:-1]
+
+    d = np.diff(plane)
+    rising = starts[1:][d > 0]
+    falling = starts[1:][d < 0]
+
+    return rising, falling
+
+def waveEdges(x, y, threshold=None, hysteresis=0.1):
+    """ Return the rising and falling edge times of a scope trace.
+
+    Args
+    ----
+    x, y : arrays
+       The sample times and values.
+    threshold : float
+       The level to cross. By default, halfway between the 5th and 95th percentiles.
+    hysteresis : float
+       The fraction of the 5%-95% range the signal must move past
+       the threshold to count as a new state. Suppresses ringing.
+
+    Returns
+    -------
+    rising, falling : float arrays
+       The linearly interpolated crossing times.
+    """
+
+    x = np.asarray(x, dtype='f8')
+    y = np.asarray(y, dtype='f8')
+    lo, hi = np.percentile(y, [5, 95])
+    if threshold is None:
+        threshold = (lo + hi)/2
+    band = hysteresis * (hi - lo) / 2
+
+    # Schmitt trigger: only leave a state when past the far side of the band.
+    state = np.full(len(y), -1, dtype='i1')
+    state[y > threshold + band] = 1
+    state[y < threshold - band] = 0
+    known = np.flatnonzero(state >= 0)
+    if len(known) == 0:
+        return np.array([]), np.array([])
+    state = state[known[np.maximum(np.searchsorted(known, np.arange(len(y)), side='right')-1, 0)]]
+
+    changes = np.flatnonzero(np.diff(state)) + 1
+    edges = []
+    for i in changes:
+        # Walk back to the actual threshold crossing, and interpolate.
+        j = i
+        if state[i]:
+            while j > 0 and y[j-1] > threshold:
+                j -= 1
+        else:
+            while j > 0 and y[j-1] < threshold:
+                j -= 1
+        j = max(j, 1)
+        frac = (threshold - y[j-1]) / (y[j] - y[j-1]) if y[j] != y[j-1] else 0.0
+        edges.append(x[j-1] + frac*(x[j] - x[j-1]))
+    edges = np.array(edges)
+    rising = state[changes] == 1
+
+    return edges[rising], edges[~rising]
+
+def alignToWave(program, signal, x, y, tickTime=None, searchRange=None):
+    """ Find where in the program a scope trace of one signal starts.
+
+    Args
+    ----
+    program : Clocks or (ticks, opcodes)
+       The program which the trace was taken of.
+    signal : Signal or name
+       The signal the trace shows.
+    x, y : arrays
+       The trace's uniformly spaced sample times and values.
+    searchRange : (float, float)
+       The range of program times to consider for the start of the
+       trace. By default the whole program.
+
+    Returns
+    -------
+    offset : float
+       The program time minus the trace time, in seconds.
+    score : float
+       The normalized correlation at that offset, -1..1.
+
+    The signal is rendered at the trace's sample period and the two
+    are cross-correlated with FFTs; a single peak is only guaranteed for
+    traces which span more than one period of the signal.
+    """
+
+    x = np.asarray(x, dtype='f8')
+    y = np.asarray(y, dtype='f8')
+    samplePeriod = (x[-1] - x[0])/(len(x) - 1)
+
+    t0, tmax = (0.0, None) if searchRange is None else (searchRange[0], searchRange[1] + (x[-1] - x[0]))
+    times, rendered = renderProgram(program, samplePeriod, signals=[signal],
+                                    t0=t0, tmax=tmax, tickTime=tickTime)
+    ref = rendered[0].astype('f4')
+    if len(ref) < len(y):
+        raise RuntimeError("the trace is longer than the rendered program")
+
+    ref -= ref.mean()
+    trace = (y - y.mean()).astype('f4')
+
+    n = len(ref) + len(trace)
+    nfft = 1 << int(np.ceil(np.log2(n)))
+    corr = np.fft.irfft(np.fft.rfft(ref, nfft) * np.conj(np.fft.rfft(trace, nfft)), nfft)
+    corr = corr[:len(ref) - len(trace) + 1]
+
+    # Normalize by the local energy of the reference, so that flat stretches do not win.
+    cumsq = np.concatenate(([0.0], np.cumsum(ref.astype('f8')**2)))
+    refEnergy = cumsq[len(trace):] - cumsq[:-len(trace)]
+    norm = np.sqrt(np.maximum(refEnergy, 1e-12) * np.sum(trace.astype('f8')**2))
+    score = corr / norm
+
+    best = int(np.argmax(score))
+    return times[best] - x[0], float(score[best])
+
+def matchEdges(programTimes, waveTimes, offset=0.0):
+    """ Pair each scope edge with the nearest program edge.
+
+    Args
+    ----
+    programTimes : array
+       Edge times from programEdges()
+    waveTimes : array
+       Edge times from waveEdges()
+    offset : float
+       The program time minus the trace time, e.g. from alignToWave().
+
+    Returns
+    -------
+    programMatches : array
+       The matched program edge times, in trace time.
+    delays : array
+       waveTimes - programMatches: how late each scope edge is.
+    """
+
+    programTimes = np.sort(np.asarray(programTimes)) - offset
+    waveTimes = np.asarray(waveTimes)
+    if len(programTimes) == 0:
+        return np.full(len(waveTimes), np.nan), np.full(len(waveTimes), np.nan)
+
+    idx = np.searchsorted(programTimes, waveTimes)
+    lo = np.clip(idx-1, 0, len(programTimes)-1)
+    hi = np.clip(idx, 0, len(programTimes)-1)
+    nearer = np.where(np.abs(programTimes[lo] - waveTimes) <= np.abs(programTimes[hi] - waveTimes), lo, hi)
+    matches = programTimes[nearer]
+
+    return matches, waveTimes - matches
@@ -0,0 +1,357 @@
+""" Parametrized read timing, and a search for the fastest valid timing.
+
+The normal read clocking (clocks.read.readClocks) is built from a
+dictionary of step durations, in 40ns ticks. This module holds the
+default values, the catalogue of named read modes, and the tools to
+derive new modes from hardware constraints and a read noise model.
+
+Note that this module is deliberately *not* reloaded by the clock
+routines, so that modes registered at runtime survive the reload() calls
+in ccd.getReadClocks().
+
+Examples
+--------
+
+>>> model = timing.fitNoiseModel([54, 108, 216], [4.1, 3.2, 2.9])
+>>> cons = timing.TimingConstraints(noiseModel=model, targetNoise=3.3,
+...                                  minDurations=dict(serialSettle=8, swDump=12))
+>>> tm, rowTime, frameTime = timing.optimizeReadTiming(cons, name='quick')
+>>> ccd.getReadClocks(readMode='quick')
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger('clocks')
+
+tickTime = 40e-9
+
+# The durations, in ticks, of the steps of one pixel of the normal read
+# clocking. Look at clocks.read.readClocks for the signals driven in
+# each step.
+defaultReadTiming = dict(pre=120,          # before the first pixel
+                         shift=8,          # S1->S2, start SCK burst
+                         swOn=4,           # SW on
+                         dcrOn=4,          # DCR on
+                         sckTail=8,        # end SCK burst
+                         serialSettle=12,  # S2->S1
+                         dcrOff=2,         # DCR off
+                         irSettle=16,      # CNV off, IR on
+                         integrate=108,    # each of the I_M and I_P integrations
+                         swDump=20,        # SW off, between the integrations
+                         ipSettle=16,      # I_P off
+                         cnvSettle=32,     # CNV on
+                         rgOn=12,          # RG on
+                         rgOff=12,         # RG off
+                         parPhasePixCnt=3) # pixels per parallel phase
+
+pixelSteps = ('shift', 'swOn', 'dcrOn', 'sckTail', 'serialSettle', 'dcrOff',
+              'irSettle', 'integrate', 'swDump', 'integrate', 'ipSettle',
+              'cnvSettle', 'rgOn', 'rgOff')
+
+# Registered read modes: name -> dict(timing=, rowTime=, frameTime=)
+readModes = dict()
+
+def fullTiming(timing=None):
+    """ Return a complete timing dictionary, with defaults filled in. """
+
+    fullTiming = defaultReadTiming.copy()
+    if timing is not None:
+        unknown = set(timing) - set(defaultReadTiming)
+        if unknown:
+            raise KeyError("unknown read timing step(s): %s" % (sorted(unknown)))
+        fullTiming.update(timing)
+
+    return fullTiming
+
+def pixelTicks(timing, colBinning=1):
+    """ Return the number of ticks for one read pixel. """
+
+    timing = fullTiming(timing)
+    ticks = sum([timing[s] for s in pixelSteps])
+    ticks += (colBinning-1) * (timing['shift'] + timing['serialSettle'])
+
+    return ticks
+
+def registerReadMode(name, timing, rowTime=None, frameTime=None):
+    """ Add or replace a named read mode, usable by ccd.getReadClocks(readMode=name). """
+
+    readModes[name] = dict(timing=fullTiming(timing),
+                           rowTime=rowTime,
+                           frameTime=frameTime)
+    logger.info('registered read mode %s: rowTime=%s frameTime=%s',
+                name, rowTime, frameTime)
+
+def getReadTiming(readMode):
+    """ Return the timing dictionary for a named read mode. """
+
+    if readMode is None:
+        return fullTiming()
+    try:
+        return readModes[readMode]['timing']
+    except KeyError:
+        raise KeyError("unknown read mode %s. Known: %s" % (readMode, sorted(readModes)))
+
+registerReadMode('normal', defaultReadTiming)
+
+def fitNoiseModel(integrationTicks, readnoise):
+    """ Fit readnoise measurements to a white noise CDS model.
+
+    Args
+    ----
+    integrationTicks : array-like
+       The integration durations (ticks) of the measurements.
+    readnoise : array-like
+       The measured read noise, in whatever units the target will be given.
+
+    Returns
+    -------
+    model : (a, b)
+       readnoise**2 = a/integrationTicks + b
+    """
+
+    t = np.asarray(integrationTicks, dtype='f8')
+    sig = np.asarray(readnoise, dtype='f8')
+    if len(t) < 2 or len(np.unique(t)) < 2:
+        raise ValueError("need measurements at two or more integration times")
+
+    a, b = np.polyfit(1.0/t, sig**2, 1)
+    return a, b
+
+def noiseForIntegration(model, integrationTicks):
+    """ Return the modelled read noise for a given integration. """
+
+    a, b = model
+    return np.sqrt(a/integrationTicks + b)
+
+def integrationForNoise(model, targetNoise):
+    """ Return the shortest integration (ticks) which reaches a target read noise. """
+
+    a, b = model
+    excess = targetNoise**2 - b
+    if a <= 0:
+        return 1
+    if excess <= 0:
+        raise ValueError("target noise %g is below the model floor %g" % (targetNoise, np.sqrt(max(b, 0))))
+
+    return int(np.ceil(a/excess))
+
+class TimingConstraints(object):
+    """ Hardware and noise constraints on the read timing. All durations are in ticks.
+
+    Args
+    ----
+    minDurations : dict
+       Per-step minimum durations, keyed by the defaultReadTiming names.
+    minFraction : float
+       Unspecified steps must last at least this fraction of their
+       defaultReadTiming duration. The default, 1.0, keeps every step
+       at its validated value: pass minDurations or a smaller
+       minFraction to let the search shorten steps.
+    minStep : int
+       The absolute minimum duration for any step.
+    minIntegration : int
+       Shortest allowed I_M and I_P integrations.
+    noiseModel : (a, b)
+       From fitNoiseModel. Used with targetNoise to set the integrations.
+       Unless minDurations has an 'integrate' entry, this replaces the
+       minFraction floor for the integrations.
+    targetNoise : float
+       The highest acceptable modelled read noise.
+    minSckBurst : int
+       The length of the ADC SCK burst: shift+swOn+dcrOn
+    minCnvToSck : int
+       The time from CNV rising to the SCK burst: the ADC conversion time.
+    minCnvHigh : int
+       The time CNV must stay high.
+    minParPhaseTime : float
+       The shortest parallel clock phase, in seconds.
+    """
+
+    def __init__(self, minDurations=None, minFraction=1.0, minStep=2,
+                 minIntegration=None, noiseModel=None, targetNoise=None,
+                 minSckBurst=16, minCnvToSck=56, minCnvHigh=None,
+                 minParPhaseTime=40e-6):
+
+        self.minDurations = dict() if minDurations is None else dict(minDurations)
+        unknown = set(self.minDurations) - set(defaultReadTiming)
+        if unknown:
+            raise KeyError("unknown read timing step(s): %s" % (sorted(unknown)))
+
+        self.minFraction = minFraction
+        self.minStep = minStep
+        self.minIntegration = minIntegration
+        self.noiseModel = noiseModel
+        self.targetNoise = targetNoise
+        self.minSckBurst = minSckBurst
+        self.minCnvToSck = minCnvToSck
+        self.minCnvHigh = minCnvHigh
+        self.minParPhaseTime = minParPhaseTime
+
+    def __str__(self):
+        return ("TimingConstraints(minFraction=%g, minIntegration=%s, targetNoise=%s, sck=%s, cnvToSck=%s, cnvHigh=%s, parPhase=%s)" %
+                (self.minFraction, self.integrationFloor(), self.targetNoise,
+                 self.minSckBurst, self.minCnvToSck, self.minCnvHigh, self.minParPhaseTime))
+
+    def stepFloor(self, step):
+        """ Return the minimum duration of one step, ignoring the integration limits. """
+
+        try:
+            return self.minDurations[step]
+        except KeyError:
+            return max(self.minStep, int(np.ceil(self.minFraction * defaultReadTiming[step])))
+
+    def integrationFloor(self):
+        """ Return the shortest integration allowed by both the explicit limit and the noise model. """
+
+        useNoiseModel = self.noiseModel is not None and self.targetNoise is not None
+        if useNoiseModel and 'integrate' not in self.minDurations:
+            floor = self.minStep
+        else:
+            floor = self.stepFloor('integrate')
+        if self.minIntegration is not None:
+            floor = max(floor, self.minIntegration)
+        if useNoiseModel:
+            floor = max(floor, integrationForNoise(self.noiseModel, self.targetNoise))
+
+        return floor
+
+    def minimumTiming(self):
+        """ Return the timing with every pixel step at its own minimum. """
+
+        timing = fullTiming()
+        for k in timing:
+            if k in ('pre', 'parPhasePixCnt'):
+                continue
+            timing[k] = self.stepFloor(k)
+        timing['integrate'] = self.integrationFloor()
+
+        return timing
+
+    def sums(self):
+        """ Return the constraints which span several steps.
+
+        Returns
+        -------
+        list of (name, steps, minimum)
+           Each requires sum(timing[steps]) >= minimum.
+        """
+
+        sums = []
+        if self.minSckBurst is not None:
+            sums.append(('SCK burst', ('shift', 'swOn', 'dcrOn'), self.minSckBurst))
+        if self.minCnvToSck is not None:
+            sums.append(('CNV to SCK', ('cnvSettle', 'rgOn', 'rgOff'), self.minCnvToSck))
+        if self.minCnvHigh is not None:
+            sums.append(('CNV high', ('cnvSettle', 'rgOn', 'rgOff',
+                                      'shift', 'swOn', 'dcrOn', 'sckTail',
+                                      'serialSettle', 'dcrOff'), self.minCnvHigh))
+        return sums
+
+    def violations(self, timing):
+        """ Return the list of (name, steps, deficit) for all unmet multi-step constraints. """
+
+        violations = []
+        for name, steps, minimum in self.sums():
+            deficit = minimum - sum([timing[s] for s in steps])
+            if deficit > 0:
+                violations.append((name, steps, deficit))
+
+        return violations
+
+    def isValid(self, timing, colBinning=1):
+        """ Whether a complete timing dictionary meets all constraints, when reading with colBinning. """
+
+        floor = self.minimumTiming()
+        for k, v in floor.items():
+            if k in ('pre', 'parPhasePixCnt'):
+                continue
+            if timing[k] < v:
+                return False
+        if self.violations(timing):
+            return False
+        if self.minParPhaseTime is not None:
+            parTime = timing['parPhasePixCnt'] * pixelTicks(timing, colBinning=colBinning) * tickTime
+            if parTime < self.minParPhaseTime:
+                return False
+
+        return True
+
+def _repairTiming(constraints, timing, maxDepth=8):
+    """ Yield all the timings made by stretching single steps to satisfy the constraints. """
+
+    violations = constraints.violations(timing)
+    if not violations:
+        yield timing
+        return
+    if maxDepth == 0:
+        return
+
+    name, steps, deficit = violations[0]
+    for s in set(steps):
+        newTiming = timing.copy()
+        newTiming[s] += deficit
+        yield from _repairTiming(constraints, newTiming, maxDepth=maxDepth-1)
+
+def optimizeReadTiming(constraints, ncols=552, nrows=4300, colBinning=1,
+                       name=None):
+    """ Search for the fastest read timing which meets the given constraints.
+
+    Args
+    ----
+    constraints : TimingConstraints
+       What the hardware and noise budget require.
+    ncols, nrows : int
+       The readout geometry used to report the row and frame times.
+    colBinning : int
+       The serial binning to evaluate the timing for.
+    name : str
+       If set, register the result as a read mode with this name.
+
+    Returns
+    -------
+    timing : dict
+       The complete timing dictionary.
+    rowTime, frameTime : float
+       The row and frame readout times, in seconds.
+
+    Starting from every step at its minimum, each unmet multi-step
+    constraint is met by stretching one of its steps. We search all
+    the ways of doing that and keep the one with the shortest pixel.
+    Finally, the parallel phases are made as few pixels long as they
+    can be.
+    """
+
+    from . import clocks
+    from . import read
+
+    best = None
+    for timing in _repairTiming(constraints, constraints.minimumTiming()):
+        ticks = pixelTicks(timing, colBinning=colBinning)
+        if best is None or ticks < best[0]:
+            best = ticks, timing
+
+    if best is None:
+        raise RuntimeError("could not find a timing which satisfies %s" % (constraints))
+    pixTicks, timing = best
+
+    if constraints.minParPhaseTime is not None:
+        parPixels = constraints.minParPhaseTime / (pixTicks * tickTime)
+        timing['parPhasePixCnt'] = max(1, int(np.ceil(parPixels - 1e-9)))
+    if not constraints.isValid(timing, colBinning=colBinning):
+        raise RuntimeError("search produced an invalid timing: %s" % (timing))
+
+    # Get the real row time from the full clocking.
+    def clockFunc(colBinning=1):
+        return read.readClocks(timing=timing, colBinning=colBinning)
+    _, _, rowTime = clocks.genRowClocks(ncols//colBinning, clockFunc,
+                                        colBinning=colBinning)
+    frameTime = rowTime * nrows
+
+    logger.info('optimized timing: pixel=%d ticks, rowTime=%0.6fs, frameTime=%0.2fs: %s',
+                pixTicks, rowTime, frameTime, timing)
+    if name is not None:
+        registerReadMode(name, timing, rowTime=rowTime, frameTime=frameTime)
+
+    return timing, rowTime, frameTime
@@ -0,0 +1,164 @@
+""" Share the FEE serial line between threads, by priority.
+
+Each transaction (one command and its reply, or one pipelined batch)
+holds the line. When it is released, the line goes to the waiting
+thread with the best priority class, and in arrival order within a
+class. So a transaction is never interrupted, but a long series of
+them (a status sweep, the telemetry sampler) lets a waiting mode
+change in after the current one.
+
+A thread's priority class is set with the priority() context manager,
+and defaults to 'user'.
+
+Examples
+--------
+
+>>> with fee.scheduler.priority('critical'):
+...     fee.setMode('read')
+>>> fee.scheduler.metrics()['critical']['maxWait']
+"""
+
+import contextlib
+import heapq
+import itertools
+import threading
+import time
+
+class CommandScheduler(object):
+    priorities = ('critical', 'user', 'housekeeping')
+    defaultPriority = 'user'
+
+    def __init__(self):
+        """ A reentrant lock, granted to waiters in priority order. """
+
+        self.cond = threading.Condition(threading.Lock())
+        self.owner = None
+        self.ownerPriority = None
+        self.depth = 0
+        self.waiters = []
+        self.arrivals = itertools.count()
+        self.local = threading.local()
+
+        self.nGranted = {p:0 for p in self.priorities}
+        self.totalWait = {p:0.0 for p in self.priorities}
+        self.maxWait = {p:0.0 for p in self.priorities}
+        self.lastWait = {p:None for p in self.priorities}
+        self.nYields = 0
+
+    def __str__(self):
+        return "CommandScheduler(owner=%s, waiting=%d)" % (self.owner, len(self.waiters))
+
+    def currentPriority(self):
+        """ Return the calling thread's priority class. """
+        return getattr(self.local, 'priority', self.defaultPriority)
+
+    @contextlib.contextmanager
+    def priority(self, name):
+        """ Run the enclosed commands in the given priority class. """
+
+        if name not in self.priorities:
+            raise RuntimeError("unknown priority %s; valid ones are: %s" % (name, self.priorities))
+        oldPriority = self.currentPriority()
+        self.local.priority = name
+        try:
+            yield
+        finally:
+            self.local.priority = oldPriority
+
+    def acquire(self):
+        """ Wait for the line, behind any waiters with better priority. """
+
+        me = threading.get_ident()
+        priority = self.currentPriority()
+        with self.cond:
+            if self.owner == me:
+                self.depth += 1
+                return
+
+            t0 = time.time()
+            entry = (self.priorities.index(priority), next(self.arrivals), me)
+            heapq.heappush(self.waiters, entry)
+            while self.owner is not None or self.waiters[0] is not entry:
+                self.cond.wait()
+            heapq.heappop(self.waiters)
+            self.owner = me
+            self.ownerPriority = priority
+            self.depth = 1
+
+            dt = time.time() - t0
+            self.nGranted[priority] += 1
+            self.totalWait[priority] += dt
+            self.maxWait[priority] = max(self.maxWait[priority], dt)
+            self.lastWait[priority] = dt
+
+    def release(self):
+        with self.cond:
+            if self.owner != threading.get_ident():
+                raise RuntimeError("releasing the FEE line from a thread which does not hold it")
+            self.depth -= 1
+            if self.depth == 0:
+                self.owner = None
+                self.ownerPriority = None
+                self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Hold the line for the enclosed commands. """
+
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def betterWaiting(self):
+        """ Whether a thread with better priority than the holder is waiting. """
+
+        with self.cond:
+            return (self.ownerPriority is not None and len(self.waiters) > 0
+                    and self.waiters[0][0] < self.priorities.index(self.ownerPriority))
+
+    def yieldLine(self):
+        """ Between transactions, let any better-priority waiters have the line first.
+
+        Only yields if the line is held once, i.e. not from inside an enclosing transaction.
+
+        Returns
+        -------
+        yielded : bool
+        """
+
+        with self.cond:
+            if self.depth != 1 or self.owner != threading.get_ident():
+                return False
+        if not self.betterWaiting():
+            return False
+
+        self.nYields += 1
+        self.release()
+        self.acquire()
+        return True
+
+    def metrics(self):
+        """ Return, per priority class, the number of grants and the wait times in seconds. """
+
+        with self.cond:
+            metrics = dict()
+            for p in self.priorities:
+                n = self.nGranted[p]
+                metrics[p] = dict(n=n,
+                                  meanWait=self.totalWait[p]/n if n else None,
+                                  maxWait=self.maxWait[p] if n else None,
+                                  lastWait=self.lastWait[p])
+            metrics['waiting'] = len(self.waiters)
+            metrics['yields'] = self.nYields
+            return metrics
+
+    def resetMetrics(self):
+        with self.cond:
+            for p in self.priorities:
+                self.nGranted[p] = 0
+                self.totalWait[p] = 0.0
+                self.maxWait[p] = 0.0
+                self.lastWait[p] = None
+            self.nYields = 0
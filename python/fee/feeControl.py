@@ -7,13 +7,15 @@ import sys
 import threading
 import time
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
 import numpy as np
 
 import astropy.io.fits as fits
 import serial
 
+from fee import commandScheduler
+
 fee = None
 
 def clipFloat(v, ndig=2):
@@ -61,17 +63,29 @@ class ModePreset(object):
                 if preload is None:
                     raise RuntimeError("All voltages must be defined for non-preloaded modes")
 
-    def saveToFee(self, fee, channels=(0,1)):
+    def saveToFee(self, fee, channels=(0,1), differential=True, verify=False):
+        """ Load our voltages into the FEE DACs, and save them as the FEE's preset.
+
+        With differential, only the voltages which differ from the FEE's
+        known DAC values are sent. See FeeControl.setDacs().
+        """
+
+        sets = [('bias', k, v, ch)
+                for ch in channels
+                for k, v in self.presets.items() if v is not None]
+        if differential and not verify and fee.presetIsSaved(self.name, sets):
+            fee.logger.debug('FEE preset %s is already saved', self.name)
+            return
+
         oldTimeout = fee.device.timeout
         fee.device.timeout = 5.0
         if False and self.preload:
             fee.sendCommandStr('lp,%s' % (self.name))
-        for ch in channels:
-            for k, v in self.presets.items():
-                if v is not None:
-                    fee.doSet('bias', k, v, ch)
-        fee.sendCommandStr('sp,%s' % (self.name))
-        fee.device.timeout = oldTimeout
+        try:
+            fee.setDacs(sets, differential=differential, verify=verify)
+            fee.sendCommandStr('sp,%s' % (self.name))
+        finally:
+            fee.device.timeout = oldTimeout
 
 class FeeSet(object):
     channels = []
@@ -131,6 +145,11 @@ class FeeSet(object):
         
         return self._getVal(subName, self.getLetter)
 
+    def getSetVal(self, subName):
+        """ Return the command string to get the set value (e.g. 'gb'), not the measured one. """
+
+        return self._getVal(subName, 'g')
+
     def readVal(self, subName):
         """ Return the command string for a 'read' function. """
 
@@ -188,6 +207,11 @@ class FeeChannelSet(FeeSet):
 
         return self._getVal(subName, channel, self.getLetter)
 
+    def getSetVal(self, subName, channel):
+        """ Return the command string to get the set value (e.g. 'gb'), not the measured one. """
+
+        return self._getVal(subName, channel, 'g')
+
     def readVal(self, subName, channel):
         """ Return the command string for a 'read' function. """
 
@@ -211,6 +235,27 @@ class FeeFeatures:
         return feature in self.features
      
 class FeeControl(object):
+    # How long, in seconds, each command set's values can be reused by
+    # statusAsCards(useCache=True). Sets not listed use defaultStatusTTL.
+    statusTTLs = dict(revision=3600.0,
+                      serial=3600.0,
+                      temps=20.0,
+                      voltage=60.0,
+                      offset=600.0,
+                      bias=60.0)
+    defaultStatusTTL = 60.0
+
+    # Flow control for sendCommands(): the most commands, and the most
+    # bytes, sent to the FEE before their echoes and replies are read.
+    commandWindow = 4
+    inputBufferSize = 64
+
+    # Flow control for sendImage(): the most hex lines, and the most
+    # bytes, sent to the bootloader before their echoes and ACKs are
+    # read. The bootloader can also pause us with XOFF.
+    uploadWindow = 4
+    uploadBufferSize = 192
+
     def __init__(self, port=None, logLevel=logging.DEBUG, sendImage=None,
                  noConnect=False, noPowerup=False, fpga=None, 
                  features=None):
@@ -222,8 +267,17 @@ class FeeControl(object):
         self.logger = logging.getLogger()
         self.logger.setLevel(logLevel)
         self.device = None
-        self.deviceLock = threading.RLock()
+        self._rxBuffer = bytearray()
+        self.scheduler = commandScheduler.CommandScheduler()
+        self.telemetry = None
         self.status = OrderedDict()
+        self.statusCache = dict()
+        self.statusGeneration = dict()
+        self.statusCacheLock = threading.Lock()
+        self.prefetchThread = None
+        self.currentMode = None
+        self.lastModeChange = (None, None)
+        self.forgetDacs()
         self.devConfig = dict(port=port, 
                               baudrate=38400,
                               timeout=2.0)  # The RTD routines need > 0.5s.
@@ -269,6 +323,8 @@ class FeeControl(object):
         if self.device:
             self.device.close()
             self.device = None
+        self._rxBuffer = bytearray()
+        self.forgetDacs()
 
         if self.devName:
             self.device = serial.Serial(**self.devConfig)
@@ -299,6 +355,7 @@ class FeeControl(object):
           4. clocks enabled, but idle.
         """
 
+        self.forgetDacs()
         self.setMode(preset)
 
         self.sendCommandStr('se,5V,on')
@@ -327,6 +384,7 @@ class FeeControl(object):
 
         # Send a spurious read, to paper over a device error on the first read.
         self.sendCommandStr('ro,2p,ch1')
+        self.invalidateStatus()
 
     def doGetAll(self, cset):
         pass
@@ -402,18 +460,135 @@ class FeeControl(object):
         else:
             skip = set(skip)
     
-        for csetName in list(self.commands.keys()):
-            t0 = time.time()
-            if csetName in skip:
-                continue
-            cmdStatus = self.getCommandStatus(csetName)
-            newStatus.update(cmdStatus)
-            t1 = time.time()
-            self.logger.debug("get all %s: %0.2fs" % (csetName, t1-t0))
+        # A full sweep is many transactions. Let mode changes in between them.
+        with self.scheduler.priority('housekeeping'):
+            for csetName in list(self.commands.keys()):
+                t0 = time.time()
+                if csetName in skip:
+                    continue
+                cmdStatus = self.refreshStatus(csetName)
+                newStatus.update(cmdStatus)
+                t1 = time.time()
+                self.logger.debug("get all %s: %0.2fs" % (csetName, t1-t0))
                 
         self.status = newStatus
         return self.status
 
+    def statusTTL(self, csetName):
+        return self.statusTTLs.get(csetName, self.defaultStatusTTL)
+
+    def invalidateStatus(self, csetNames=None):
+        """ Forget the cached values for some or all command sets.
+
+        Any refresh already under way for them is not cached either.
+        """
+
+        if csetNames is None:
+            csetNames = list(self.commands.keys())
+        elif isinstance(csetNames, str):
+            csetNames = [csetNames]
+
+        with self.statusCacheLock:
+            for name in csetNames:
+                self.statusCache.pop(name, None)
+                self.statusGeneration[name] = self.statusGeneration.get(name, 0) + 1
+
+    def refreshStatus(self, csetName):
+        """ Fetch one command set's values, and cache them unless they were invalidated meanwhile.
+
+        Returns the values, as from getCommandStatus().
+        """
+
+        with self.statusCacheLock:
+            generation = self.statusGeneration.get(csetName, 0)
+        t0 = time.time()
+        status = self.getCommandStatus(csetName)
+        with self.statusCacheLock:
+            if self.statusGeneration.get(csetName, 0) == generation:
+                self.statusCache[csetName] = (t0, status)
+        return status
+
+    def staleStatus(self, margin=0.0):
+        """ Return the names of the command sets whose cached values are, or within margin seconds will be, too old. """
+
+        now = time.time()
+        stale = []
+        with self.statusCacheLock:
+            for csetName, cset in self.commands.items():
+                if cset.getLetter is None:
+                    continue
+                cached = self.statusCache.get(csetName)
+                if cached is None or now + margin - cached[0] > self.statusTTL(csetName):
+                    stale.append(csetName)
+        return stale
+
+    def _prefetch(self, csetNames):
+        with self.scheduler.priority('housekeeping'):
+            for csetName in csetNames:
+                try:
+                    self.refreshStatus(csetName)
+                except Exception as e:
+                    self.logger.warn('failed to prefetch FEE %s status: %s', csetName, e)
+
+    def prefetchStatus(self, margin=10.0):
+        """ Refresh, in a background thread, the cached values which will be stale within margin seconds.
+
+        Meant to be called before integrating, so that the readout's
+        statusAsCards(useCache=True) need not wait for the serial line.
+
+        Returns
+        -------
+        thread : threading.Thread or None
+           The prefetching thread, if anything needed fetching.
+        """
+
+        if self.prefetchThread is not None and self.prefetchThread.is_alive():
+            return self.prefetchThread
+
+        stale = self.staleStatus(margin=margin)
+        if not stale:
+            return None
+
+        self.logger.debug('prefetching FEE status: %s', stale)
+        self.prefetchThread = threading.Thread(target=self._prefetch, args=(stale,),
+                                               name='feePrefetch', daemon=True)
+        self.prefetchThread.start()
+        return self.prefetchThread
+
+    def getCachedStatus(self):
+        """ Return all the status values, only fetching the ones older than their TTL.
+
+        Returns
+        -------
+        status : OrderedDict
+           As for getAllStatus()
+        ages : OrderedDict
+           For each command set, the age of its values, in seconds.
+        """
+
+        if self.prefetchThread is not None:
+            self.prefetchThread.join()
+            self.prefetchThread = None
+
+        for csetName in self.staleStatus():
+            self.refreshStatus(csetName)
+
+        now = time.time()
+        status = OrderedDict()
+        ages = OrderedDict()
+        with self.statusCacheLock:
+            for csetName in self.commands.keys():
+                cached = self.statusCache.get(csetName)
+                if cached is None:
+                    continue
+                t0, cmdStatus = cached
+                if cmdStatus:
+                    ages[csetName] = now - t0
+                    status.update(cmdStatus)
+
+        self.status = status
+        return status, ages
+
     def getTemps(self):
         """ Return readings from all temperature sensors. 
 
@@ -436,19 +611,54 @@ class FeeControl(object):
 
         self.sendCommandStr('se,Clks,off')
         self.sendCommandStr('se,all,off')
+        self.invalidateStatus()
+        self.forgetDacs()
+
+    def startTelemetry(self, interval=5.0, nsamples=4096, groups=('temps', 'voltage', 'bias')):
+        """ Start sampling telemetry in the background. See fee.telemetry.TelemetrySampler. """
+
+        from fee import telemetry
+
+        self.stopTelemetry()
+        self.telemetry = telemetry.TelemetrySampler(self, interval=interval,
+                                                    nsamples=nsamples, groups=groups)
+        self.telemetry.start()
+        return self.telemetry
+
+    def stopTelemetry(self):
+        """ Stop sampling telemetry. The samples are kept in self.telemetry. """
+
+        if self.telemetry is not None:
+            self.telemetry.stop()
 
     def printStatus(self):
         for k, v in self.status.items():
             print(k, ': ', v)
 
-    def statusAsCards(self, useCache=False):
+    def statusAsCards(self, useCache=False, asTuples=False):
+        """ Return all the status values as FITS cards, with the age of each command set's values.
+
+        Args
+        ----
+        useCache : bool
+           If True, only fetch values older than their statusTTLs. See getCachedStatus().
+        asTuples : bool
+           If True, return (keyword, value, comment) tuples instead of
+           fits.Cards, which are much slower to make and to read back.
+        """
+
         if useCache is False:
             self.getAllStatus()
+        status, ages = self.getCachedStatus()
         cards = []
-        for k,v in self.status.items():
-            c = fits.Card('HIERARCH %s' % (k), v)
-            cards.append(c)
-                    
+        for k,v in status.items():
+            cards.append(('HIERARCH %s' % (k), v, ''))
+        for csetName, age in ages.items():
+            cards.append(('HIERARCH statusAge.%s' % (csetName), round(age, 1),
+                          '[s] age of the FEE %s values' % (csetName)))
+
+        if not asTuples:
+            cards = [fits.Card(*c) for c in cards]
         return cards
 
     def lockConfig(self):
@@ -724,7 +934,14 @@ class FeeControl(object):
         else:
             cmdStr = cmdSet.setVal(subName, value)
 
-        return self.sendCommandStr(cmdStr)
+        # Invalidate after the set too, to drop any values a prefetch read meanwhile.
+        self.invalidateStatus(setName)
+        try:
+            ret = self.sendCommandStr(cmdStr)
+        finally:
+            self.invalidateStatus(setName)
+
+        return ret
 
     def doGet(self, setName, subName=None, channel=None):
         """  
@@ -745,11 +962,209 @@ class FeeControl(object):
 
         return retVal
     
+    def doSetMany(self, sets, raiseOnError=True):
+        """ Set many values in one pipelined batch. See sendCommands().
+
+        Args
+        ----
+        sets : list of (setName, subName, value, channel) tuples
+           As for doSet(). channel is None for sets without channels.
+        raiseOnError : bool
+           As for sendCommands().
+
+        Returns
+        -------
+        replies : list
+           As for sendCommands()
+        """
+
+        cmdStrs = []
+        setNames = set()
+        for setName, subName, value, channel in sets:
+            cmdSet = self.commands[setName]
+            if channel is not None:
+                cmdStrs.append(cmdSet.setVal(subName, channel, value))
+            else:
+                cmdStrs.append(cmdSet.setVal(subName, value))
+            setNames.add(setName)
+
+        self.invalidateStatus(setNames)
+        try:
+            replies = self.sendCommands(cmdStrs, raiseOnError=False)
+        finally:
+            self.invalidateStatus(setNames)
+
+        errors = [r for r in replies if isinstance(r, Exception)]
+        if errors and raiseOnError:
+            raise RuntimeError("%d of %d sets failed; first: %s" % (len(errors), len(replies),
+                                                                    errors[0]))
+        return replies
+
+    # The command sets whose DAC values we shadow, and the sets' presets.
+    shadowedSets = ('bias', 'offset')
+
+    def _presetSetName(self, name):
+        """ Return the command set a FEE preset holds. """
+
+        return 'offset' if name == 'offset' else 'bias'
+
+    def _noteCommand(self, cmdStr, reply):
+        """ Update the shadow DACs and presets after any command, including raw ones.
+
+        reply is the FEE's reply, or None/an exception if the command failed.
+        """
+
+        parts = cmdStr.strip().split(',')
+        verb = parts[0]
+        ok = isinstance(reply, str) and reply.endswith('SUCCESS')
+        if verb == 'lp' and len(parts) > 1:
+            if ok:
+                self._notePresetLoaded(parts[1])
+            else:
+                self.forgetDacs(self._presetSetName(parts[1]))
+        elif verb == 'sp' and len(parts) > 1:
+            if ok:
+                self.notePresetSaved(parts[1])
+            else:
+                self.presetShadow.pop(parts[1], None)
+        elif verb == 'cal':
+            self.forgetDacs()
+        else:
+            for setName in self.shadowedSets:
+                cmdSet = self.commands[setName]
+                if verb != '%s%s' % (cmdSet.setLetter, cmdSet.letter):
+                    continue
+                try:
+                    subName = parts[1]
+                    if cmdSet.channels:
+                        if not parts[2].startswith('ch'):
+                            raise ValueError(parts[2])
+                        channel = int(parts[2][2:])
+                        value = float(parts[3])
+                    else:
+                        channel = None
+                        value = float(parts[2])
+                except (IndexError, ValueError):
+                    subName = None
+                if subName in cmdSet.subs and subName != 'all':
+                    self._noteDacSet(setName, subName, channel, value, reply)
+                else:
+                    self.forgetDacs(setName)
+
+    def forgetDacs(self, setName=None):
+        """ Forget what we know about the FEE's DACs and stored presets, e.g. after a power cycle. """
+
+        if setName is None:
+            self.dacShadow = dict()
+            self.presetShadow = dict()
+            return
+        for key in [k for k in self.dacShadow if k[0] == setName]:
+            del self.dacShadow[key]
+
+    def _noteDacSet(self, setName, subName, channel, value, reply):
+        """ Update the shadow DACs after a set: reply is the FEE's reply, or None/an exception if it failed. """
+
+        if setName not in self.shadowedSets:
+            return
+        key = (setName, subName, channel)
+        if isinstance(reply, str) and reply.endswith('SUCCESS'):
+            self.dacShadow[key] = float(value)
+        else:
+            self.dacShadow.pop(key, None)
+
+    def knownDac(self, setName, subName, channel):
+        """ Return the FEE's DAC value as we last set or loaded it, or None if we do not know it. """
+
+        return self.dacShadow.get((setName, subName, channel))
+
+    def notePresetSaved(self, name):
+        """ Record that the current DACs were saved as preset name. """
+
+        setName = self._presetSetName(name)
+        allSubs = [n for n in self.commands[setName].subs if n != 'all']
+        keys = [(setName, sub, ch) for sub in allSubs for ch in (0, 1)]
+        if all(k in self.dacShadow for k in keys):
+            self.presetShadow[name] = {k:self.dacShadow[k] for k in keys}
+        else:
+            self.presetShadow.pop(name, None)
+
+    def presetIsSaved(self, name, sets):
+        """ Whether we know that the FEE's preset name already has all these values. """
+
+        saved = self.presetShadow.get(name)
+        if saved is None:
+            return False
+        for setName, subName, value, channel in sets:
+            savedVal = saved.get((setName, subName, channel))
+            if savedVal is None or abs(savedVal - float(value)) > 1e-6:
+                return False
+        return True
+
+    def _notePresetLoaded(self, name):
+        """ Update the shadow DACs after an lp: we know them if we know the preset. """
+
+        setName = self._presetSetName(name)
+        self.forgetDacs(setName)
+        if name in self.presetShadow:
+            self.dacShadow.update(self.presetShadow[name])
+
+    def setDacs(self, sets, differential=True, verify=False, tolerance=0.01,
+                raiseOnError=True):
+        """ Set bias or offset DACs, only sending the values which differ from the FEE's known ones.
+
+        Args
+        ----
+        sets : list of (setName, subName, value, channel) tuples
+           As for doSetMany()
+        differential : bool
+           If False, send all the values.
+        verify : bool
+           Read back the set values ('gb'/'go') and raise a RuntimeError
+           if any is off by more than tolerance.
+        raiseOnError : bool
+           As for doSetMany().
+
+        Returns
+        -------
+        sent : list
+           The sets which were actually sent.
+        replies : list
+           For each sent set, its reply or exception, as from doSetMany().
+        """
+
+        if differential:
+            sent = [s for s in sets
+                    if s[0] not in self.shadowedSets
+                    or self.knownDac(s[0], s[1], s[3]) is None
+                    or abs(self.knownDac(s[0], s[1], s[3]) - float(s[2])) > 1e-6]
+        else:
+            sent = list(sets)
+        self.logger.debug('setDacs: sending %d of %d values', len(sent), len(sets))
+        replies = self.doSetMany(sent, raiseOnError=raiseOnError) if sent else []
+
+        if verify:
+            bad = []
+            for setName, subName, value, channel in sets:
+                cmdSet = self.commands[setName]
+                if channel is None:
+                    cmdStr = cmdSet.getSetVal(subName)
+                else:
+                    cmdStr = cmdSet.getSetVal(subName, channel)
+                readVal = float(self.sendCommandStr(cmdStr))
+                if abs(readVal - float(value)) > tolerance:
+                    bad.append('%s.%s.ch%s=%s (wanted %s)' % (setName, subName, channel,
+                                                             readVal, value))
+                    self.dacShadow.pop((setName, subName, channel), None)
+            if bad:
+                raise RuntimeError("DAC values did not verify: %s" % (', '.join(bad)))
+
+        return sent, replies
+
     def raw(self, cmdStr):
         return self.sendCommandStr(cmdStr)
 
     def sendImage(self, path, verbose=True, doWait=True, sendReboot=False,
-                  charAtATime=False, cmd=None):
+                  charAtATime=False, window=None, cmd=None):
         """Download an image file to the interlock board.
 
         Args
@@ -763,6 +1178,9 @@ class FeeControl(object):
         charAtATime: bool
           Whether to send the image one character at a time (checking the echo) instead
           of one line at a time (also checking the echo.
+        window : int
+          The most lines in flight. Default is self.uploadWindow. 1
+          sends each line only after the previous one was ACKed.
         cmd : `actorcore.Command`
           The driving command, to which we can send reassuring messages of progress,
 
@@ -775,13 +1193,29 @@ class FeeControl(object):
         will effectively power-cycle it from this routine. The gotcha
         there is that as of 2021-09-20, a running FEE will hang if
         sent reboot twice.
+
+        Any telemetry sampling is stopped, and the whole upload holds
+        the serial line, so that no other command reaches the
+        bootloader. Afterwards nothing is known about the FEE's state.
         """
 
-        eol = chr(0x0a)
-        ack = chr(0x06) # ; ack='+'
-        nak = chr(0x15) # ; name='-'
-        lineNumber = 1
-        maxRetries = 5
+        if self.telemetry is not None and self.telemetry.isRunning:
+            self.logger.warn('stopping telemetry for the image upload')
+            self.stopTelemetry()
+        if self.prefetchThread is not None:
+            self.prefetchThread.join()
+
+        try:
+            with self.scheduler.priority('critical'), self.scheduler.transaction():
+                self._loadImage(path, verbose=verbose, doWait=doWait, sendReboot=sendReboot,
+                                charAtATime=charAtATime, window=window, cmd=cmd)
+        finally:
+            self.invalidateStatus()
+            self.forgetDacs()
+
+    def _loadImage(self, path, verbose=True, doWait=True, sendReboot=False,
+                   charAtATime=False, window=None, cmd=None):
+        """ Reconnect, and run the bootloader protocol. See sendImage(). """
 
         # We are doing something violent: always make a new connection.
         self.connectToDevice()
@@ -820,56 +1254,23 @@ class FeeControl(object):
         logLevel = self.logger.level
         # self.logger.setLevel(logging.INFO)
         self.device.timeout = 1.0 # self.devConfig['timeout'] * 100
-        strTrans = str.maketrans('', '', '\x11\x13')
         self.logger.info(f'sending image file {path}')
         with open(path, 'rt') as hexfile:
             lines = hexfile.readlines()
-            t0 = time.time()
-            msg = 'sending image file %s, %d lines' % (path, len(lines))
-            self.logger.info(msg)
-            if cmd is not None:
-                cmd.inform(f'text="{msg}"')
-            for l_i, rawl in enumerate(lines):
-                hexl = rawl.strip()
-                if hexl[0] == ';':
-                    continue
-                retries = 0
-                while True:
-                    if verbose and retries > 0:
-                        self.logger.warn('resending line %d; try %d' % (lineNumber, 
-                                                                        retries))
-                    fullLine = hexl+eol
-                    if verbose and lineNumber%100 == 1:
-                        msg = 'sending line %d / %d' % (lineNumber, len(lines))
-                        self.logger.info(msg)
-                        if cmd is not None:
-                            cmd.inform(f'text="{msg}"')
-                            
-                    self.logger.debug("sending line %d: %r", lineNumber, fullLine)
-                    if charAtATime:
-                        retline = self.sendOneLinePerChar(fullLine)
-                    else:
-                        self.device.write(fullLine.encode('latin-1'))
-                        retline = self.device.read(size=len(hexl)+len(eol)+1).decode('latin-1')
-                    self.logger.debug('recv %r' % (retline))
-                    retline = retline.translate(strTrans)
-
-                    if fullLine != retline[:len(fullLine)]:
-                        self.logger.warn("command echo mismatch. sent %r rcvd %r" % (fullLine, retline))
-                    ret = retline[-1]
-                    lineNumber += 1
-                    if ret == ack or hexl == ':00000001FF':
-                        break
-                    if ret != nak:
-                        raise RuntimeError("unexpected response (%r in %r) after sending line %d" %
-                                           (ret, retline, lineNumber-1))
-                    retries += 1
-                    if retries >= maxRetries:
-                        raise RuntimeError("too many retries (%d) on line %d" %
-                                           (retries, lineNumber-1))
+        t0 = time.time()
+        msg = 'sending image file %s, %d lines' % (path, len(lines))
+        self.logger.info(msg)
+        if cmd is not None:
+            cmd.inform(f'text="{msg}"')
+
+        if window is None:
+            window = self.uploadWindow
+        if charAtATime or window <= 1:
+            self._sendHexLines(lines, verbose=verbose, charAtATime=charAtATime, cmd=cmd)
+        else:
+            self._sendHexWindowed(lines, window=window, verbose=verbose, cmd=cmd)
+        t1 = time.time()
 
-            t1 = time.time()
-            
         msg = 'sent image file %s in %0.2f seconds' % (path, t1-t0)
         self.logger.info(msg)
         if cmd is not None:
@@ -886,6 +1287,174 @@ class FeeControl(object):
 
         self.logger.setLevel(logLevel)
 
+    def _sendHexLines(self, lines, verbose=True, charAtATime=False, cmd=None):
+        """ Send hex lines to the bootloader, each after the previous one was ACKed. """
+
+        eol = chr(0x0a)
+        ack = chr(0x06) # ; ack='+'
+        nak = chr(0x15) # ; name='-'
+        lineNumber = 1
+        maxRetries = 5
+        strTrans = str.maketrans('', '', '\x11\x13')
+
+        for l_i, rawl in enumerate(lines):
+            hexl = rawl.strip()
+            if hexl[0] == ';':
+                continue
+            retries = 0
+            while True:
+                if verbose and retries > 0:
+                    self.logger.warn('resending line %d; try %d' % (lineNumber, 
+                                                                    retries))
+                fullLine = hexl+eol
+                if verbose and lineNumber%100 == 1:
+                    msg = 'sending line %d / %d' % (lineNumber, len(lines))
+                    self.logger.info(msg)
+                    if cmd is not None:
+                        cmd.inform(f'text="{msg}"')
+                        
+                self.logger.debug("sending line %d: %r", lineNumber, fullLine)
+                if charAtATime:
+                    retline = self.sendOneLinePerChar(fullLine)
+                else:
+                    self.device.write(fullLine.encode('latin-1'))
+                    retline = self.device.read(size=len(hexl)+len(eol)+1).decode('latin-1')
+                self.logger.debug('recv %r' % (retline))
+                retline = retline.translate(strTrans)
+
+                if fullLine != retline[:len(fullLine)]:
+                    self.logger.warn("command echo mismatch. sent %r rcvd %r" % (fullLine, retline))
+                ret = retline[-1]
+                lineNumber += 1
+                if ret == ack or hexl == ':00000001FF':
+                    break
+                if ret != nak:
+                    raise RuntimeError("unexpected response (%r in %r) after sending line %d" %
+                                       (ret, retline, lineNumber-1))
+                retries += 1
+                if retries >= maxRetries:
+                    raise RuntimeError("too many retries (%d) on line %d" %
+                                       (retries, lineNumber-1))
+
+    def _sendHexWindowed(self, lines, window, verbose=True, maxRetries=5, cmd=None):
+        """ Send hex lines to the bootloader, keeping up to window lines in flight.
+
+        The echoes and ACK/NAKs are matched to the lines as they
+        arrive, and only NAKed lines are sent again. An XOFF from the
+        bootloader stops us sending until its XON.
+
+        Records other than data (the address records, and the end of
+        file) are sent alone, once all earlier lines have been ACKed:
+        a retransmitted data line must never be written under a later
+        address record, and the bootloader may not answer the end of
+        file record before booting.
+        """
+
+        eol = '\n'
+        ack = '\x06'
+        nak = '\x15'
+        xon = '\x11'
+        xoff = '\x13'
+
+        records = []
+        endRecords = []
+        for rawl in lines:
+            hexl = rawl.strip()
+            if not hexl or hexl[0] == ';':
+                continue
+            if hexl[7:9] == '01':
+                endRecords.append(hexl + eol)
+            else:
+                records.append(hexl + eol)
+        isBarrier = [r[7:9] != '00' for r in records]
+
+        toSend = deque(range(len(records)))
+        resend = deque()
+        retries = [0] * len(records)
+        inFlight = deque()
+        inFlightBytes = 0
+        paused = False
+        echo = []
+        nAcked = 0
+        nSent = 0
+        nextReport = 100
+
+        while toSend or resend or inFlight:
+            # Send whatever the window, the byte limit, and the flow control allow.
+            while not paused and (resend or toSend) and len(inFlight) < window:
+                queue = resend if resend else toSend
+                rec_i = queue[0]
+                if inFlight and (isBarrier[rec_i] or isBarrier[inFlight[-1]]):
+                    break
+                if inFlight and inFlightBytes + len(records[rec_i]) > self.uploadBufferSize:
+                    break
+                queue.popleft()
+                self.logger.debug("sending line %d: %r", rec_i+1, records[rec_i])
+                self.device.write(records[rec_i].encode('latin-1'))
+                inFlight.append(rec_i)
+                inFlightBytes += len(records[rec_i])
+                nSent += 1
+
+            data = self.device.read(size=max(1, self.device.in_waiting))
+            if not data:
+                if paused:
+                    self.logger.warn('no XON from the bootloader; resuming')
+                    paused = False
+                    continue
+                raise RuntimeError("timed out waiting for the bootloader's reply to line %d (%r)" %
+                                   (inFlight[0]+1, records[inFlight[0]]))
+
+            for c in data.decode('latin-1'):
+                if c == xoff:
+                    paused = True
+                    continue
+                if c == xon:
+                    paused = False
+                    continue
+                if not echo or echo[-1] != eol:
+                    echo.append(c)
+                    continue
+
+                if not inFlight:
+                    raise RuntimeError("unexpected input from the bootloader: %r" % (''.join(echo) + c))
+                rec_i = inFlight.popleft()
+                inFlightBytes -= len(records[rec_i])
+                retline = ''.join(echo)
+                echo = []
+                self.logger.debug('recv %r for line %d', retline + c, rec_i+1)
+                if retline != records[rec_i]:
+                    self.logger.warn("command echo mismatch. sent %r rcvd %r" % (records[rec_i], retline))
+
+                if c == ack:
+                    nAcked += 1
+                    if verbose and nAcked >= nextReport:
+                        msg = 'sent line %d / %d' % (nAcked, len(records))
+                        self.logger.info(msg)
+                        if cmd is not None:
+                            cmd.inform(f'text="{msg}"')
+                        nextReport += 100
+                elif c == nak:
+                    retries[rec_i] += 1
+                    if retries[rec_i] >= maxRetries:
+                        raise RuntimeError("too many retries (%d) on line %d" %
+                                           (retries[rec_i], rec_i+1))
+                    if verbose:
+                        self.logger.warn('resending line %d; try %d' % (rec_i+1, retries[rec_i]))
+                    resend.append(rec_i)
+                else:
+                    raise RuntimeError("unexpected response (%r in %r) after sending line %d" %
+                                       (c, retline, rec_i+1))
+
+        # The end of file record is answered by a reboot, not necessarily an ACK.
+        for endRecord in endRecords:
+            self.logger.debug("sending end of file record: %r", endRecord)
+            self.device.write(endRecord.encode('latin-1'))
+            ret = self.device.read(size=len(endRecord)+1).decode('latin-1')
+            self.logger.debug('recv %r', ret)
+
+        self.logger.info('sent %d lines, with %d resends' % (len(records) + len(endRecords),
+                                                             nSent - len(records)))
+
     def sendOneLinePerChar(self, strline, debug=False):
         """Send a line to the bootloader one character at a time.
 
@@ -921,6 +1490,10 @@ class FeeControl(object):
                 break
             print("gobbled: ", ret)
                                                         
+    def commandMetrics(self):
+        """ Return the serial line wait times, per priority class. See CommandScheduler.metrics(). """
+        return self.scheduler.metrics()
+
     def sendCommandStr(self, cmdStr, noTilde=False, EOL=None):
         if EOL is None:
             EOL = self.EOL
@@ -930,25 +1503,134 @@ class FeeControl(object):
             fullCmd = "~%s%s" % (cmdStr, EOL)
 
         writeCmd = fullCmd.encode('latin-1')
-        with self.deviceLock:
-            self.logger.debug("sending command :%r:" % (fullCmd))
+        with self.scheduler.transaction():
+            ret = None
             try:
-                self.device.write(writeCmd)
-            except serial.writeTimeoutError as e:
-                raise
-            except serial.SerialException as e:
-                raise
-            except Exception as e:
-                raise
-
-            ret = self.readResponse()
-            if ret != fullCmd.strip():
-                raise RuntimeError("command echo mismatch. sent :%r: rcvd :%r:" % (fullCmd, ret))
- 
-            ret = self.readResponse()
+                self.logger.debug("sending command :%r:" % (fullCmd))
+                try:
+                    self.device.write(writeCmd)
+                except serial.writeTimeoutError as e:
+                    raise
+                except serial.SerialException as e:
+                    raise
+                except Exception as e:
+                    raise
+
+                echo = self.readResponse()
+                if echo != fullCmd.strip():
+                    raise RuntimeError("command echo mismatch. sent :%r: rcvd :%r:" % (fullCmd, echo))
+
+                ret = self.readResponse()
+            finally:
+                if not noTilde:
+                    self._noteCommand(cmdStr, ret)
 
         return ret
 
+    def sendCommands(self, cmdStrs, raiseOnError=True, window=None):
+        """ Send many commands, without waiting for each reply before sending the next.
+
+        Up to window commands, and self.inputBufferSize bytes, are sent
+        ahead of the replies, so that the FEE's input buffer cannot
+        overflow. The echoes and replies are matched to the commands in
+        order. After an echo mismatch or a timeout we cannot tell which
+        reply belongs to which command, so nothing more is sent, the
+        input is drained, and the rest of the commands fail.
+
+        Args
+        ----
+        cmdStrs : list of str
+           The commands, as for sendCommandStr().
+        raiseOnError : bool
+           Whether to raise a RuntimeError if any command failed.
+        window : int
+           The most commands in flight. Default is self.commandWindow.
+
+        Returns
+        -------
+        replies : list
+           For each command, its reply string, or the exception
+           describing how it failed.
+        """
+
+        if window is None:
+            window = self.commandWindow
+        fullCmds = ["~%s%s" % (cmdStr, self.EOL) for cmdStr in cmdStrs]
+        replies = [None] * len(fullCmds)
+        inFlight = deque()
+        inFlightBytes = 0
+        nextCmd = 0
+        inSync = True
+
+        t0 = time.time()
+        with self.scheduler.transaction():
+            try:
+                while inSync and (nextCmd < len(fullCmds) or inFlight):
+                    # If a better priority thread is waiting, stop sending,
+                    # and let it have the line once our replies are in.
+                    if not inFlight:
+                        self.scheduler.yieldLine()
+                    preempted = bool(inFlight) and self.scheduler.betterWaiting()
+                    while (not preempted
+                           and nextCmd < len(fullCmds) and len(inFlight) < max(1, window)
+                           and (not inFlight
+                                or inFlightBytes + len(fullCmds[nextCmd]) <= self.inputBufferSize)):
+                        writeCmd = fullCmds[nextCmd].encode('latin-1')
+                        self.logger.debug("sending command :%r:" % (fullCmds[nextCmd]))
+                        self.device.write(writeCmd)
+                        inFlight.append(nextCmd)
+                        inFlightBytes += len(writeCmd)
+                        nextCmd += 1
+
+                    cmd_i = inFlight.popleft()
+                    inFlightBytes -= len(fullCmds[cmd_i])
+                    ret = self.readResponse()
+                    if ret != fullCmds[cmd_i].strip():
+                        replies[cmd_i] = RuntimeError("command echo mismatch. sent :%r: rcvd :%r:" %
+                                                      (fullCmds[cmd_i], ret))
+                        inSync = False
+                        break
+                    replies[cmd_i] = self.readResponse()
+                    self._noteCommand(cmdStrs[cmd_i], replies[cmd_i])
+
+                if not inSync:
+                    for cmd_i in inFlight:
+                        replies[cmd_i] = RuntimeError("reply to %r lost after an earlier error" %
+                                                      (cmdStrs[cmd_i]))
+                    for cmd_i in range(nextCmd, len(fullCmds)):
+                        replies[cmd_i] = RuntimeError("%r not sent after an earlier error" %
+                                                      (cmdStrs[cmd_i]))
+                    self._drainInput()
+            finally:
+                # The replies read were noted as they came in: now the failures.
+                for cmdStr, reply in zip(cmdStrs, replies):
+                    if not isinstance(reply, str):
+                        self._noteCommand(cmdStr, reply)
+
+        errors = [r for r in replies if isinstance(r, Exception)]
+        self.logger.debug("sent %d commands in %0.3fs, %d errors" % (len(fullCmds),
+                                                                     time.time()-t0,
+                                                                     len(errors)))
+        if errors and raiseOnError:
+            raise RuntimeError("%d of %d commands failed; first: %s" % (len(errors), len(fullCmds),
+                                                                        errors[0]))
+        return replies
+
+    def _drainInput(self, quietTime=0.2):
+        """ Drop all input until the device has been quiet for quietTime seconds. """
+
+        oldTimeout = self.device.timeout
+        self.device.timeout = quietTime
+        try:
+            while True:
+                data = self.device.read(size=max(1, self.device.in_waiting))
+                if not data:
+                    break
+                self.logger.debug("drained :%r:" % (data))
+        finally:
+            self.device.timeout = oldTimeout
+        self._rxBuffer = bytearray()
+
     def readResponse(self, EOL=None):
         """ Read a single response line, up to the next self.EOL.
 
@@ -960,17 +1642,27 @@ class FeeControl(object):
         Notes
         -----
         Ignores CRs
+
+        Reads whatever the device has waiting, and keeps any bytes after
+        the EOL in self._rxBuffer for the next response. If the device
+        read times out, returns what has been received so far.
         """
 
         if EOL is None:
             EOL = self.EOL
-
-        response = ""
+        eol = EOL.encode('latin-1')
+        buf = self._rxBuffer
 
         while True:
+            eolIdx = buf.find(eol)
+            if eolIdx >= 0:
+                line = bytes(buf[:eolIdx])
+                del buf[:eolIdx+len(eol)]
+                break
+
             try:
-                c = self.device.read(size=1)
-                # self.logger.debug("received char :%r:" % (c))
+                # Block for at least one byte, but take everything already here.
+                data = self.device.read(size=max(1, self.device.in_waiting))
             except serial.SerialException as e:
                 raise
             except serial.portNotOpenError as e:
@@ -978,17 +1670,18 @@ class FeeControl(object):
             except Exception as e:
                 raise
 
-            c = str(c, 'latin-1')
-            if c == '':
-                self.logger.warn('pyserial device read(1) timed out')
-
-            if self.ignoredEOL is not None and c == self.ignoredEOL:
-                self.logger.debug("ignoring %r" % (c))
-                continue
-            if c in (EOL, ''):
+            if not data:
+                self.logger.warn('pyserial device read timed out')
+                line = bytes(buf)
+                del buf[:]
                 break
-            response += c
-                
+            buf.extend(data)
+
+        response = str(line, 'latin-1')
+        if self.ignoredEOL is not None and self.ignoredEOL in response:
+            self.logger.debug("ignoring %r" % (self.ignoredEOL))
+            response = response.replace(self.ignoredEOL, '')
+
         self.logger.debug("received :%s:" % (response))
         return response
 
@@ -1013,21 +1706,164 @@ class FeeControl(object):
         return "%d%s" % (ampNum%4, leg), channel
 
     def setMode(self, newMode):
+        # Loading a mode changes the bias and offset DACs.
+        self.invalidateStatus(('bias', 'offset'))
+
         # Setting modes fails every now any then. But I do not think
         # it is a real and significant failure, so just try again.
         try:
-            ret = self.sendCommandStr('lp,%s' % (newMode))
-        except RuntimeError:
-            self.logger.warn('setMode failed; retrying....')
-            ret = self.sendCommandStr('lp,%s' % (newMode))
-
+            with self.scheduler.priority('critical'):
+                try:
+                    ret = self.sendCommandStr('lp,%s' % (newMode))
+                except RuntimeError:
+                    self.logger.warn('setMode failed; retrying....')
+                    ret = self.sendCommandStr('lp,%s' % (newMode))
+        finally:
+            self.invalidateStatus(('bias', 'offset'))
+
+        self.lastModeChange = (self.currentMode, newMode)
+        self.currentMode = newMode
         return ret
 
+    def changedRails(self, oldMode, newMode):
+        """ Return the bias rails whose preset values differ between two modes.
+
+        If either mode has no local preset, returns all the rails.
+        """
+
+        allRails = [n for n in self.commands['bias'].subs if n != 'all']
+        try:
+            old = self.presets[oldMode].presets
+            new = self.presets[newMode].presets
+        except KeyError:
+            return allRails
+        return [n for n in allRails if old.get(n) != new.get(n)]
+
+    def waitForSettle(self, names=None, tolerance=0.2, maxTime=2.0, pollInterval=0.02,
+                      channels=(0,1)):
+        """ Wait until the bias readbacks are within tolerance of their set values.
+
+        Args
+        ----
+        names : list of str
+           The bias rails to check. Default is those changed by the last setMode().
+        tolerance : float
+           The largest acceptable difference, in volts.
+        maxTime : float
+           The most seconds to wait. We give up, with a warning, after that.
+        pollInterval : float
+           Seconds between readbacks.
+        channels : list of int
+           The channels to check.
+
+        Returns
+        -------
+        settled : bool
+           Whether all the rails got within tolerance.
+        elapsed : float
+           How long we waited.
+        """
+
+        t0 = time.time()
+        if names is None:
+            names = self.changedRails(*self.lastModeChange)
+        if not names:
+            return True, 0.0
+
+        allRails = [n for n in self.commands['bias'].subs if n != 'all']
+        idx = np.array([allRails.index(n) for n in names])
+        targets = dict()
+        for ch in channels:
+            setVals = self.sendCommandStr('gb,all,ch%d' % (ch)).split(',')
+            targets[ch] = np.array([float(v) for v in setVals])[idx]
+
+        while True:
+            worst = 0.0
+            worstRail = None
+            for ch in channels:
+                readVals = np.array(self.doGet('bias', 'all', ch))[idx]
+                diffs = np.abs(readVals - targets[ch])
+                if diffs.max() > worst:
+                    worst = diffs.max()
+                    worstRail = 'ch%d.%s' % (ch, names[diffs.argmax()])
+
+            elapsed = time.time() - t0
+            if worst <= tolerance:
+                self.logger.info('FEE bias settled in %0.3fs (%d rails, worst %0.3fV)',
+                                 elapsed, len(names), worst)
+                return True, elapsed
+            if elapsed >= maxTime:
+                self.logger.warn('FEE bias not settled after %0.3fs: %s is off by %0.3fV',
+                                 elapsed, worstRail, worst)
+                return False, elapsed
+            time.sleep(pollInterval)
+
     def getMode(self):
         ret = self.sendCommandStr('gp')
         return ret
     
+    def setAllOffsets(self, amps, n=None, p=None, skipUnchanged=True, doSave=True):
+        """ Set the offsets of some amps, on both legs, in one batch, then save them once.
+
+        Args
+        ----
+        amps : list of int
+           The 0..7 amp indices.
+        n, p : float or list of floats
+           The levels for each leg, one per amp or one for all. None leaves a leg alone.
+        skipUnchanged : bool
+           Do not send levels which the FEE is known to already have.
+        doSave : bool
+           Save the offsets as the FEE's 'offset' preset, with one 'sp,offset'.
+
+        Returns
+        -------
+        nSent : int
+           The number of levels sent.
+        elapsed : float
+           The seconds taken, including the save.
+        """
+
+        t0 = time.time()
+        sets = []
+        setAmps = dict()
+        for leg, levels in (('n', n), ('p', p)):
+            if levels is None:
+                continue
+            if np.isscalar(levels):
+                levels = np.zeros(len(amps),dtype='f4') + levels
+            if len(amps) != len(levels):
+                raise RuntimeError("require same number of amps (%r) and levels (%r)" % (amps, levels))
+            for a, level in zip(amps, levels):
+                ampName, channel = self.ampParts(a, leg=leg)
+                sets.append(('offset', ampName, round(float(level),2), channel))
+                setAmps[(ampName, channel)] = '%d%s' % (a, leg)
+
+        sent, replies = self.setDacs(sets, differential=skipUnchanged, raiseOnError=False)
+        failed = ['amp %s: %s' % (setAmps[(s[1], s[3])], reply) for s, reply in zip(sent, replies)
+                  if not (isinstance(reply, str) and reply.endswith('SUCCESS'))]
+        if failed:
+            raise RuntimeError('setting offsets failed for %d of %d: %s' % (len(failed), len(sent),
+                                                                             '; '.join(failed)))
+
+        saved = doSave and (sent or not self.presetIsSaved('offset', sets))
+        if saved:
+            self.sendCommandStr('sp,offset')
+
+        elapsed = time.time() - t0
+        self.logger.info('set %d of %d offsets in %0.3fs%s', len(sent), len(sets), elapsed,
+                         ' and saved' if saved else '')
+        return len(sent), elapsed
+
     def setOffsets(self, amps, levels, leg='n', pause=0.0, doSave=True):
+        """ Set the offsets of some amps on one leg. See setAllOffsets().
+
+        With pause, the levels are sent one at a time, pause seconds apart.
+        """
+
+        if pause <= 0:
+            return self.setAllOffsets(amps, **{leg:levels}, doSave=doSave)
+
         if np.isscalar(levels):
             levels = np.zeros(len(amps),dtype='f4') + levels
         if len(amps) != len(levels):
@@ -1041,32 +1877,30 @@ class FeeControl(object):
                 self.logger.debug("raw received :%r:" % (ret))
             if not ret.endswith('SUCCESS'):
                 raise RuntimeError('setLevels command returned: %s' % (ret))
-            if pause > 0:
-                time.sleep(pause)
+            time.sleep(pause)
 
-            if doSave:
-                self.sendCommandStr('sp,offset')
+        if doSave:
+            self.sendCommandStr('sp,offset')
 
     def zeroOffsets(self, amps=None, leg=True):
         if amps is None:
             amps = list(range(8))
-        levels = [0.0] * len(amps)
 
         if leg is True:
             legs = ('n','p')
         else:
             legs = leg,
-    
-        if 'p' in legs:
-            self.setOffsets(amps, levels, leg='p')
-        if 'n' in legs:
-            self.setOffsets(amps, levels, leg='n')
 
-    def setPreset(self, name):
+        return self.setAllOffsets(amps,
+                                  n=0.0 if 'n' in legs else None,
+                                  p=0.0 if 'p' in legs else None)
+
+    def setPreset(self, name, differential=True):
         vset = self.presets[name]
-        for ch in 0, 1:
-            for k, v in vset.items():
-                self.doSet('bias', k, v, ch)
+        self.setDacs([('bias', k, v, ch)
+                      for ch in (0, 1)
+                      for k, v in vset.presets.items()],
+                     differential=differential)
 
 def main(argv=None):
     if argv is None:
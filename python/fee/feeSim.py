@@ -0,0 +1,544 @@
+#!/usr/bin/env python
+
+""" Simulate the FEE controller's serial protocol on a pseudo-terminal.
+
+The simulator implements the command grammar which FeeControl uses:
+the '~' prefix, the echo of each command line, and one reply line,
+both ended with CR-LF. It keeps per-channel bias and offset DACs, the
+stored mode presets, the supply enables, and a few fake
+temperatures. Bias readbacks (rb) slew towards the set values with
+time constant settleTau, so code which waits for voltages to settle
+can be exercised.
+
+Latency is modelled as a time per byte in each direction, which
+defaults to the 38400 baud line rate, plus a fixed time per command,
+plus optionally a fixed link latency each way, as added by USB serial
+adapters.
+The line is full duplex: a command which was sent while the previous
+one was being answered does not wait for its own bytes again. Errors
+can be injected: a corrupted echo, or a missing reply.
+
+enterBootloader() switches to the firmware bootloader's protocol, as
+FeeControl.sendImage() expects it: '*' starts the load, then each
+Intel hex line is echoed and answered with ACK, or NAK if its checksum
+is bad (or with probability nakRate). Each line takes lineTime to
+write, optionally bracketed by XOFF/XON. The loaded bytes are kept in
+sim.image, by address.
+
+Examples
+--------
+
+From the shell, leave a simulator running and connect to the pty it prints:
+
+  feeSim --commandTime 0.005
+  feeSim --bootloader --lineTime 0.004
+
+Or in-process:
+
+>>> sim = feeSim.FeeSim(commandTime=0.005)
+>>> sim.start()
+>>> fee = feeControl.FeeControl(port=sim.portName, noPowerup=True)
+>>> fee.getAllStatus()
+>>> sim.stop()
+"""
+
+import argparse
+import logging
+import math
+import os
+import queue
+import select
+import sys
+import threading
+import time
+import tty
+
+import numpy as np
+
+from fee import feeControl
+
+class FeeSim(object):
+    # Nominal supply voltages, in the voltage command set's order, and the enable which powers each.
+    supplies = (('3V3M', 3.3, None), ('3V3', 3.3, None),
+                ('5VP', 5.0, '5V'), ('5VN', -5.0, '5V'),
+                ('5VPpa', 5.0, 'PA'), ('5VNpa', -5.0, 'PA'),
+                ('12VP', 12.0, '12V'), ('12VN', -12.0, '12V'),
+                ('24VN', -24.0, '24V'), ('54VP', 54.0, '54V'))
+
+    ACK = '\x06'
+    NAK = '\x15'
+    XON = '\x11'
+    XOFF = '\x13'
+
+    def __init__(self, byteTime=10/38400, commandTime=0.002, settleTau=0.05,
+                 echoErrorRate=0.0, dropRate=0.0, seed=None,
+                 lineTime=0.004, nakRate=0.0, flowControl=False, linkLatency=0.0,
+                 logLevel=logging.INFO):
+        """ A simulated FEE, served on a new pty.
+
+        Args
+        ----
+        byteTime : float
+           Seconds per byte, each way. Default is the 38400 baud line rate.
+        commandTime : float
+           Seconds the FEE takes to process each command.
+        settleTau : float
+           Time constant, in seconds, of the bias readbacks' approach to the set values.
+        echoErrorRate : float
+           Probability of corrupting a command's echo.
+        dropRate : float
+           Probability of sending no reply to a command.
+        seed : int
+           For the error injection.
+        lineTime : float
+           Seconds the bootloader takes to write each hex line.
+        nakRate : float
+           Probability of the bootloader NAKing a good hex line.
+        flowControl : bool
+           Whether the bootloader sends XOFF/XON around each line's write.
+        linkLatency : float
+           Seconds added to the delivery of everything, each way.
+        """
+
+        self.logger = logging.getLogger('feeSim')
+        self.logger.setLevel(logLevel)
+
+        self.byteTime = byteTime
+        self.commandTime = commandTime
+        self.settleTau = settleTau
+        self.echoErrorRate = echoErrorRate
+        self.dropRate = dropRate
+        self.lineTime = lineTime
+        self.nakRate = nakRate
+        self.flowControl = flowControl
+        self.linkLatency = linkLatency
+        self.outQueue = queue.Queue()
+        self.rng = np.random.default_rng(seed)
+
+        # Borrow the command sets and the mode presets from an unconnected FeeControl.
+        proto = feeControl.FeeControl(noConnect=True,
+                                      logLevel=logging.getLogger().getEffectiveLevel())
+        self.commands = proto.commands
+        self.biasNames = [n for n in self.commands['bias'].subs if n != 'all']
+        self.offsetNames = [n for n in self.commands['offset'].subs if n != 'all']
+
+        self.presets = dict()
+        for name, preset in proto.presets.items():
+            self.presets[name] = [dict(preset.presets), dict(preset.presets)]
+        self.presets['offset'] = [{n:0.0 for n in self.offsetNames} for ch in (0,1)]
+
+        self.mode = 'idle'
+        self.bias = [dict(self.presets['idle'][ch]) for ch in (0,1)]
+        self.biasRead = [dict(b) for b in self.bias]
+        self.biasChangeTime = time.time()
+        self.offsets = [dict(self.presets['offset'][ch]) for ch in (0,1)]
+        self.enables = {n:False for n in self.commands['enable'].subs if n != 'all'}
+        self.serials = dict(FEE='SIM0001', ADC='SIM0002', PA0='SIM0003',
+                            CCD0='SIMCCD0', CCD1='SIMCCD1')
+        self.revision = 'FEE simulator'
+        self.speed = 'slow'
+
+        self.nCommands = 0
+        self.nErrors = 0
+
+        self.bootState = None
+        self.image = dict()
+        self.upperAddress = 0
+        self.nLines = 0
+        self.nNaks = 0
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.portName = os.ttyname(self.slave)
+        self.thread = None
+        self.running = threading.Event()
+
+    def __str__(self):
+        return "FeeSim(port=%s, mode=%s, commands=%d)" % (self.portName, self.mode, self.nCommands)
+
+    def start(self):
+        """ Serve the pty from daemon threads. """
+
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, name='feeSim', daemon=True)
+        self.thread.start()
+        return self.portName
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def _readLines(self, lines):
+        """ Queue the command lines, with when they would have finished arriving on a real serial line. """
+
+        inbuf = bytearray()
+        inputFreeAt = 0.0
+        while self.running.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if not ready:
+                continue
+            inbuf.extend(os.read(self.master, 4096))
+            tRead = time.time()
+            if self.bootState == 'prompt' and inbuf.startswith(b'*'):
+                del inbuf[:1]
+                inputFreeAt = max(tRead, inputFreeAt) + self.byteTime
+                lines.put(('*', inputFreeAt + self.linkLatency))
+            while True:
+                eolIdx = inbuf.find(b'\n')
+                if eolIdx < 0:
+                    break
+                line = bytes(inbuf[:eolIdx]).decode('latin-1').rstrip('\r')
+                del inbuf[:eolIdx+1]
+
+                inputFreeAt = max(tRead, inputFreeAt) + (eolIdx+1) * self.byteTime
+                lines.put((line, inputFreeAt + self.linkLatency))
+
+    def run(self):
+        """ Read command lines from the pty and answer them, until stop(). """
+
+        self.running.set()
+        lines = queue.Queue()
+        reader = threading.Thread(target=self._readLines, args=(lines,),
+                                  name='feeSimReader', daemon=True)
+        reader.start()
+        writer = threading.Thread(target=self._writeDelayed,
+                                  name='feeSimWriter', daemon=True)
+        writer.start()
+        try:
+            while self.running.is_set():
+                try:
+                    line, arrivalTime = lines.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                self.handleLine(line, arrivalTime=arrivalTime)
+        finally:
+            self.running.clear()
+            reader.join()
+            writer.join()
+
+    def _send(self, text):
+        data = text.encode('latin-1')
+        if self.byteTime > 0:
+            time.sleep(len(data) * self.byteTime)
+        self._write(data)
+
+    def _write(self, data):
+        """ Write to the pty, after any link latency. """
+
+        if self.linkLatency > 0:
+            self.outQueue.put((time.time() + self.linkLatency, data))
+        else:
+            os.write(self.master, data)
+
+    def _writeDelayed(self):
+        while self.running.is_set():
+            try:
+                deliverAt, data = self.outQueue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            time.sleep(max(0.0, deliverAt - time.time()))
+            os.write(self.master, data)
+
+    def handleLine(self, line, arrivalTime=None):
+        """ Echo one command line and send its reply, with any injected errors.
+
+        Does not start before arrivalTime, when the whole line would have been received.
+        """
+
+        if self.bootState is not None:
+            self.handleBootLine(line, arrivalTime=arrivalTime)
+            return
+
+        self.nCommands += 1
+        if arrivalTime is not None:
+            time.sleep(max(0.0, arrivalTime - time.time()))
+        if self.commandTime > 0:
+            time.sleep(self.commandTime)
+
+        echo = line
+        if self.echoErrorRate and self.rng.random() < self.echoErrorRate:
+            self.nErrors += 1
+            echo = line[:-1] + '?' if line else '?'
+            self.logger.info('corrupting echo of %r', line)
+        self._send(echo + '\r\n')
+
+        try:
+            reply = self.execute(line[1:] if line.startswith('~') else line)
+        except Exception as e:
+            reply = 'ERROR: %s' % (e)
+        self.logger.debug('%r -> %r', line, reply)
+
+        if self.dropRate and self.rng.random() < self.dropRate:
+            self.nErrors += 1
+            self.logger.info('dropping reply to %r', line)
+            return
+        self._send(reply + '\r\n')
+
+    def enterBootloader(self, banner=True):
+        """ Switch to the bootloader protocol, as after a power cycle. """
+
+        self.bootState = 'prompt'
+        self.image = dict()
+        self.upperAddress = 0
+        if banner:
+            self._send('Bootloader (FEE simulator)\r\n')
+
+    def handleBootLine(self, line, arrivalTime=None):
+        """ Answer the bootloader's '*', or echo and load one hex line.
+
+        The echo is sent as the line arrives, so it finishes one byte
+        after the line does unless the bootloader was still busy.
+        """
+
+        if arrivalTime is None:
+            arrivalTime = time.time()
+        if self.bootState == 'prompt':
+            if line == '*':
+                self.bootState = 'loading'
+                time.sleep(max(0.0, arrivalTime - time.time()))
+                self._send('*Waiting for Data...\r\n')
+            return
+
+        self.nLines += 1
+        echo = (line + '\n').encode('latin-1')
+        echoDone = max(arrivalTime + self.byteTime, time.time() + len(echo)*self.byteTime)
+        time.sleep(max(0.0, echoDone - time.time()))
+        self._write(echo)
+
+        if self.flowControl:
+            self._write(self.XOFF.encode('latin-1'))
+        try:
+            done = self.loadHexLine(line)
+            ok = True
+        except ValueError as e:
+            self.logger.info('NAKing %r: %s', line, e)
+            done = False
+            ok = False
+        if ok and self.nakRate and self.rng.random() < self.nakRate:
+            ok = False
+        if self.lineTime > 0:
+            time.sleep(self.lineTime)
+        if self.flowControl:
+            self._write(self.XON.encode('latin-1'))
+
+        if not ok:
+            self.nNaks += 1
+            self._send(self.NAK)
+            return
+        self._send(self.ACK)
+        if done:
+            self.bootState = None
+            time.sleep(0.1)
+            self._send('FEE simulator loaded %d bytes\r\n' % (len(self.image)))
+
+    def loadHexLine(self, line):
+        """ Check one Intel hex record, and apply it to self.image. Returns True at the end of file. """
+
+        if not line.startswith(':') or len(line) < 11 or len(line) % 2 != 1:
+            raise ValueError('malformed record')
+        try:
+            rec = bytes.fromhex(line[1:])
+        except ValueError:
+            raise ValueError('non-hex characters')
+        if sum(rec) & 0xff != 0:
+            raise ValueError('bad checksum')
+        nbytes, addr, rtype, data = rec[0], (rec[1] << 8) | rec[2], rec[3], rec[4:-1]
+        if len(data) != nbytes:
+            raise ValueError('bad length')
+
+        if rtype == 0:
+            base = self.upperAddress + addr
+            for i, b in enumerate(data):
+                self.image[base + i] = b
+        elif rtype == 1:
+            return True
+        elif rtype == 2:
+            self.upperAddress = int.from_bytes(data, 'big') << 4
+        elif rtype == 4:
+            self.upperAddress = int.from_bytes(data, 'big') << 16
+        return False
+
+    def _channel(self, chName):
+        if chName not in ('ch0', 'ch1'):
+            raise ValueError('bad channel %s' % (chName))
+        return int(chName[2])
+
+    def _readBias(self, ch, name):
+        """ The bias readback, slewing towards the set value. """
+
+        dt = time.time() - self.biasChangeTime
+        frac = math.exp(-dt/self.settleTau) if self.settleTau > 0 else 0.0
+        old = self.biasRead[ch][name]
+        return self.bias[ch][name] + (old - self.bias[ch][name]) * frac
+
+    def _setBias(self, ch, values):
+        # Freeze the readbacks where they are now, then start slewing to the new values.
+        for c in (0, 1):
+            for n in self.biasNames:
+                self.biasRead[c][n] = self._readBias(c, n)
+        self.biasChangeTime = time.time()
+        self.bias[ch].update(values)
+
+    def _fmt(self, vals):
+        return ','.join('%0.3f' % (v) for v in vals)
+
+    def execute(self, cmd):
+        """ Return the reply to one command, without the '~' or EOL. """
+
+        parts = cmd.split(',')
+        verb, args = parts[0], parts[1:]
+
+        if verb == 'lp':
+            name = args[0]
+            if name not in self.presets:
+                raise ValueError('unknown preset %s' % (name))
+            if name == 'offset':
+                self.offsets = [dict(self.presets[name][ch]) for ch in (0,1)]
+            else:
+                for ch in (0,1):
+                    self._setBias(ch, self.presets[name][ch])
+                self.mode = name
+            return 'SUCCESS'
+        if verb == 'sp':
+            name = args[0]
+            if name == 'offset':
+                self.presets[name] = [dict(o) for o in self.offsets]
+            else:
+                self.presets[name] = [dict(b) for b in self.bias]
+            return 'SUCCESS'
+        if verb == 'gp':
+            return self.mode
+
+        if verb == 'sb':
+            name, ch, val = args[0], self._channel(args[1]), float(args[2])
+            if name not in self.biasNames:
+                raise ValueError('unknown bias %s' % (name))
+            self._setBias(ch, {name:val})
+            return 'SUCCESS'
+        if verb in ('gb', 'rb'):
+            name, ch = args[0], self._channel(args[1])
+            get = (lambda n: self.bias[ch][n]) if verb == 'gb' else (lambda n: self._readBias(ch, n))
+            if name == 'all':
+                return self._fmt([get(n) for n in self.biasNames])
+            return self._fmt([get(name)])
+
+        if verb == 'so':
+            name, ch, val = args[0], self._channel(args[1]), float(args[2])
+            if name not in self.offsetNames:
+                raise ValueError('unknown offset %s' % (name))
+            self.offsets[ch][name] = val
+            return 'SUCCESS'
+        if verb in ('go', 'ro'):
+            name, ch = args[0], self._channel(args[1])
+            if name == 'all':
+                return self._fmt([self.offsets[ch][n] for n in self.offsetNames])
+            return self._fmt([self.offsets[ch][name]])
+
+        if verb == 'rt':
+            temps = dict(CCD0=163.0, CCD1=163.2, FEE=301.5, PA=290.3)
+            temps = {k:v + self.rng.normal(0, 0.05) for k, v in temps.items()}
+            if args[0] == 'all':
+                return self._fmt([temps[n] for n in ('CCD0', 'CCD1', 'FEE', 'PA')])
+            return self._fmt([temps[args[0]]])
+        if verb == 'rv':
+            vals = dict((name, (v if (enable is None or self.enables[enable]) else 0.0)
+                         + self.rng.normal(0, 0.005))
+                        for name, v, enable in self.supplies)
+            if args[0] == 'all':
+                return self._fmt([vals[name] for name, _, _ in self.supplies])
+            return self._fmt([vals[args[0]]])
+        if verb == 'cv':
+            return 'SUCCESS'
+
+        if verb == 'se':
+            name, state = args[0], args[1]
+            if state not in ('on', 'off'):
+                raise ValueError('enable state must be on or off')
+            names = list(self.enables) if name == 'all' else [name]
+            for n in names:
+                if n not in self.enables and n != 'Clks':
+                    raise ValueError('unknown enable %s' % (n))
+                self.enables[n] = (state == 'on')
+            return 'SUCCESS'
+
+        if verb == 'gr':
+            return self.revision
+        if verb == 'gs':
+            return self.serials[args[0]]
+        if verb == 'ss':
+            self.serials[args[0]] = args[1]
+            return 'SUCCESS'
+        if verb == 'sf':
+            self.speed = args[0]
+            return 'SUCCESS'
+        if verb == 'cal':
+            time.sleep(0.1)
+            return 'SUCCESS'
+
+        if verb == 'rSeq':
+            vPar, vThresh, nSteps, dwell = float(args[0]), float(args[1]), int(args[2]), int(args[3])
+            if not 1 <= nSteps <= 1000 or not 0 <= dwell <= 5000:
+                raise ValueError('rSeq steps or dwell out of range')
+            time.sleep((2*nSteps*5 + dwell) / 1000.0)
+            return 'SUCCESS'
+
+        raise ValueError('unknown command %s' % (verb))
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if isinstance(argv, str):
+        argv = argv.split()
+
+    parser = argparse.ArgumentParser(description="Serve a simulated FEE on a pty, until interrupted.")
+    parser.add_argument('--byteTime', type=float, default=10/38400,
+                        help='seconds per byte sent back. Default=%(default)s')
+    parser.add_argument('--commandTime', type=float, default=0.002,
+                        help='seconds to process each command. Default=%(default)s')
+    parser.add_argument('--settleTau', type=float, default=0.05,
+                        help='time constant of the bias readbacks. Default=%(default)s')
+    parser.add_argument('--echoErrorRate', type=float, default=0.0,
+                        help='probability of corrupting each echo')
+    parser.add_argument('--dropRate', type=float, default=0.0,
+                        help='probability of dropping each reply')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--bootloader', action='store_true',
+                        help='start at the firmware bootloader prompt.')
+    parser.add_argument('--lineTime', type=float, default=0.004,
+                        help='seconds for the bootloader to write each hex line. Default=%(default)s')
+    parser.add_argument('--nakRate', type=float, default=0.0,
+                        help='probability of the bootloader NAKing each hex line')
+    parser.add_argument('--linkLatency', type=float, default=0.0,
+                        help='seconds of latency added each way, as by USB serial adapters.')
+    parser.add_argument('--flowControl', action='store_true',
+                        help='have the bootloader send XOFF/XON around each line write.')
+    parser.add_argument('--debug', action='store_true',
+                        help='show all traffic.')
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    sim = FeeSim(byteTime=args.byteTime, commandTime=args.commandTime,
+                 settleTau=args.settleTau,
+                 echoErrorRate=args.echoErrorRate, dropRate=args.dropRate, seed=args.seed,
+                 lineTime=args.lineTime, nakRate=args.nakRate, flowControl=args.flowControl,
+                 linkLatency=args.linkLatency,
+                 logLevel=logging.DEBUG if args.debug else logging.INFO)
+    print(sim.portName, flush=True)
+    if args.bootloader:
+        sim.enterBootloader(banner=False)
+    try:
+        sim.run()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
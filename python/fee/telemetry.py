@@ -0,0 +1,234 @@
+""" Sample FEE temperatures and voltages in the background, into a fixed-size ring buffer.
+
+The sampler reads whole command sets ('rt,all', 'rv,all', 'rb,all,chN')
+every interval seconds, in the 'housekeeping' priority class of the
+FEE's CommandScheduler: it gets the serial line only when no other
+thread is waiting for it, so it never delays other commands by more
+than one transaction. The values also refresh FeeControl's status
+cache, so statusAsCards(useCache=True) does not need to read them
+again.
+
+Around pixel readouts, pause() the sampler: it returns once any
+sample in progress is done, and no more are taken until resume().
+
+Examples
+--------
+
+>>> fee.startTelemetry(interval=5.0)
+>>> ... integrate ...
+>>> fee.telemetry.summary(t0, t1)['temps.CCD0']
+>>> fee.telemetry.cards(t0, t1)
+>>> times, vals = fee.telemetry.history(names=['temps.CCD0', 'temps.CCD1'])
+"""
+
+import contextlib
+import logging
+import threading
+import time
+
+import numpy as np
+
+class TelemetrySampler(object):
+    def __init__(self, fee, interval=5.0, nsamples=4096,
+                 groups=('temps', 'voltage', 'bias'),
+                 cardGroups=('temps', 'voltage')):
+        """ A background thread polling FEE telemetry.
+
+        Args
+        ----
+        fee : FeeControl
+           The FEE to poll.
+        interval : float
+           Seconds between samples.
+        nsamples : int
+           The number of samples kept.
+        groups : list of str
+           The FEE command sets to sample.
+        cardGroups : list of str
+           The command sets summarized by cards().
+        """
+
+        self.logger = logging.getLogger('telemetry')
+        self.fee = fee
+        self.interval = interval
+        self.groups = list(groups)
+        self.cardGroups = list(cardGroups)
+
+        self.names = []
+        for group in self.groups:
+            cset = fee.commands[group]
+            subs = [s for s in cset.subs if s != 'all']
+            if cset.channels:
+                self.names.extend('%s.ch%d.%s' % (group, ch, s) for ch in cset.channels for s in subs)
+            else:
+                self.names.extend('%s.%s' % (group, s) for s in subs)
+        self.columns = {name:i for i, name in enumerate(self.names)}
+
+        self.times = np.full(nsamples, np.nan)
+        self.values = np.full((nsamples, len(self.names)), np.nan, dtype='f4')
+        self.nextRow = 0
+        self.nRows = 0
+        self.bufferLock = threading.Lock()
+
+        self.thread = None
+        self.stopEvent = threading.Event()
+        self.sampleLock = threading.Lock()
+        self.pauseLock = threading.Lock()
+        self.nPauses = 0
+        self.resumeEvent = threading.Event()
+        self.resumeEvent.set()
+
+    def __str__(self):
+        return "TelemetrySampler(interval=%g, groups=%s, samples=%d)" % (self.interval,
+                                                                         self.groups,
+                                                                         self.nRows)
+
+    def start(self):
+        if self.isRunning:
+            return
+        self.stopEvent.clear()
+        with self.pauseLock:
+            if self.nPauses == 0:
+                self.resumeEvent.set()
+            else:
+                self.resumeEvent.clear()
+        self.thread = threading.Thread(target=self._run, name='feeTelemetry', daemon=True)
+        self.thread.start()
+
+    @property
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def stop(self):
+        self.stopEvent.set()
+        # Wake a paused thread, so that it sees the stop.
+        self.resumeEvent.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    @property
+    def isPaused(self):
+        return self.nPauses > 0
+
+    def pause(self):
+        """ Stop sampling until resume(), waiting for any sample in progress. Pauses nest. """
+
+        with self.pauseLock:
+            self.nPauses += 1
+            self.resumeEvent.clear()
+        with self.sampleLock:
+            pass
+
+    def resume(self):
+        with self.pauseLock:
+            if self.nPauses == 0:
+                return
+            self.nPauses -= 1
+            if self.nPauses == 0:
+                self.resumeEvent.set()
+
+    @contextlib.contextmanager
+    def paused(self):
+        """ Take no samples in the enclosed code. """
+
+        self.pause()
+        try:
+            yield
+        finally:
+            self.resume()
+
+    def _run(self):
+        with self.fee.scheduler.priority('housekeeping'):
+            while not self.stopEvent.is_set():
+                self.resumeEvent.wait()
+                t0 = time.time()
+                # Never loop straight back while paused: always sleep below.
+                with self.sampleLock:
+                    if not (self.isPaused or self.stopEvent.is_set()):
+                        try:
+                            self.sample()
+                        except Exception as e:
+                            self.logger.warn('telemetry sample failed: %s', e)
+                self.stopEvent.wait(max(0.0, self.interval - (time.time() - t0)))
+
+    def sample(self):
+        """ Read all the groups once, and append them to the ring buffer. """
+
+        row = np.full(len(self.names), np.nan, dtype='f4')
+        t0 = time.time()
+        for group in self.groups:
+            status = self.fee.refreshStatus(group)
+            for name, val in status.items():
+                col = self.columns.get(name)
+                if col is not None:
+                    try:
+                        row[col] = float(val)
+                    except (TypeError, ValueError):
+                        pass
+
+        with self.bufferLock:
+            self.times[self.nextRow] = (t0 + time.time()) / 2
+            self.values[self.nextRow] = row
+            self.nextRow = (self.nextRow + 1) % len(self.times)
+            self.nRows = min(self.nRows + 1, len(self.times))
+
+    def history(self, t0=None, t1=None, names=None):
+        """ Return the samples between two times, oldest first.
+
+        Returns
+        -------
+        times : ndarray
+           The unix times of the samples.
+        values : dict of ndarrays
+           For each name, e.g. 'temps.CCD0', its values.
+        """
+
+        with self.bufferLock:
+            order = (np.arange(self.nRows) + self.nextRow - self.nRows) % len(self.times)
+            times = self.times[order]
+            values = self.values[order]
+
+        keep = np.ones(len(times), dtype=bool)
+        if t0 is not None:
+            keep &= times >= t0
+        if t1 is not None:
+            keep &= times <= t1
+        if names is None:
+            names = self.names
+
+        return times[keep], {name:values[keep, self.columns[name]] for name in names}
+
+    def summary(self, t0=None, t1=None, names=None):
+        """ Return ({name: (min, max, mean)}, nsamples) over the samples between two times.
+
+        If there are no samples in the interval, the latest sample before t1 is used.
+        """
+
+        times, values = self.history(t0, t1, names=names)
+        if len(times) == 0:
+            times, values = self.history(None, t1, names=names)
+            times = times[-1:]
+            values = {name:v[-1:] for name, v in values.items()}
+
+        summary = dict()
+        for name, v in values.items():
+            v = v[np.isfinite(v)]
+            if len(v):
+                summary[name] = (float(v.min()), float(v.max()), float(v.mean()))
+        return summary, len(times)
+
+    def cards(self, t0=None, t1=None):
+        """ Return (keyword, value, comment) cards with the min, max, and mean of the cardGroups values between two times. """
+
+        names = [n for n in self.names if n.split('.')[0] in self.cardGroups]
+        summary, nsamples = self.summary(t0, t1, names=names)
+        cards = [('HIERARCH tlm.nsamples', nsamples, 'number of telemetry samples')]
+        for name in names:
+            if name not in summary:
+                continue
+            vmin, vmax, vmean = summary[name]
+            cards.append(('HIERARCH tlm.%s.min' % (name), round(vmin, 3), ''))
+            cards.append(('HIERARCH tlm.%s.max' % (name), round(vmax, 3), ''))
+            cards.append(('HIERARCH tlm.%s.mean' % (name), round(vmean, 3), ''))
+        return cards
@@ -0,0 +1,221 @@
+""" Build master calibration frames: bias, dark current, and flat.
+
+Each input file is overscan-corrected (and bias- and dark-subtracted,
+and scaled) by a pool of processes, into a temporary .npy file. The
+frames are then memory-mapped and combined band by band with
+geom.combineImages(), so neither step needs the full stack in memory.
+
+The products are FITS files of the active area, laid out as from
+Exposure.overscanCorrect(). They are cached in cacheDir, under a key
+made from the input files (paths, sizes, and modification times), the
+parameters, and the products they depend on. Building the same product
+again just returns the cached file.
+
+Examples
+--------
+
+>>> bias = calib.masterBias(biasFiles)
+>>> dark = calib.masterDark(darkFiles, bias=bias)
+>>> flat = calib.masterFlat(flatFiles, bias=bias, dark=dark)
+>>> im = geom.finalImage('PFJA00012345.fits', bias=bias, dark=dark, flat=flat)
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+import astropy.io.fits as pyfits
+
+from fpga import geom
+
+logger = logging.getLogger('calib')
+
+defaultCacheDir = '/data/pfseng/calib'
+
+# Bump when the processing changes, to invalidate all cached products.
+cacheVersion = 1
+
+def _fileKey(path):
+    st = os.stat(path)
+    return '%s:%d:%d' % (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+def productKey(kind, flist, params, depends=()):
+    """ Return the cache key for a product.
+
+    Args
+    ----
+    kind : str
+        'bias', 'dark', or 'flat'
+    flist : list of paths
+        The input files. The order does not matter.
+    params : dict
+        Everything else which changes the product.
+    depends : list of paths
+        The products this one is built from.
+    """
+
+    h = hashlib.sha1()
+    h.update(('%s:%d\n' % (kind, cacheVersion)).encode())
+    for key in sorted(_fileKey(f) for f in flist):
+        h.update((key + '\n').encode())
+    for name in sorted(params):
+        h.update(('%s=%r\n' % (name, params[name])).encode())
+    for path in depends:
+        if path is not None:
+            h.update(('depends:' + _fileKey(path) + '\n').encode())
+
+    return h.hexdigest()
+
+def productPath(kind, key, cacheDir=None):
+    if cacheDir is None:
+        cacheDir = defaultCacheDir
+    return os.path.join(cacheDir, 'master%s-%s.fits' % (kind.capitalize(), key[:16]))
+
+def _prepareFrame(path, outPath, model, bias, dark, perSecond, normalize):
+    """ Correct one exposure and save it to outPath. Runs in the worker processes. """
+
+    exp = geom.Exposure(path, lazy=True)
+    im = exp.overscanCorrect(model, dtype='f4')
+    exptime = exp.expTime
+
+    if bias is not None:
+        im -= np.load(bias, mmap_mode='r')
+    if dark is not None:
+        im -= np.load(dark, mmap_mode='r') * np.float32(exptime)
+    if perSecond:
+        if exptime <= 0:
+            raise RuntimeError("%s: cannot scale an exposure with EXPTIME=%s" % (path, exptime))
+        im /= np.float32(exptime)
+
+    level = float(np.median(im))
+    if normalize:
+        if level <= 0:
+            raise RuntimeError("%s: cannot normalize an exposure with median level %g" % (path, level))
+        im /= np.float32(level)
+
+    np.save(outPath, im)
+
+    return dict(path=path, imagetyp=exp.expType, exptime=exptime, level=level)
+
+def _writeProduct(path, image, kind, key, flist, infos, params):
+    hdr = pyfits.Header()
+    hdr['IMAGETYP'] = ('master_%s' % (kind), 'master calibration product')
+    hdr['CALIBKEY'] = (key, 'hash of the inputs and parameters')
+    hdr['NCOMBINE'] = (len(flist), 'number of input exposures')
+    for name in sorted(params):
+        hdr['HIERARCH calib.%s' % (name)] = str(params[name])
+    if kind == 'dark':
+        hdr['BUNIT'] = 'ADU/s'
+    for info in infos:
+        hdr.add_history('%s %s %g %g' % (os.path.basename(info['path']), info['imagetyp'],
+                                         info['exptime'], info['level']))
+
+    tmpPath = path + '.tmp'
+    pyfits.PrimaryHDU(image.astype('f4'), header=hdr).writeto(tmpPath, overwrite=True)
+    os.replace(tmpPath, path)
+
+def buildMaster(kind, flist, cacheDir=None, model='row', combine='median',
+                bias=None, dark=None, perSecond=False, normalize=False,
+                nprocs=None, memoryBudget=512*1024*1024, nthreads=None, clobber=False):
+    """ Build, or fetch from the cache, one master calibration product.
+
+    Args
+    ----
+    kind : str
+        'bias', 'dark', or 'flat'. The input IMAGETYPs are checked against this.
+    flist : list of paths
+        The raw input exposures.
+    cacheDir : str
+        Where the products are kept. Default is defaultCacheDir.
+    model : str
+        The overscan model, as for Exposure.overscanCorrect().
+    combine : {'median', 'mean', 'clippedMean'}
+        How to combine the corrected frames.
+    bias, dark : paths
+        Master products to subtract. The dark is scaled by each EXPTIME.
+    perSecond : bool
+        Whether to divide each frame by its EXPTIME.
+    normalize : bool
+        Whether to divide each frame by its median.
+    nprocs : int
+        The number of processes correcting frames. Default is all cores.
+    memoryBudget, nthreads : int
+        For the combine step, as for geom.combineImages().
+    clobber : bool
+        Rebuild even if the product is cached.
+
+    Returns
+    -------
+    path : str
+        The product file.
+    """
+
+    if not flist:
+        raise RuntimeError("no %s files to combine" % (kind))
+    if cacheDir is None:
+        cacheDir = defaultCacheDir
+    os.makedirs(cacheDir, exist_ok=True)
+
+    params = dict(model=model, combine=combine, perSecond=perSecond, normalize=normalize)
+    key = productKey(kind, flist, params, depends=(bias, dark))
+    path = productPath(kind, key, cacheDir)
+    if os.path.exists(path) and not clobber:
+        logger.info('using cached master %s %s', kind, path)
+        return path
+
+    if nprocs is None:
+        nprocs = os.cpu_count() or 1
+    nprocs = max(1, min(nprocs, len(flist)))
+
+    with tempfile.TemporaryDirectory(dir=cacheDir, prefix='calib-') as tmpDir:
+        # The workers memory-map the products we subtract, so pass them plain .npy files.
+        calibs = dict()
+        for name, calibPath in (('bias', bias), ('dark', dark)):
+            if calibPath is not None:
+                calibs[name] = os.path.join(tmpDir, '%s.npy' % (name))
+                np.save(calibs[name], geom.loadCalibImage(calibPath).astype('f4'))
+
+        outPaths = [os.path.join(tmpDir, 'frame%04d.npy' % (i)) for i in range(len(flist))]
+        args = [(f, outPath, model, calibs.get('bias'), calibs.get('dark'), perSecond, normalize)
+                for f, outPath in zip(flist, outPaths)]
+
+        logger.info('correcting %d %s frames with %d processes', len(flist), kind, nprocs)
+        if nprocs == 1:
+            infos = [_prepareFrame(*a) for a in args]
+        else:
+            with ProcessPoolExecutor(max_workers=nprocs) as pool:
+                infos = list(pool.map(_prepareFrame, *zip(*args)))
+
+        for info in infos:
+            if info['imagetyp'] != kind:
+                logger.warning('%s: IMAGETYP is %s, not %s', info['path'], info['imagetyp'], kind)
+
+        frames = [np.load(outPath, mmap_mode='r') for outPath in outPaths]
+        image = geom.combineImages(frames, combine=combine, dtype='f4', outDtype='f4',
+                                   memoryBudget=memoryBudget, nworkers=nthreads)
+        del frames
+
+        _writeProduct(path, image, kind, key, flist, infos, params)
+
+    logger.info('wrote master %s from %d files to %s', kind, len(flist), path)
+    return path
+
+def masterBias(flist, combine='median', **kwargs):
+    """ Build the master bias, in ADU. See buildMaster() for the arguments. """
+
+    return buildMaster('bias', flist, combine=combine, **kwargs)
+
+def masterDark(flist, bias=None, combine='clippedMean', **kwargs):
+    """ Build the master dark current, in ADU/s. See buildMaster() for the arguments. """
+
+    return buildMaster('dark', flist, bias=bias, perSecond=True, combine=combine, **kwargs)
+
+def masterFlat(flist, bias=None, dark=None, combine='median', **kwargs):
+    """ Build the master flat, normalized to a median of 1. See buildMaster() for the arguments. """
+
+    return buildMaster('flat', flist, bias=bias, dark=dark, normalize=True,
+                       combine=combine, **kwargs)
@@ -10,6 +10,9 @@ import astropy.io.fits as pyfits
 from pyFPGA import FPGA
     
 from . import SeqPath
+from . import fitsWriter
+from . import headerTemplate
+from . import tileCompress
 
 class FakeCCD(object):
     def ampidx(self, ampid, im):
@@ -87,12 +90,20 @@ class CCD(FPGA):
         self.leadinRows = 48
         self.namps = 8
         self.readDirection = 0b10101010 
+
+        # The binning of the last configured readout. Used for the geometry cards.
+        self.rowBinning = 1
+        self.colBinning = 1
         # self.logger.warn('ccd is: %s', str(self))
 
         self.setAdcVersion(adcVersion)
         self.setAdcType(adcBits, doCorrectSignBit=doCorrectSignBit)
         self.holdOn = set()
         self.holdOff = set()
+        self.readMode = None
+        self.setCompression(None)
+        self.setWriter()
+        self.headerBuilder = headerTemplate.HeaderBuilder()
 
     def __str__(self):
         return "FPGA(readoutState=%d,ver=%s,newADC=%s,adc18=%s,correctSignBit=%s)" % (self.readoutState(),
@@ -251,19 +262,50 @@ class CCD(FPGA):
         
         cmd.debug(f'text="set read clock holdOn={holdOn} and holdOff={holdOff}"')
 
-    def getReadClocks(self):
-        """ Fetch the final read mode clocking routine. """
+    def setReadMode(self, readMode=None):
+        """ Set the read timing mode for subsequent reads.
+
+        Args
+        ----
+        readMode : str
+           The name of a mode registered in clocks.timing, or None for the default timing.
+        """
+
+        if readMode is not None:
+            import clocks.timing as clockTiming
+            clockTiming.getReadTiming(readMode)
+        self.readMode = readMode
+
+    def getReadClocks(self, readMode=None):
+        """ Fetch the final read mode clocking routine.
+
+        Args
+        ----
+        readMode : str
+           The name of a mode registered in clocks.timing. If None, use
+           the mode from setReadMode(), if any.
+        """
+
+        if readMode is None:
+            readMode = self.readMode
 
         if self.newAdc:
             import clocks.read as readClocks
             reload(readClocks)
         else:
+            if readMode is not None:
+                raise RuntimeError(f'read timing modes are not supported with the old ADC (readMode={readMode})')
             import clocks.oldAdcRead as readClocks
             reload(readClocks)
 
-        readClocks = partial(readClocks.readClocks, holdOn=self.holdOn, holdOff=self.holdOff)
-        self.logger.info(f'clocks (new={self.newAdc}) with holdon={self.holdOn}, holdOff={self.holdOff}')
-        
+        if readMode is None:
+            readClocks = partial(readClocks.readClocks, holdOn=self.holdOn, holdOff=self.holdOff)
+        else:
+            import clocks.timing as clockTiming
+            readClocks = partial(readClocks.readClocks, holdOn=self.holdOn, holdOff=self.holdOff,
+                                 timing=clockTiming.getReadTiming(readMode))
+        self.logger.info(f'clocks (new={self.newAdc}, mode={readMode}) with holdon={self.holdOn}, holdOff={self.holdOff}')
+
         return readClocks
     
     def ampidx(self, ampid, im=None):
@@ -300,17 +342,49 @@ class CCD(FPGA):
             cards.append(('W_HLDON', ','.join({str(s) for s in self.holdOn}), "clocks held on"))
         if self.holdOff:
             cards.append(('W_HLDOFF', ','.join({str(s) for s in self.holdOff}), "clocks held off"))
+        if self.readMode is not None:
+            cards.append(('W_RDMODE', self.readMode, "read timing mode"))
         return cards
 
+    def binnedGeometry(self, rowBinning=None, colBinning=None):
+        """ Return the readout geometry for the given binning.
+
+        Returns
+        -------
+        leadinRows, ccdRows, overRows, leadinCols, ampCols, overCols : int
+           All in binned pixels. The overscan absorbs any remainder, so
+           that ccdRows+overRows and ampCols+overCols match the number of
+           rows and per-amp columns actually read.
+        """
+
+        if rowBinning is None:
+            rowBinning = self.rowBinning
+        if colBinning is None:
+            colBinning = self.colBinning
+
+        readRows = self.nrows // rowBinning
+        readCols = self.ncols // colBinning
+
+        ccdRows = self.ccdRows // rowBinning
+        ampCols = self.ampCols // colBinning
+
+        return (self.leadinRows // rowBinning, ccdRows, readRows - ccdRows,
+                self.leadinCols // colBinning, ampCols, readCols - ampCols)
+
     def geomCards(self):
         cards = []
 
-        cards.append(('HIERARCH geom.rows.leadin', self.leadinRows, "rows in necked area"))
-        cards.append(('HIERARCH geom.rows.active', self.ccdRows-self.leadinRows, "active rows"))
-        cards.append(('HIERARCH geom.rows.overscan', self.overRows, "overscan rows"))
-        cards.append(('HIERARCH geom.cols.leadin', self.leadinCols, "unilluminated cols"))
-        cards.append(('HIERARCH geom.cols.active', self.ampCols-self.leadinCols, "active columns"))
-        cards.append(('HIERARCH geom.cols.overscan', self.overCols, "overscan columnss"))
+        (leadinRows, ccdRows, overRows,
+         leadinCols, ampCols, overCols) = self.binnedGeometry()
+
+        cards.append(('HIERARCH geom.rows.leadin', leadinRows, "rows in necked area"))
+        cards.append(('HIERARCH geom.rows.active', ccdRows-leadinRows, "active rows"))
+        cards.append(('HIERARCH geom.rows.overscan', overRows, "overscan rows"))
+        cards.append(('HIERARCH geom.rows.binning', self.rowBinning, "rows binned per read row"))
+        cards.append(('HIERARCH geom.cols.leadin', leadinCols, "unilluminated cols"))
+        cards.append(('HIERARCH geom.cols.active', ampCols-leadinCols, "active columns"))
+        cards.append(('HIERARCH geom.cols.overscan', overCols, "overscan columnss"))
+        cards.append(('HIERARCH geom.cols.binning', self.colBinning, "columns binned per read column"))
         cards.append(('HIERARCH geom.namps', self.namps, "number of amps in image"))
         cards.append(('HIERARCH geom.readDirection', self.readDirection,
                       "0th bit: right amp; 0: read right, 1: read left"))
@@ -334,25 +408,82 @@ class CCD(FPGA):
                 self.logger.warning("failed to add card to header: %s", e)
                 self.logger.warning("failed card: %r", card)
             
+    def setCompression(self, compression=None, tileRows=16, nthreads=None):
+        """ Set how image files are written.
+
+        Args
+        ----
+        compression : {None, 'RICE_1', 'HCOMPRESS_1'}
+           None writes plain images. Otherwise, the lossless tile
+           compression to use. See fpga.tileCompress.
+        tileRows : int
+           The number of rows per compressed tile.
+        nthreads : int
+           The number of threads compressing RICE_1 tiles.
+        """
+
+        if compression is not None and compression not in tileCompress.compressionTypes:
+            raise RuntimeError("unknown compression %s. Known: %s" % (compression,
+                                                                    tileCompress.compressionTypes))
+        self.compression = compression
+        self.compressionArgs = dict(tileRows=tileRows, nthreads=nthreads)
+
+    def setWriter(self, queueDepth=2, fsync=False):
+        """ Set up the background writer used by readImage(asyncWrite=True).
+
+        Args
+        ----
+        queueDepth : int
+           The most images waiting to be written. Readouts block when there are more.
+        fsync : bool
+           Whether to fsync each file, synchronous or not, before it counts as written.
+        """
+
+        if getattr(self, 'writer', None) is not None:
+            self.writer.close()
+        self.writer = fitsWriter.FitsWriter(queueDepth=queueDepth, fsync=fsync)
+
     def writeImageFile(self, im, 
-                       comment=None, addCards=None):
+                       comment=None, addCards=None, compression=False,
+                       asyncWrite=False):
+        """ Write an image to the next file.
+
+        Args
+        ----
+        compression : {False, None, 'RICE_1', 'HCOMPRESS_1'}
+           False uses the setCompression() setting; None writes a plain image.
+        asyncWrite : bool
+           If set, queue the image to self.writer and return a
+           fitsWriter.WriteFuture instead of the filename. The image
+           must not be modified until the write is done.
+        """
+
+        if compression is False:
+            compression = self.compression
 
         fnames = self.fileMgr.getNextFileset()
         fname = fnames[0]
         
         self.logger.warning('creating fits file: %s', fname)
 
-        hdr = pyfits.Header()
-        self.addHeaderCards(hdr, self.idCards())
-        self.addHeaderCards(hdr, self.geomCards())
-            
-        if comment is not None:
-            hdr['comment'] = comment
+        # The cards are nearly the same for every exposure: only format the changed values.
+        cards = self.idCards() + self.geomCards()
         if addCards is not None:
-            self.addHeaderCards(hdr, addCards)
-                    
+            cards.extend(addCards)
+        if comment is not None:
+            cards.append(('COMMENT', comment))
+        hdr = self.headerBuilder.buildString(cards)
+
+        if asyncWrite:
+            return self.writer.submit(fname, im, hdr, compression=compression,
+                                      compressionArgs=self.compressionArgs)
+
+        # Keep the files in order with any queued ones.
+        self.writer.wait()
         try:
-            pyfits.writeto(fname, im, hdr, checksum=True)
+            fitsWriter.writeFits(fname, im, hdr, compression=compression,
+                                 compressionArgs=self.compressionArgs,
+                                 fsync=self.writer.fsync)
         except Exception as e:
             self.logger.warn('failed to write fits file %s: %s', fname, e)
             self.logger.warn('hdr : %s', hdr)
@@ -363,14 +494,15 @@ class CCD(FPGA):
         return np.zeros(shape=(self.nrows, self.namps*self.ncols), dtype='u2')
 
     def readImage(self, nrows=None, ncols=None,
-                  rowBinning=1,
+                  rowBinning=1, colBinning=1,
                   doTest=False, debugLevel=1, 
                   doAmpMap=True, 
                   doReread=False,
                   rowFunc=None, rowFuncArgs=None,
-                  clockFunc=None,
+                  clockFunc=None, preset=None,
                   doReset=True, doSave=True, 
-                  comment=None, addCards=None):
+                  comment=None, addCards=None,
+                  asyncWrite=False):
                   
         """ Configure and readout the detector; write image to disk. 
 
@@ -380,8 +512,19 @@ class CCD(FPGA):
            If set False, does not PCI-reset the FPGA before starting.
         doSave : bool , optional
            If set False, does not save the image to disk FITS file.
+        asyncWrite : bool, optional
+           If set, return as soon as the image is read, with a
+           fitsWriter.WriteFuture in place of the filename. The file is
+           written by self.writer; see writeImageFile().
         doReread : bool, optional
            If set, do not start a new exposure, but reread the one on the FPGA.
+        rowBinning, colBinning : int, optional
+           The number of rows and per-amp columns to sum. nrows and ncols
+           are unbinned, and should be multiples of the binning.
+        preset : str or clocks.presets.ReadoutPreset, optional
+           A named readout preset. Supplies the clocking, the compiled
+           program, and the model for the readout time. Cannot be
+           combined with clockFunc.
 
         Notes
         -----
@@ -391,36 +534,67 @@ class CCD(FPGA):
 
         self.logger.warn('ccd is: %s', str(self))
 
-        if clockFunc is None:
-            clockFunc = self.getReadClocks()
-        
+        if preset is not None:
+            if clockFunc is not None:
+                raise RuntimeError("cannot specify both a clockFunc and a preset")
+            import clocks.presets as readPresets
+            preset = readPresets.getPreset(preset)
+            if preset.newAdc is not None and preset.newAdc != self.newAdc:
+                raise RuntimeError(f'readout preset {preset.name} does not match the ADC (newAdc={self.newAdc})')
+            preset.checkColBinning(colBinning)
+            timeModel = preset.timeModel
+        else:
+            import clocks.presets as readPresets
+            timeModel = readPresets.defaultTimeModel
+            if clockFunc is None:
+                clockFunc = self.getReadClocks()
+
         if nrows is None:
             nrows = self.nrows
         if ncols is None:
             ncols = self.ncols
 
-        readRows = nrows/rowBinning
+        readRows = nrows//rowBinning
         if readRows * rowBinning != nrows:
             self.logger.warn("warning: rowBinning (%d) does not divide nrows (%d) integrally." % (rowBinning,
                                                                                                   nrows))
+        readCols = ncols//colBinning
+        if readCols * colBinning != ncols:
+            self.logger.warn("warning: colBinning (%d) does not divide ncols (%d) integrally." % (colBinning,
+                                                                                                  ncols))
+        self.rowBinning = rowBinning
+        self.colBinning = colBinning
+
         if doReset:
             self.pciReset()
 
+        rowTime = None
         if not doReread:
-            expectedTime = self.configureReadout(nrows=readRows, ncols=ncols,
-                                                 rowBinning=rowBinning,
-                                                 doTest=doTest, clockFunc=clockFunc)
+            if preset is not None:
+                program = preset.program(readCols, rowBinning=rowBinning, colBinning=colBinning,
+                                         holdOn=self.holdOn, holdOff=self.holdOff)
+            else:
+                program = None
+            frameTime = self.configureReadout(nrows=readRows, ncols=readCols,
+                                              rowBinning=rowBinning,
+                                              colBinning=colBinning,
+                                              doTest=doTest, clockFunc=clockFunc,
+                                              program=program)
+            rowTime = frameTime / readRows
 
         t0 = time.time()
-        im = self._readImage(nrows=readRows, ncols=ncols, 
+        im = self._readImage(nrows=readRows, ncols=readCols, 
                              doTest=doTest, debugLevel=debugLevel,
                              doAmpMap=doAmpMap,
                              rowFunc=rowFunc, rowFuncArgs=rowFuncArgs)
         t1 = time.time()
         elapsedTime = t1-t0
         
-        if abs(elapsedTime-expectedTime) > 0.1*expectedTime:
-            self.logger.warn("readTime = %g; expected %g" % (elapsedTime, expectedTime))
+        if rowTime is not None:
+            ok, expectedTime = timeModel.check(elapsedTime, rowTime, readRows)
+            if not ok:
+                self.logger.warn("readTime = %g; expected %g (%s)" % (elapsedTime, expectedTime,
+                                                                     preset.name if preset else 'default'))
 
         # INSTRM-40: Paper over an FPGA bug which we have not found, where there is
         # a spurious 0th pixel, which effectively wraps the rest of the pixels.
@@ -438,7 +612,8 @@ class CCD(FPGA):
         im = im.reshape(imShape)
 
         if doSave:
-            imfile = self.writeImageFile(im, comment=comment, addCards=addCards)
+            imfile = self.writeImageFile(im, comment=comment, addCards=addCards,
+                                         asyncWrite=asyncWrite)
         else:
             imfile = None
 
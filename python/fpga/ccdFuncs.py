@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from importlib import reload
+import contextlib
 import glob
 import logging
 import os
@@ -11,6 +12,7 @@ import numpy as np
 
 import fitsio
 
+from clocks import presets as readPresets
 from fpga import ccd as ccdMod
 from fee import feeControl as feeMod
 from fpga import opticslab
@@ -35,6 +37,7 @@ class FeeTweaks(object):
 
         self.fee = fee
         self.modes = dict()
+        self.verify = False
 
     def getMode(self):
         return self.fee.getMode()
@@ -45,11 +48,30 @@ class FeeTweaks(object):
     def doSet(self, mode, name, val, chan):
         return self.fee.doSet(mode, name, val, chan)
 
+    def doSetMany(self, sets, raiseOnError=True):
+        return self.fee.doSetMany(sets, raiseOnError=raiseOnError)
+
+    def setDacs(self, sets, **kwargs):
+        return self.fee.setDacs(sets, **kwargs)
+
+    def knownDac(self, setName, subName, channel):
+        return self.fee.knownDac(setName, subName, channel)
+
     def raw(self, cmdStr):
         return self.fee.raw(cmdStr)
 
-    def statusAsCards(self):
-        return self.fee.statusAsCards()
+    def statusAsCards(self, useCache=False, asTuples=False):
+        return self.fee.statusAsCards(useCache=useCache, asTuples=asTuples)
+
+    def prefetchStatus(self, margin=10.0):
+        return self.fee.prefetchStatus(margin=margin)
+
+    def waitForSettle(self, **kwargs):
+        return self.fee.waitForSettle(**kwargs)
+
+    @property
+    def telemetry(self):
+        return self.fee.telemetry
 
     def setMode(self, mode):
         print("setting mode: ", mode)
@@ -65,6 +87,11 @@ class FeeTweaks(object):
         time.sleep(0.25)
 
     def setVoltage(self, mode, vname, val, ccds=None):
+        """ Set a runtime voltage, only sending it to the channels where the FEE does not already have it.
+
+        The old values come from the FEE's shadow DACs when they are known.
+        With self.verify, the set values are read back and checked.
+        """
 
         if mode is not None:
             raise RuntimeError("tweaked modes can only set runtime voltages")
@@ -73,10 +100,18 @@ class FeeTweaks(object):
         if ccds is None:
             ccds = (0,1)
 
-        oldVals = [fee.doGet('bias', vname, ch) for ch in (0,1)]
-        [fee.doSet('bias', vname, val, ch) for ch in ccds]
+        oldVals = [fee.knownDac('bias', vname, ch) for ch in (0,1)]
+        oldVals = [v if v is not None else fee.doGet('bias', vname, ch)
+                   for ch, v in enumerate(oldVals)]
+        sent, _ = fee.setDacs([('bias', vname, val, ch) for ch in ccds], verify=self.verify)
+        if not sent:
+            print("%s %0.1f,%0.1f unchanged" % (vname, oldVals[0], oldVals[1]))
+            return
+
         time.sleep(0.25)
-        newVals = [fee.doGet('bias', vname, ch) for ch in (0,1)]
+        newVals = [fee.knownDac('bias', vname, ch) for ch in (0,1)]
+        newVals = [v if v is not None else fee.doGet('bias', vname, ch)
+                   for ch, v in enumerate(newVals)]
         print("%s %0.1f,%0.1f -> %0.1f,%0.1f (%0.1f)" %
               (vname, oldVals[0], oldVals[1], newVals[0], newVals[1], val))
 
@@ -177,14 +212,28 @@ def fnote(fname, ftype='', notes=''):
 
     note("%s %s %s %s" % (fname, ftype, hdrNotes, notes))
 
-def fetchCards(exptype=None, feeControl=None, expTime=0.0, darkTime=None, getCards=True):
-    """ Generate all FEE exposure cards, included times and IMAGETYP. """
+def fetchCards(exptype=None, feeControl=None, expTime=0.0, darkTime=None, getCards=True,
+               useCache=True):
+    """ Generate all FEE exposure cards, included times and IMAGETYP.
+
+    With useCache, FEE values younger than their TTLs (see
+    FeeControl.statusTTLs) are not read again. Call
+    feeControl.prefetchStatus() before integrating to refresh the rest
+    in the background.
+
+    If feeControl.startTelemetry() has been called, the cards also
+    summarize the temperatures and voltages over the exposure.
+    """
 
     if feeControl is None:
         feeControl = feeMod.fee
 
     if getCards:
-        feeCards = feeControl.statusAsCards()
+        feeCards = feeControl.statusAsCards(useCache=useCache, asTuples=True)
+        telemetry = getattr(feeControl, 'telemetry', None)
+        if telemetry is not None and telemetry.isRunning:
+            now = time.time()
+            feeCards.extend(telemetry.cards(now - max(expTime, darkTime or 0.0), now))
     else:
         feeCards = []
     if exptype is not None:
@@ -194,6 +243,43 @@ def fetchCards(exptype=None, feeControl=None, expTime=0.0, darkTime=None, getCar
         feeCards.insert(0, ('DATE-OBS', ts(), 'Crude Lab Time'))
     return feeCards
 
+# If set, wait for the FEE bias readbacks to reach their set values
+# after changes, instead of sleeping fixed times. See settle().
+doSettle = False
+settleTolerance = 0.2
+settleMaxTime = 2.0
+def settle(feeControl, fixedTime, names=None):
+    """ Wait for the FEE voltages after a change.
+
+    If doSettle is False, just sleep fixedTime. Otherwise poll the bias
+    readbacks until they are within settleTolerance of their set values,
+    for at most settleMaxTime seconds.
+
+    Args
+    ----
+    feeControl : `FeeControl`
+        The FEE object we can command
+    fixedTime : float
+        The time to sleep when not settling.
+    names : list of str
+        The bias rails to check. Default is those changed by the last setMode.
+
+    Returns
+    -------
+    elapsed : float
+        How long we waited.
+    """
+
+    if not doSettle:
+        time.sleep(fixedTime)
+        return fixedTime
+
+    settled, elapsed = feeControl.waitForSettle(names=names,
+                                                tolerance=settleTolerance,
+                                                maxTime=settleMaxTime)
+    logger.info('settled=%s in %0.3fs, instead of sleeping %0.2fs', settled, elapsed, fixedTime)
+    return elapsed
+
 def setBias(fee, biasName, biasValue):
     oldVals = [fee.doGet('bias', biasName, ch) for ch in (0,1)]
     [fee.doSet('bias', biasName, biasValue, ch) for ch in (0,1)]
@@ -225,7 +311,7 @@ def purge(feeControl):
 
     setBias(feeControl, 'P_off', oldOff)
     setBias(feeControl, 'P_on', oldOn)
-    time.sleep(0.25)
+    settle(feeControl, 0.25, names=['P_off', 'P_on'])
 
 doPurgedWipe = True
 purgedWipeVoltage = 7.5
@@ -248,17 +334,19 @@ def purgedWipeExternal(feeControl, blockPurgedWipe=False):
     if doPurgedWipe and not blockPurgedWipe:
         # This *replaces* the erase mode, which simply drops VBB for ~1s. We do that but also
         # raise P_{on,off} at the same time.
+        # Each step is one pipelined batch, so both channels move together.
         t0 = time.time()
-        [feeControl.doSet('bias', 'P_off', purgedWipeVoltage, ch) for ch in (0,1)]
-        [feeControl.doSet('bias', 'P_on', purgedWipeVoltage, ch) for ch in (0,1)]
+        feeControl.doSetMany([('bias', name, purgedWipeVoltage, ch)
+                              for name in ('P_off', 'P_on') for ch in (0,1)])
         for v in np.linspace(30, 0, purgedWipeNsteps):
-            [feeControl.doSet('bias', 'BB', v, ch) for ch in (0,1)]
+            feeControl.doSetMany([('bias', 'BB', v, ch) for ch in (0,1)])
         time.sleep(0.5)
         for v in np.linspace(0, 30, purgedWipeNsteps):
-            [feeControl.doSet('bias', 'BB', v, ch) for ch in (0,1)]
+            sets = [('bias', 'BB', v, ch) for ch in (0,1)]
             if v >= purgedWipeResetThreshold:
-                [feeControl.doSet('bias', 'P_off', 6.0, ch) for ch in (0,1)]
-                [feeControl.doSet('bias', 'P_on', 6.0, ch) for ch in (0,1)]
+                sets.extend([('bias', name, 6.0, ch)
+                             for name in ('P_off', 'P_on') for ch in (0,1)])
+            feeControl.doSetMany(sets)
 
         t1 = time.time()
         print(f'purgedWipe total={t1-t0:0.2f}')
@@ -310,7 +398,8 @@ def purgedWipe(feeControl, blockPurgedWipe=False):
         print(f'purgedWipe total={t1-t0:0.2f}')
 
 def wipe(ccd=None, nwipes=1, ncols=None, nrows=None,
-         rowBinning=1,
+         rowBinning=None,
+         preset='wipe',
          feeControl=None,
          blockPurgedWipe=False,
          toExposeMode=True):
@@ -330,6 +419,8 @@ def wipe(ccd=None, nwipes=1, ncols=None, nrows=None,
     Adding LBNL-style purge step, where P- is set to low (+V) rail just before wiping.
     Adding LBNL-style erase step, where P are inverted w.r.t. VBB.
 
+    The wipe clocking comes from the named readout preset: 'wipe' or
+    'wipe-fast'. rowBinning defaults to the preset's.
     """
 
     if ccd is None:
@@ -338,6 +429,9 @@ def wipe(ccd=None, nwipes=1, ncols=None, nrows=None,
     if feeControl is None:
         feeControl = feeMod.fee
 
+    preset = readPresets.getPreset(preset)
+    if rowBinning is None:
+        rowBinning = preset.rowBinning
     if ncols is None:
         ncols = ccd.ampCols
     if nrows is None:
@@ -356,8 +450,8 @@ def wipe(ccd=None, nwipes=1, ncols=None, nrows=None,
         #
         purge(feeControl)
 
-        feeControl.setMode('wipe')
-        time.sleep(0.5)
+        feeControl.setMode(preset.feeMode)
+        settle(feeControl, 0.5)
 
         logger.info("resetting....")
         ccd.pciReset()
@@ -365,8 +459,7 @@ def wipe(ccd=None, nwipes=1, ncols=None, nrows=None,
         for i in range(nwipes):
             logger.info("wiping....")
             readTime = ccd.configureReadout(nrows=nrows, ncols=ncols,
-                                            clockFunc=getWipeClocks(),
-                                            rowBinning=rowBinning)
+                                            program=preset.program(ncols, rowBinning=rowBinning))
             time.sleep(readTime+0.1)
             logger.info("wiped %d %d %g s" % (nrows, ncols, readTime))
 
@@ -396,58 +489,84 @@ def clock(ncols, nrows=None, ccd=None, feeControl=None, cmd=None):
 def readout(imtype, ccd=None,
             expTime=0, darkTime=None,
             nrows=None, ncols=None,
+            rowBinning=1, colBinning=1,
             doSave=True, comment='',
             extraCards=(),
             doFeeCards=True,
-            clockFunc=None,
+            clockFunc=None, preset=None,
             feeControl=None, cmd=None,
             rowStatsFunc=None,
-            doModes=True):
+            doModes=True,
+            asyncWrite=False):
 
-    """ Wrap a complete detector readout: no wipe, but with a log note, FITS cards and left in idle mode.  """
+    """ Wrap a complete detector readout: no wipe, but with a log note, FITS cards and left in idle mode.
+
+    If preset is set, it names a readout preset (see clocks.presets),
+    which supplies the clocking and the FEE read mode.
+
+    If asyncWrite is set, the file is written in the background and
+    the returned imfile is a fitsWriter.WriteFuture (see
+    ccd.readImage). No log note is made: the caller makes it with
+    fnote(imfile.result(), comment) once the file is written.
+    """
 
     if ccd is None:
         ccd = ccdMod.ccd
 
-    argDict = dict(everyNRows=(nrows//5 if nrows else 500), ccd=ccd, cols=slice(50,-40))
+    argDict = dict(everyNRows=(nrows//(5*rowBinning) if nrows else 500//rowBinning),
+                   ccd=ccd, cols=slice(50//colBinning,-40//colBinning))
 
     if feeControl is None:
         feeControl = feeMod.fee
 
-    t0 = time.time()
-    if doModes:
-        feeControl.setMode('read')
-        time.sleep(0.5)               # 1s per JEG
-    t1 = time.time()
-
-    feeCards = fetchCards(imtype, feeControl=feeControl, expTime=expTime,
-                          darkTime=darkTime,
-                          getCards=doFeeCards)
+    if preset is not None:
+        preset = readPresets.getPreset(preset)
+        feeMode = preset.feeMode
+    else:
+        feeMode = 'read'
 
-    feeCards.extend(extraCards)
-    im, imfile = ccd.readImage(nrows=nrows, ncols=ncols,
-                               rowFunc=rowStatsFunc, rowFuncArgs=argDict,
-                               clockFunc=clockFunc,
-                               doSave=doSave,
-                               comment=comment, addCards=feeCards)
-    t2 = time.time()
-    if doModes:
-        feeControl.setMode('idle')
-        time.sleep(0.5)
-    t3 = time.time()
+    # Keep the telemetry sampler off the FEE line from the mode change to the return to idle.
+    telemetry = getattr(feeControl, 'telemetry', None)
+    with telemetry.paused() if telemetry is not None else contextlib.nullcontext():
+        t0 = time.time()
+        if doModes:
+            feeControl.setMode(feeMode)
+            settle(feeControl, 0.5)               # 1s per JEG
+        t1 = time.time()
 
-    print("file : %s" % (imfile))
+        feeCards = fetchCards(imtype, feeControl=feeControl, expTime=expTime,
+                              darkTime=darkTime,
+                              getCards=doFeeCards)
+
+        feeCards.extend(extraCards)
+        im, imfile = ccd.readImage(nrows=nrows, ncols=ncols,
+                                   rowBinning=rowBinning, colBinning=colBinning,
+                                   rowFunc=rowStatsFunc, rowFuncArgs=argDict,
+                                   clockFunc=clockFunc, preset=preset,
+                                   doSave=doSave,
+                                   comment=comment, addCards=feeCards,
+                                   asyncWrite=asyncWrite)
+        t2 = time.time()
+        if doModes:
+            feeControl.setMode('idle')
+            settle(feeControl, 0.5)
+        t3 = time.time()
+
+    if asyncWrite and imfile is not None:
+        print("file : %s (queued)" % (imfile.path))
+    else:
+        print("file : %s" % (imfile))
+        fnote(imfile, comment)
     print("times: %0.2f, %0.2f, %0.2f"
           % (t1-t0,t2-t1,t3-t2))
 
-    fnote(imfile, comment)
-
     return im, imfile
 
 
 def fullExposure(imtype, ccd=None, expTime=0.0,
                  nrows=None, ncols=None,
-                 clockFunc=None, doWipe=True,
+                 rowBinning=1, colBinning=1,
+                 clockFunc=None, preset=None, doWipe=True,
                  doSave=True, comment='',
                  extraCards=(), doFeeCards=True,
                  feeControl=None, cmd=None):
@@ -460,7 +579,7 @@ def fullExposure(imtype, ccd=None, expTime=0.0,
     if ccd is None:
         ccd = ccdMod.ccd
 
-    if clockFunc is None:
+    if clockFunc is None and preset is None:
         clockFunc = getReadClocks()
 
     if feeControl is None:
@@ -476,6 +595,7 @@ def fullExposure(imtype, ccd=None, expTime=0.0,
     t1 = time.time()
     if cmd is not None:
         cmd.inform('exposureState="integrating",%0.2f' % (expTime))
+    feeControl.prefetchStatus()
     time.sleep(expTime)
     t2 = time.time()
 
@@ -483,7 +603,8 @@ def fullExposure(imtype, ccd=None, expTime=0.0,
         cmd.inform('exposureState="reading",%0.2f' % (45.0))
     im, imfile = readout(imtype, ccd=ccd, expTime=expTime,
                          nrows=nrows, ncols=ncols,
-                         clockFunc=clockFunc, doSave=doSave,
+                         rowBinning=rowBinning, colBinning=colBinning,
+                         clockFunc=clockFunc, preset=preset, doSave=doSave,
                          doFeeCards=doFeeCards,
                          comment=comment, extraCards=extraCards,
                          rowStatsFunc=False, cmd=cmd,
@@ -520,7 +641,7 @@ def fastRevRead(ccd=None, rowBinning=10,
     try:
         feeControl.setFast()
         feeControl.setMode('revRead')
-        time.sleep(1)               # Per JEG
+        settle(feeControl, 1)               # Per JEG
 
         feeCards = fetchCards('revread', expTime=0)
         im, imfile = ccd.readImage(nrows=nrows, ncols=ncols, rowBinning=rowBinning,
@@ -531,7 +652,7 @@ def fastRevRead(ccd=None, rowBinning=10,
     finally:
         feeControl.setSlow()
         feeControl.setMode('idle')
-        time.sleep(1)               # Per JEG
+        settle(feeControl, 1)               # Per JEG
 
 
     return im, imfile
@@ -566,7 +687,8 @@ def expList(explist, ccd=None,
             feeControl=None,
             clockFunc=None,
             comment='',
-            title='Running exposure list'):
+            title='Running exposure list',
+            asyncWrite=False):
 
     """ Currently the main entry-point for taking multiple exposures.
 
@@ -577,13 +699,22 @@ def expList(explist, ccd=None,
       (wipe NWIPES)
       (flash DARKTIME FLATTIME)
 
+    With asyncWrite, each file is written by the ccd's background writer
+    while the next exposure is wiped and taken. The log note for each
+    file is made once it has been written. All the files are written
+    before returning, even if an exposure fails, and a RuntimeError is
+    raised if any write failed.
     """
 
+    if ccd is None:
+        ccd = ccdMod.ccd
     if feeControl is None:
         feeControl = feeMod.fee
     note('... %s (%s exposures)' % (title, len(explist)))
 
     files = []
+    unnoted = []
+    writeError = None
 
     try:
         for e_i, exp in enumerate(explist):
@@ -600,15 +731,16 @@ def expList(explist, ccd=None,
             wipe(ccd=ccd, feeControl=feeControl)
 
             if exptype == 'bias':
-                im, imfile = readout('bias', ccd=ccd,
+                im, imfile = readout('bias', ccd=ccd, asyncWrite=asyncWrite,
                                      nrows=nrows, ncols=ncols,
                                      clockFunc=clockFunc,
                                      feeControl=feeControl,
                                      comment=expComment)
             elif exptype == 'dark':
                 darkTime = expargs[0]
+                feeControl.prefetchStatus()
                 time.sleep(darkTime)
-                im, imfile = readout('dark', ccd=ccd,
+                im, imfile = readout('dark', ccd=ccd, asyncWrite=asyncWrite,
                                      expTime=darkTime,
                                      nrows=nrows, ncols=ncols,
                                      clockFunc=clockFunc,
@@ -616,6 +748,7 @@ def expList(explist, ccd=None,
                                      comment=expComment)
             elif exptype == 'flat':
                 flatTime = expargs[0]
+                feeControl.prefetchStatus()
                 ret = opticslab.pulseShutter(flatTime)
                 print(ret)
 
@@ -627,7 +760,7 @@ def expList(explist, ccd=None,
                 cards.append(('HIERARCH QE.flux', flux, 'calibrated flux, W'),)
                 cards.append(('HIERARCH QE.current', current, 'Keithley current, A'),)
 
-                im, imfile = readout('flat', ccd=ccd,
+                im, imfile = readout('flat', ccd=ccd, asyncWrite=asyncWrite,
                                      expTime=flatTime,
                                      nrows=nrows, ncols=ncols,
                                      clockFunc=clockFunc,
@@ -637,6 +770,7 @@ def expList(explist, ccd=None,
             elif exptype == 'flash':
                 darkTime = expargs[0]
                 flatTime = expargs[1]
+                feeControl.prefetchStatus()
                 time.sleep(darkTime)
 
                 ret = opticslab.pulseShutter(flatTime)
@@ -650,7 +784,7 @@ def expList(explist, ccd=None,
                 cards.append(('HIERARCH QE.flux', flux, 'calibrated flux, W'),)
                 cards.append(('HIERARCH QE.current', current, 'Keithley current, A'),)
 
-                im, imfile = readout('flash', ccd=ccd,
+                im, imfile = readout('flash', ccd=ccd, asyncWrite=asyncWrite,
                                      expTime=flatTime,
                                      nrows=nrows, ncols=ncols,
                                      clockFunc=clockFunc,
@@ -662,13 +796,52 @@ def expList(explist, ccd=None,
 
             files.append(imfile)
 
-            print(imfile)
+            if asyncWrite:
+                print(imfile.path)
+                unnoted.append((imfile, expComment))
+                _noteWrites(unnoted, wait=False)
+            else:
+                print(imfile)
     finally:
-        feeControl.setMode('idle')
+        try:
+            feeControl.setMode('idle')
+        finally:
+            if asyncWrite:
+                try:
+                    ccd.writer.flush()
+                except RuntimeError as e:
+                    logger.error('exposure list: %s', e)
+                    writeError = e
+                _noteWrites(unnoted)
+                logger.info('exposure list writes: %s', ccd.writer.metrics())
+
+    if writeError is not None:
+        raise writeError
+    if asyncWrite:
+        files = [f.path for f in files]
 
     note('Done with exposure list.')
     return files
 
+def _noteWrites(unnoted, wait=True):
+    """ Make the log notes for background writes, in order, and drop them from the list.
+
+    Args
+    ----
+    unnoted : list of (WriteFuture, comment)
+       The written or queued files, oldest first.
+    wait : bool
+       Whether to wait for the writes. If not, stop at the first unfinished one.
+    """
+
+    while unnoted:
+        imfile, comment = unnoted[0]
+        if not wait and not imfile.done():
+            return
+        del unnoted[0]
+        if imfile.exception() is None:
+            fnote(imfile.path, comment)
+
 def rowStats(line, image, errorMsg="OK", everyNRows=100,
              ampList=list(range(8)), cols=None,
              lineDetail=False, **kwargs):
@@ -0,0 +1,325 @@
+""" Write FITS files from a background thread, so that readouts do not wait for the disk.
+
+A single thread takes write requests from a bounded queue, so files are
+written in the order they were submitted. When the queue is full,
+submit() blocks: a disk which cannot keep up slows the readouts down
+rather than letting images pile up in memory.
+
+Each request gets a future whose result is the filename, or which
+raises the write's exception. Failures are also remembered, and
+flush() raises a RuntimeError for any since the last flush(), so they
+cannot be lost by a caller which drops the futures.
+
+Examples
+--------
+
+>>> writer = fitsWriter.FitsWriter(queueDepth=2, fsync=True)
+>>> future = writer.submit('PFJA00012345b1.fits', im, hdr)
+>>> ... start the next exposure ...
+>>> writer.flush()
+>>> writer.metrics()
+"""
+
+from concurrent.futures import Future
+import logging
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+import astropy.io.fits as pyfits
+
+from . import headerTemplate
+from . import tileCompress
+
+logger = logging.getLogger('fitsWriter')
+
+class WriteFuture(Future):
+    """ A Future for one file write, which knows the filename before the write is done. """
+
+    def __init__(self, path):
+        Future.__init__(self)
+        self.path = path
+
+def _checksum32(data, sum32=0):
+    """ Return the FITS ones' complement sum of some bytes, whose length is a multiple of 4. """
+
+    s = sum32 + int(np.frombuffer(data, dtype='>u4').sum(dtype='u8'))
+    while s >> 32:
+        s = (s & 0xffffffff) + (s >> 32)
+    return s
+
+def _encodeChecksum(value):
+    """ Return the 16-character ASCII encoding of a checksum, as for the CHECKSUM card. """
+
+    exclude = set(b':;<=>?@[\\]^_`')
+    asc = [0] * 16
+    for i in range(4):
+        byte = (value >> ((3 - i) * 8)) & 0xff
+        quotient = byte // 4 + ord('0')
+        ch = [quotient + byte % 4, quotient, quotient, quotient]
+        check = True
+        while check:
+            check = False
+            for j in (0, 2):
+                while ch[j] in exclude or ch[j+1] in exclude:
+                    ch[j] += 1
+                    ch[j+1] -= 1
+                    check = True
+        for j in range(4):
+            asc[4*j + i] = ch[j]
+    return bytes(asc[(i + 15) % 16] for i in range(16)).decode('latin-1')
+
+def _card(keyword, value, comment=''):
+    image = "%-8s= %s" % (keyword, headerTemplate.formatValue(value))
+    if comment:
+        image += ' / %s' % (comment)
+    return "%-80s" % (image)
+
+def writeUnsignedImage(f, im, cardText):
+    """ Write a uint16 image as a primary HDU, with a header made directly from card images.
+
+    This is what astropy writes for the image, with the same BZERO
+    and CHECKSUM/DATASUM cards, but without parsing the cards.
+
+    Args
+    ----
+    f : file
+        Open for binary writing.
+    im : ndarray of uint16
+        The image.
+    cardText : str
+        The header cards, a multiple of 80 characters. See
+        headerTemplate.HeaderBuilder.buildString().
+    """
+
+    if im.dtype != np.uint16 or im.ndim != 2:
+        raise RuntimeError("can only write 2-d uint16 images directly, not %s %s" % (im.ndim, im.dtype))
+    if len(cardText) % 80 != 0:
+        raise RuntimeError("header cards must be a multiple of 80 characters")
+
+    data = (im ^ np.uint16(0x8000)).astype('>u2').tobytes()
+    data += b'\0' * (-len(data) % 2880)
+    datasum = _checksum32(data)
+
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+    cards = [_card('SIMPLE', True, 'conforms to FITS standard'),
+             _card('BITPIX', 16, 'array data type'),
+             _card('NAXIS', 2, 'number of array dimensions'),
+             _card('NAXIS1', im.shape[1]),
+             _card('NAXIS2', im.shape[0]),
+             cardText,
+             _card('BSCALE', 1),
+             _card('BZERO', 32768),
+             None,
+             _card('DATASUM', str(datasum), 'data unit checksum updated %s' % (timestamp)),
+             "%-80s" % ('END')]
+    checksumComment = 'HDU checksum updated %s' % (timestamp)
+    cards[-3] = _card('CHECKSUM', '0' * 16, checksumComment)
+    header = ''.join(cards)
+    header += ' ' * (-len(header) % 2880)
+    header = header.encode('latin-1')
+
+    checksum = _encodeChecksum(~_checksum32(header, datasum) & 0xffffffff)
+    cards[-3] = _card('CHECKSUM', checksum, checksumComment)
+    header = ''.join(cards)
+    header += ' ' * (-len(header) % 2880)
+
+    f.write(header.encode('latin-1'))
+    f.write(data)
+
+def writeFits(path, im, header, compression=None, compressionArgs=None, fsync=False):
+    """ Write one image file, optionally making sure it is on the disk before returning.
+
+    Args
+    ----
+    path : str
+        The new file. Must not exist.
+    im : ndarray
+        The image.
+    header : pyfits.Header or str
+        The image's cards. A str holds the card images, as from
+        headerTemplate.HeaderBuilder.buildString(): uncompressed uint16
+        images are then written without astropy parsing the cards.
+    compression : {None, 'RICE_1', 'HCOMPRESS_1'}
+        None writes a plain image. Otherwise, see fpga.tileCompress.
+    compressionArgs : dict
+        Passed to tileCompress.compressedHDU().
+    fsync : bool
+        Whether to fsync the file and its directory.
+    """
+
+    if isinstance(header, str):
+        if compression is None and im.dtype == np.uint16 and im.ndim == 2:
+            _writeNew(path, lambda f: writeUnsignedImage(f, im, header), fsync=fsync)
+            return
+        header = pyfits.Header.fromstring(header)
+
+    if compression is None:
+        hdus = pyfits.HDUList([pyfits.PrimaryHDU(im, header=header)])
+    else:
+        hdu = tileCompress.compressedHDU(im, header=header, compression=compression,
+                                         **(compressionArgs or dict()))
+        hdus = pyfits.HDUList([pyfits.PrimaryHDU(), hdu])
+
+    _writeNew(path, lambda f: hdus.writeto(f, checksum=True), fsync=fsync)
+
+def _writeNew(path, writer, fsync=False):
+    """ Create a new file, call writer(f) to fill it, and remove it if that fails. """
+
+    # pyfits only accepts some file modes, so get the exclusive create from os.open().
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            writer(f)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+    except Exception:
+        os.unlink(path)
+        raise
+
+    if fsync:
+        dirfd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+class FitsWriter(object):
+    def __init__(self, queueDepth=2, fsync=False):
+        """ A background thread writing FITS files in order.
+
+        Args
+        ----
+        queueDepth : int
+            The most images waiting to be written. submit() blocks when there are more.
+        fsync : bool
+            Whether each file and its directory are fsynced before the write counts as done.
+        """
+
+        self.logger = logging.getLogger('fitsWriter')
+        self.queueDepth = queueDepth
+        self.fsync = fsync
+
+        self.queue = queue.Queue(maxsize=queueDepth)
+        self.thread = None
+        self.threadLock = threading.Lock()
+
+        self.statsLock = threading.Lock()
+        self.failures = []
+        self.nWritten = 0
+        self.nFailed = 0
+        self.totalWriteTime = 0.0
+        self.maxWriteTime = 0.0
+        self.lastWriteTime = None
+        self.totalWaitTime = 0.0
+
+    def __str__(self):
+        return "FitsWriter(queueDepth=%d, fsync=%s, pending=%d)" % (self.queueDepth, self.fsync,
+                                                                   self.pending)
+
+    @property
+    def pending(self):
+        """ The number of requests queued but not yet written. """
+        return self.queue.unfinished_tasks
+
+    def _start(self):
+        with self.threadLock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='fitsWriter', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            req = self.queue.get()
+            try:
+                if req is None:
+                    return
+                future, tQueued, args, kwargs = req
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                t0 = time.time()
+                try:
+                    writeFits(future.path, *args, fsync=self.fsync, **kwargs)
+                except Exception as e:
+                    self.logger.error('failed to write fits file %s: %s', future.path, e)
+                    with self.statsLock:
+                        self.nFailed += 1
+                        self.failures.append((future.path, e))
+                    future.set_exception(e)
+                    continue
+
+                t1 = time.time()
+                with self.statsLock:
+                    self.nWritten += 1
+                    self.lastWriteTime = t1 - t0
+                    self.totalWriteTime += t1 - t0
+                    self.maxWriteTime = max(self.maxWriteTime, t1 - t0)
+                    self.totalWaitTime += t0 - tQueued
+                self.logger.debug('wrote %s in %0.3fs after %0.3fs in the queue',
+                                  future.path, t1-t0, t0-tQueued)
+                future.set_result(future.path)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, path, im, header, compression=None, compressionArgs=None):
+        """ Queue an image to be written, blocking while the queue is full.
+
+        The image must not be modified until the write is done.
+
+        Returns
+        -------
+        future : WriteFuture
+            .path is the filename; .result() waits for the write and
+            returns the filename, or raises the write's exception.
+        """
+
+        self._start()
+        future = WriteFuture(path)
+        self.queue.put((future, time.time(), (im, header),
+                        dict(compression=compression, compressionArgs=compressionArgs)))
+        return future
+
+    def wait(self):
+        """ Wait for all queued writes to finish. """
+
+        if self.thread is not None:
+            self.queue.join()
+
+    def flush(self):
+        """ Wait for all queued writes, and raise a RuntimeError if any failed since the last flush. """
+
+        self.wait()
+        with self.statsLock:
+            failures, self.failures = self.failures, []
+        if failures:
+            raise RuntimeError("failed to write %d file(s): %s" %
+                               (len(failures),
+                                '; '.join('%s: %s' % (path, e) for path, e in failures)))
+
+    def close(self):
+        """ Write everything queued, then stop the thread. See flush(). """
+
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.thread = None
+        self.flush()
+
+    def metrics(self):
+        """ Return the queue depth and the write latencies, in seconds. """
+
+        with self.statsLock:
+            nWritten = self.nWritten
+            return dict(pending=self.pending,
+                        queueDepth=self.queueDepth,
+                        written=nWritten,
+                        failed=self.nFailed,
+                        lastWriteTime=self.lastWriteTime,
+                        meanWriteTime=self.totalWriteTime/nWritten if nWritten else None,
+                        maxWriteTime=self.maxWriteTime if nWritten else None,
+                        meanQueueTime=self.totalWaitTime/nWritten if nWritten else None)
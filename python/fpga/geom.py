@@ -1,23 +1,175 @@
 import logging
+import os
 import pathlib
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
 import astropy.io.fits as pyfits
 
+class LazyImage(object):
+    """ A read-only, memory-mapped FITS image which only reads the pixels asked for.
+
+    Indexing with slices or integers returns a new ndarray for just that
+    region, in native byte order and with any BZERO applied.
+
+    Args
+    ----
+    raw : ndarray
+       The unscaled (memory-mapped) data, from pyfits.open(memmap=True, do_not_scale_image_data=True)
+    bzero, bscale : numbers
+       The FITS scaling.
+    fixEdge : bool
+       Whether to apply the pre-0xa071 FPGA edge fix: pixel i is raw pixel i+1,
+       with the last pixel repeated.
+    dtype : dtype
+       If set, the type of the returned pixels.
+    """
+
+    def __init__(self, raw, bzero=0, bscale=1, fixEdge=False, dtype=None):
+        self.raw = raw
+        self.bzero = bzero
+        self.bscale = bscale
+        self.fixEdge = fixEdge
+
+        if bscale == 1 and bzero == 32768 and raw.dtype.kind == 'i' and raw.dtype.itemsize == 2:
+            self.rawDtype = np.dtype('u2')
+        elif bscale == 1 and bzero == 0:
+            self.rawDtype = raw.dtype.newbyteorder('=')
+        else:
+            self.rawDtype = np.dtype('f4')
+        self.dtype = self.rawDtype if dtype is None else np.dtype(dtype)
+
+    def __str__(self):
+        return "LazyImage(shape=%s, dtype=%s, fixEdge=%s)" % (self.shape, self.dtype, self.fixEdge)
+
+    @property
+    def shape(self):
+        return self.raw.shape
+
+    @property
+    def ndim(self):
+        return self.raw.ndim
+
+    @property
+    def size(self):
+        return int(np.prod(self.raw.shape))
+
+    def astype(self, dtype, copy=True):
+        return LazyImage(self.raw, bzero=self.bzero, bscale=self.bscale,
+                         fixEdge=self.fixEdge, dtype=dtype)
+
+    def _scale(self, raw):
+        """ Convert raw pixels to our dtype. """
+
+        if self.rawDtype == np.dtype('u2') and self.bzero == 32768:
+            # Flipping the sign bit is the same as adding 32768 to an int16.
+            pixels = raw.view(raw.dtype.str.replace('i', 'u'))
+            pixels = (pixels ^ np.uint16(0x8000)).astype('u2', copy=False)
+        elif self.rawDtype.kind == 'f':
+            pixels = raw * self.bscale + self.bzero
+        else:
+            pixels = raw.astype(self.rawDtype)
+
+        return pixels.astype(self.dtype, copy=False)
+
+    def _axisIndices(self, key, n):
+        """ Return (index array, dropAxis) for one axis of an index. """
+
+        if isinstance(key, slice):
+            return np.arange(*key.indices(n)), False
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += n
+            return np.array([key]), True
+        return np.arange(n)[key], False
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key or len(key) > 2:
+            raise IndexError("LazyImage only supports [rows, cols] indexing, not %s" % (key,))
+        key = key + (slice(None),)*(2 - len(key))
+
+        if not self.fixEdge:
+            return self._scale(self.raw[key])
+
+        nrows, ncols = self.raw.shape
+        rows, dropRows = self._axisIndices(key[0], nrows)
+        cols, dropCols = self._axisIndices(key[1], ncols)
+
+        # The edge fix is a one-pixel offset in the flattened image:
+        # fixed[r, c] = raw.flat[r*ncols + c + 1], so the last column
+        # comes from the next row's first pixel, and the very last
+        # pixel is repeated.
+        srcCols = cols + 1
+        wrapped = srcCols == ncols
+        srcCols[wrapped] = 0
+        pixels = self.raw[np.ix_(rows, srcCols)]
+        if np.any(wrapped):
+            nextRows = rows + 1
+            lastRow = nextRows == nrows
+            nextRows[lastRow] = nrows-1
+            wrappedPixels = self.raw[nextRows, 0]
+            wrappedPixels[lastRow] = self.raw[nrows-1, ncols-1]
+            pixels[:, wrapped] = wrappedPixels[:, None]
+
+        pixels = self._scale(pixels)
+        if dropRows and dropCols:
+            return pixels[0, 0]
+        if dropRows:
+            return pixels[0]
+        if dropCols:
+            return pixels[:, 0]
+        return pixels
+
+    def materialize(self):
+        """ Return the full image as an ndarray. """
+
+        return self[:, :]
+
+    def __array__(self, dtype=None, copy=None):
+        im = self.materialize()
+        return im if dtype is None else im.astype(dtype, copy=False)
+
 class Exposure(object):
     def __init__(self, obj=None, dtype=None, nccds=2, copyExposure=False,
-                 simpleGeometry=False, logLevel=logging.WARN):
+                 simpleGeometry=False, lazy=False, logLevel=logging.WARN):
+        """ A PFS detector image, with its geometry.
+
+        Args
+        ----
+        obj : None, Exposure, path, or ndarray
+           What to build the Exposure from.
+        dtype : dtype
+           If set, convert the image to this type.
+        copyExposure : bool
+           Whether to copy the image and header from obj.
+        simpleGeometry : bool
+           If the header has no geometry, deduce one from the image shape.
+        lazy : bool
+           For files only: memory-map the image, and only read the
+           pixels for the regions which are asked for (ampImage(),
+           overscanColImage(), etc.). The full image is only read if
+           .image is used.
+        """
+
         self.logger = logging.getLogger('geom.Exposure')
         self.logger.setLevel(logLevel)
         
         self.nccds = nccds
         self._setDefaultGeometry()
+        self._image = None
+        self._lazyImage = None
 
         if obj is None:
             self.image = None
             self.header = dict()
         elif isinstance(obj, Exposure):
-            self.image = obj.image
+            if obj._lazyImage is not None and not copyExposure:
+                self._lazyImage = obj._lazyImage
+            else:
+                self.image = obj.image
             self.header = obj.header
             self.deduceGeometry()
             
@@ -25,11 +177,14 @@ class Exposure(object):
                 self.image = self.image.copy()
                 self.header = self.header.copy()
         elif isinstance(obj, (str, pathlib.Path)):
-            ffile = pyfits.open(obj)
-            self.image = ffile[-1].data
-            self.header = ffile[-1].header
-            self.deduceGeometry(simpleGeometry)
-            self.image = self.fixEdgeColsBug(self.image)
+            if lazy:
+                self._openLazy(obj, simpleGeometry=simpleGeometry)
+            else:
+                ffile = pyfits.open(obj)
+                self.image = ffile[-1].data
+                self.header = ffile[-1].header
+                self.deduceGeometry(simpleGeometry)
+                self.image = self.fixEdgeColsBug(self.image)
 
         elif isinstance(obj, np.ndarray):
             self.image = obj.copy() if copyExposure else obj
@@ -39,39 +194,96 @@ class Exposure(object):
             raise RuntimeError("do not know how to construct from a %s" % (type(obj)))
 
         if dtype is not None:
-            self.image = self.image.astype(dtype, copy=False)
+            if self._lazyImage is not None:
+                self._lazyImage = self._lazyImage.astype(dtype)
+            else:
+                self.image = self.image.astype(dtype, copy=False)
+
+    def _openLazy(self, path, simpleGeometry=False):
+        """ Memory-map the image in path. """
+
+        ffile = pyfits.open(path, memmap=True, do_not_scale_image_data=True)
+        hdu = ffile[-1]
+        self.header = hdu.header
+        # Compressed images cannot be mapped, but their sections only
+        # decompress the tiles they touch.
+        isCompressed = isinstance(hdu, pyfits.CompImageHDU)
+        self._lazyImage = LazyImage(hdu.section if isCompressed else hdu.data,
+                                    bzero=self.header.get('BZERO', 0),
+                                    bscale=self.header.get('BSCALE', 1))
+        self.deduceGeometry(simpleGeometry)
+        if self.needsEdgeFix():
+            if isCompressed:
+                # The edge fix needs fancy indexing, which sections do not do.
+                self.image = self.fixEdgeColsBug(pyfits.getdata(path))
+            else:
+                self._lazyImage.fixEdge = True
+
+    @property
+    def image(self):
+        """ The full image, as an ndarray. Reads the entire image of lazy Exposures. """
+
+        if self._image is None and self._lazyImage is not None:
+            self._image = self._lazyImage.materialize()
+            self._lazyImage = None
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+        self._lazyImage = None
+
+    @property
+    def pixels(self):
+        """ The image, or for lazy Exposures the LazyImage. Either can be indexed by [rows, cols]. """
+
+        return self._lazyImage if self._lazyImage is not None else self._image
+
+    @property
+    def isLazy(self):
+        return self._lazyImage is not None
+
+    @property
+    def imageShape(self):
+        return self.pixels.shape
 
     def __str__(self):
-        return "Exposure(shape=%s, dtype=%s, rows=(%d,%d,%d) cols=(%d,%d,%d)*%d)" % (self.image.shape, self.image.dtype,
-                                                                                     self.leadinRows, self.activeRows,
-                                                                                     self.overRows,
-                                                                                     self.leadinCols, self.activeCols,
-                                                                                     self.overCols,
-                                                                                     self.namps)
+        return "Exposure(shape=%s, dtype=%s, rows=(%d,%d,%d) cols=(%d,%d,%d)*%d binning=%dx%d)" % (self.pixels.shape, self.pixels.dtype,
+                                                                                                   self.leadinRows, self.activeRows,
+                                                                                                   self.overRows,
+                                                                                                   self.leadinCols, self.activeCols,
+                                                                                                   self.overCols,
+                                                                                                   self.namps,
+                                                                                                   self.rowBinning, self.colBinning)
     
-    def fixEdgeColsBug(self, image):
-        """ Fix extra 0th pixel in early raw images.
-        """
-        
+    def needsEdgeFix(self):
+        """ Whether this image has the extra 0th pixel of pre-0xa071 FPGAs. """
+
         try:
             vers = self.header['versions.FPGA']
             if isinstance(vers, str):
                 vers = int(vers, base=16) 
             
             if vers >= 0xa071:
-                return image
+                return False
         except KeyError:
             self.logger.info('versions.FPGA missing from header, returning image')
-            return image
+            return False
         except:
             pass
         
         try:
             flag = self.header.get('geom.edgesOK')
         except:
-            return image
+            return False
+
+        return not flag
 
-        if not flag:
+    def fixEdgeColsBug(self, image):
+        """ Fix extra 0th pixel in early raw images.
+        """
+        
+        if self.needsEdgeFix():
             self.logger.info('fixing corner pixel')
             if False:
                 fixedImage1 = np.ndarray(shape=image.shape, dtype=image.dtype)
@@ -101,9 +313,11 @@ class Exposure(object):
             self.leadinCols = self.header['geom.cols.leadin'] 
             self.overCols = self.header['geom.cols.overscan']
             self.readDirection = self.header['geom.readDirection']
+            self.rowBinning = self.header.get('geom.rows.binning', 1)
+            self.colBinning = self.header.get('geom.cols.binning', 1)
 
-            self.ccdRows = self.image.shape[0] - self.overRows
-            self.ampCols = self.image.shape[1]//self.namps - self.overCols
+            self.ccdRows = self.imageShape[0] - self.overRows
+            self.ampCols = self.imageShape[1]//self.namps - self.overCols
 
             return True
         except Exception as e:
@@ -112,7 +326,10 @@ class Exposure(object):
             return False
         
     def deduceGeometry(self, simple=False):
-        """ Use .image to generate geometry for an unbinned full-frame. 
+        """ Use .image to generate geometry for a full-frame.
+
+        Binned geometry is only known from the header cards: without
+        them we assume an unbinned image.
 
         Args
         ----
@@ -129,10 +346,10 @@ class Exposure(object):
                 self.overCols = self.overRows = 0
                 self.leadinCols = self.leadinRows = 0
                 self.readDirection = 0
-                self.ccdRows = self.image.shape[0]
-                self.ampCols = self.image.shape[1]//self.namps
+                self.ccdRows = self.imageShape[0]
+                self.ampCols = self.imageShape[1]//self.namps
         
-        imh,imw = self.image.shape
+        imh,imw = self.imageShape
         if (self.ampCols + self.overCols)*self.namps != imw:
             self.logger.warn("Strange geometry: %d amps * (%d cols + %d overscan cols) != image width %d)" %
                              (self.namps, self.ampCols, self.overCols, imw))
@@ -146,6 +363,8 @@ class Exposure(object):
         self.leadinRows = 48
         
         self.readDirection = 0b10101010
+        self.rowBinning = 1
+        self.colBinning = 1
         
         self.namps = 4 * self.nccds
 
@@ -202,7 +421,7 @@ class Exposure(object):
         if not self.readDirection or (self.readDirection & (1 << ampId)) == 0:
             xr = slice(x0, x1)
         else:
-            xr = slice(x1-1, x0-1, -1)
+            xr = slice(x1-1, x0-1 if x0 > 0 else None, -1)
 
         yr = slice(self.leadinRows*(not leadingRows), self.ccdRows + overscan*self.overRows)
         
@@ -247,7 +466,7 @@ class Exposure(object):
         """
         
         if im is None:
-            im = self.image
+            im = self.pixels
             
         yr, xr = self.ampExtents(ampId, leadingRows=leadingRows, leadingCols=leadingCols)
 
@@ -274,50 +493,54 @@ class Exposure(object):
 
     def overscanRowImage(self, ampId, im=None, leadingCols=False, overscanCols=False):
         if im is None:
-            im = self.image
+            im = self.pixels
         yr, xr = self.overscanRows(ampId, leadingCols=leadingCols, overscanCols=overscanCols)
     
         return im[yr, xr]
 
     def overscanColImage(self, ampId, im=None, leadingRows=False, overscanRows=False):
         if im is None:
-            im = self.image
+            im = self.pixels
         yr, xr = self.overscanCols(ampId, leadingRows=leadingRows, overscanRows=overscanRows)
     
         return im[yr, xr]
 
     def coreAmpImage(self, ampId, im=None, offset=(0,0)):
         if im is None:
-            im = self.image
+            im = self.pixels
         ampImg = self.ampImage(ampId, im=im)
 
         amph, ampw = ampImg.shape
-        hslice = slice(int(amph/2.0 - 200 + offset[0]),
-                       int(amph/2.0 + 200 + offset[0]))
-        wslice = slice(int(ampw/2.0 - 200 + offset[1]),
-                       int(ampw/2.0 + 200 + offset[1]))
+        hsize = 200 // self.rowBinning
+        wsize = 200 // self.colBinning
+        hslice = slice(int(amph/2.0 - hsize + offset[0]),
+                       int(amph/2.0 + hsize + offset[0]))
+        wslice = slice(int(ampw/2.0 - wsize + offset[1]),
+                       int(ampw/2.0 + wsize + offset[1]))
     
         return ampImg[hslice, wslice]
 
     def coreOverscanColImage(self, ampId, im=None):
         if im is None:
-            im = self.image
+            im = self.pixels
         ampImg = self.overscanColImage(ampId, im=im)
 
         amph, ampw = ampImg.shape
-        hslice = slice(int(amph/2.0 - 50), int(amph/2.0 + 50))
-        wslice = slice(5, -1)
+        hsize = 50 // self.rowBinning
+        hslice = slice(int(amph/2.0 - hsize), int(amph/2.0 + hsize))
+        wslice = slice(5 // self.colBinning, -1)
     
         return ampImg[hslice, wslice]
 
     def coreOverscanRowImage(self, ampId, im=None):
         if im is None:
-            im = self.image
+            im = self.pixels
         ampImg = self.overscanRowImage(ampId, im=im)
 
         amph, ampw = ampImg.shape
-        hslice = slice(5, -1)
-        wslice = slice(int(ampw/2.0 - 50), int(ampw/2.0 + 50))
+        wsize = 50 // self.colBinning
+        hslice = slice(5 // self.rowBinning, -1)
+        wslice = slice(int(ampw/2.0 - wsize), int(ampw/2.0 + wsize))
     
         return ampImg[hslice, wslice]
 
@@ -348,6 +571,102 @@ class Exposure(object):
 
         return osIms
 
+    def _cube(self, im, yr, x0s, width, steps):
+        """ Return the (len(x0s), rows, width) cube of im[yr, x0 + step*arange(width)] for each amp.
+
+        When every amp has the same step, and the amps are evenly spaced,
+        the cube is a strided view of im. Otherwise it is a single
+        gathered copy.
+        """
+
+        x0s = np.asarray(x0s)
+        steps = np.asarray(steps)
+        xs = x0s[:, None] + steps[:, None]*np.arange(width)
+        xmin = xs.min() if xs.size else 0
+        xmax = xs.max() + 1 if xs.size else 0
+
+        # For a LazyImage this reads just the one band of columns.
+        region = im[yr, xmin:xmax]
+        xs = xs - xmin
+        namps = len(x0s)
+
+        ampSteps = np.diff(xs[:, 0])
+        if width > 0 and np.all(steps == steps[0]) and np.all(ampSteps == (ampSteps[0] if namps > 1 else 0)):
+            colStride = region.strides[1]
+            ampStride = (ampSteps[0] if namps > 1 else 0) * colStride
+            return np.lib.stride_tricks.as_strided(region[:, xs[0, 0]:],
+                                                   shape=(namps, region.shape[0], width),
+                                                   strides=(ampStride, region.strides[0], steps[0]*colStride))
+
+        return region[:, xs].transpose(1, 0, 2)
+
+    def ampCube(self, im=None, leadingCols=False, leadingRows=False, applyReadDirection=True):
+        """ Return the active areas of all amps as one (namps, rows, cols) array.
+
+        Args
+        ----
+        im : ndarray of image, optional
+            If set, use the given image. Must have a geometry compatible with self.
+        leadingCols, leadingRows : bool
+            If set, include the leadin columns/rows.
+        applyReadDirection : bool
+            If set, flip the amps as in ampImage(). If not, or if all amps
+            read in the same direction, the cube is a view of the image;
+            otherwise it is a copy. Per-amp statistics do not need the flips.
+
+        Examples
+        --------
+
+        >>> ampMedians = np.median(exp.ampCube(applyReadDirection=False), axis=(1,2))
+        """
+
+        if im is None:
+            im = self.pixels
+
+        yr, x0s, width, steps = self._ampColumns(leadingCols=leadingCols, leadingRows=leadingRows,
+                                                 applyReadDirection=applyReadDirection)
+
+        return self._cube(im, yr, x0s, width, steps)
+
+    def _ampColumns(self, leadingCols=False, leadingRows=False, applyReadDirection=True):
+        """ Return the rows, and the first column, width and column step of each amp's active area. """
+
+        x0s = []
+        steps = []
+        for a_i in range(self.namps):
+            yr, xr = self.ampExtents(a_i, leadingRows=leadingRows, leadingCols=leadingCols)
+            cols = range(*xr.indices(self.namps*self.ncols))
+            if applyReadDirection:
+                x0s.append(cols[0])
+                steps.append(cols.step)
+            else:
+                x0s.append(min(cols[0], cols[-1]))
+                steps.append(1)
+
+        return yr, np.array(x0s), len(cols), np.array(steps)
+
+    def overscanColCube(self, im=None, leadingRows=False, overscanRows=False):
+        """ Return the overscan columns of all amps as a (namps, rows, overCols) view. """
+
+        if im is None:
+            im = self.pixels
+
+        yr, xr = self.overscanCols(0, leadingRows=leadingRows, overscanRows=overscanRows)
+        x0s = [xr.start + a_i*self.ncols for a_i in range(self.namps)]
+
+        return self._cube(im, yr, x0s, self.overCols, [1]*self.namps)
+
+    def overscanRowCube(self, im=None, leadingCols=False, overscanCols=False):
+        """ Return the overscan rows of all amps as a (namps, overRows, cols) view. """
+
+        if im is None:
+            im = self.pixels
+
+        yr, xr = self.overscanRows(0, leadingCols=leadingCols, overscanCols=overscanCols)
+        x0s = [xr.start + a_i*self.ncols for a_i in range(self.namps)]
+
+        return self._cube(im, yr, x0s, xr.stop - xr.start, [1]*self.namps)
+
     def splitImage(self, doTrim=False, doFull=False):
 
         if doTrim and doFull:
@@ -419,18 +738,25 @@ class Exposure(object):
         
     def biasSubtractOne(self, im=None, byRow=False):
         if im is None:
-            im = self.image
-        amps = []
+            im = self.pixels
 
-        for a_i in range(8):
-            amps.append(self.biasSubtractAmp(a_i, im=im, byRow=byRow))
-        
-        return np.hstack(amps)
+        amps = self.ampCube(im=im)
+        overscan = self.overscanColCube(im=im)
+
+        if byRow:
+            imMed = np.median(overscan, axis=2, keepdims=True).astype('i4')
+        else:
+            trim = 500//self.rowBinning
+            overscan = overscan[:, trim:overscan.shape[1]-trim, 3//self.colBinning:]
+            imMed = np.median(overscan.reshape(self.namps, -1), axis=1).astype('i4')
+            imMed = imMed[:, None, None]
+
+        return cubeToImage(amps.astype('i4') - imMed)
 
     
     def biasSubtractAmp(self, ampId, im=None, byRow=False):
         if im is None:
-            im = self.image
+            im = self.pixels
 
         ampIm = self.ampImage(ampId, im=im)
         osYr, osXr = self.overscanCols(ampId)
@@ -439,91 +765,587 @@ class Exposure(object):
             imMed = np.median(im[osYr, osXr],
                               axis=1, keepdims=True).astype('i4')
         else:
-            osYr = slice(osYr.start + 500,
-                         osYr.stop - 500)
-            osXr = slice(osXr.start+3, osXr.stop)
+            osYr = slice(osYr.start + 500//self.rowBinning,
+                         osYr.stop - 500//self.rowBinning)
+            osXr = slice(osXr.start + 3//self.colBinning, osXr.stop)
         
             imMed = int(np.median(im[osYr, osXr]))
 
         return ampIm.astype('i4') - imMed
-    
+
+    def overscanLevels(self, model='scalar', im=None, leadingRows=False, overscanRows=False,
+                       rowTrim=None, colTrim=None, smoothRows=31, stat='median'):
+        """ Return the overscan level of every amp, as a (namps, rows, 1) or (namps, 1, 1) array.
+
+        Args
+        ----
+        model : {'scalar', 'row', 'smooth'}
+            'scalar' is one level per amp, 'row' one per amp per row,
+            'smooth' the per-row levels boxcar-smoothed over smoothRows rows.
+        im : ndarray of image, optional
+            If set, use the given image. Must have a geometry compatible with self.
+        leadingRows, overscanRows : bool
+            Which rows to return levels for. Must match the pixels they will be
+            subtracted from.
+        rowTrim : int
+            For 'scalar', the rows to ignore at each end. Default 500 unbinned rows.
+        colTrim : int
+            The leading overscan columns to ignore: they carry the CTE tail of
+            the last active pixels. Default 3 unbinned columns.
+        smoothRows : int
+            For 'smooth', the width of the boxcar.
+        stat : {'median', 'mean'}
+            How to combine the overscan pixels.
+
+        Returns
+        -------
+        levels : float64 array, broadcastable against ampCube()
+        """
+
+        if im is None:
+            im = self.pixels
+        if rowTrim is None:
+            rowTrim = 500//self.rowBinning
+        if colTrim is None:
+            colTrim = 3//self.colBinning
+
+        statFunc = dict(median=np.median, mean=np.mean).get(stat)
+        if statFunc is None:
+            raise RuntimeError("unknown overscan statistic: %s" % (stat))
+
+        overscan = self.overscanColCube(im=im, leadingRows=leadingRows, overscanRows=overscanRows)
+        overscan = overscan[:, :, colTrim:]
+        if model == 'scalar':
+            overscan = overscan[:, rowTrim:overscan.shape[1]-rowTrim]
+            return statFunc(overscan, axis=(1,2)).reshape(self.namps, 1, 1)
+        elif model in {'row', 'smooth'}:
+            levels = statFunc(overscan, axis=2)
+            if model == 'smooth':
+                levels = smoothLevels(levels, smoothRows)
+            return levels[:, :, None]
+        else:
+            raise RuntimeError("unknown overscan model: %s" % (model))
+
+    def overscanCorrect(self, model='scalar', im=None, dtype='f4', out=None, inPlace=False,
+                        region='active', leadingRows=False, levels=None, **levelArgs):
+        """ Subtract the overscan levels from all amps in one pass, into one output image.
+
+        Args
+        ----
+        model : {'scalar', 'row', 'smooth'}
+            The overscan model, as for overscanLevels().
+        im : ndarray of image, optional
+            If set, use the given image. Must have a geometry compatible with self.
+        dtype : numpy dtype
+            The type of the output. For integer types the levels are rounded first.
+        out : ndarray, optional
+            A C-contiguous array to write into, of the right shape.
+        inPlace : bool
+            If set, overwrite the image itself. Requires region='full', and a
+            float or signed image.
+        region : {'active', 'full'}
+            'active' returns the active areas side by side, flipped per the
+            read direction, as from biasSubtractOne(). 'full' returns the
+            entire image, with each amp's leadin and overscan pixels
+            corrected too, as from normAmpLevels().
+        leadingRows : bool
+            For region='active', whether to include the leadin rows.
+        levels : array, optional
+            Precomputed levels, as from overscanLevels(), e.g. to apply
+            one exposure's levels to another.
+        levelArgs
+            Passed on to overscanLevels().
+
+        Returns
+        -------
+        out : ndarray
+
+        Notes
+        -----
+        The amps are not copied out before subtracting: the subtraction
+        reads strided views of the image and writes strided views of the
+        output, so this takes one ufunc call per group of amps which read in
+        the same direction. biasSubtract(), biasSubtractOne() and
+        normAmpLevels() each make full intermediate copies.
+
+        Examples
+        --------
+
+        >>> flux = exp.overscanCorrect('smooth', dtype='f4')
+        >>> exp.overscanCorrect('row', region='full', inPlace=True)
+        """
+
+        if im is None:
+            im = self.pixels
+        if region not in {'active', 'full'}:
+            raise RuntimeError("unknown region: %s" % (region))
+
+        if region == 'full':
+            leadingRows = overscanRows = True
+            yr = slice(None)
+            width = self.ncols
+            x0s = np.arange(self.namps)*self.ncols
+            steps = np.ones(self.namps, dtype='i4')
+        else:
+            overscanRows = False
+            yr, x0s, width, steps = self._ampColumns(leadingRows=leadingRows)
+
+        if levels is None:
+            levels = self.overscanLevels(model, im=im, leadingRows=leadingRows,
+                                         overscanRows=overscanRows, **levelArgs)
+
+        if inPlace:
+            if region != 'full':
+                raise RuntimeError("only region='full' can be corrected in place")
+            if not isinstance(im, np.ndarray):
+                im = self.image
+            if im.dtype.kind not in 'fi':
+                raise RuntimeError("cannot correct a %s image in place" % (im.dtype))
+            out = im
+        nrows = len(range(*yr.indices(im.shape[0])))
+        shape = (nrows, self.namps*width)
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        elif out.shape != shape or not out.flags.c_contiguous:
+            raise RuntimeError("output must be a C-contiguous %s array, not %s" % (shape, out.shape))
+
+        if out.dtype.kind in 'iu':
+            levels = np.rint(levels)
+        levels = np.asarray(levels).astype(out.dtype)
+        outCube = out.reshape(nrows, self.namps, width).transpose(1, 0, 2)
+
+        # Amps which read in the same direction and are evenly spaced can be
+        # handled by a single pair of views.
+        for step in np.unique(steps):
+            for ampSlice in _evenRuns(np.where(steps == step)[0]):
+                np.subtract(self._cube(im, yr, x0s[ampSlice], width, steps[ampSlice]),
+                            levels[ampSlice], out=outCube[ampSlice], casting='unsafe')
+
+        return out
+
     def finalImage(self, leadingRows=False):
-        ampImages = self.allAmpsImages(leadingRows=leadingRows)
-        return np.hstack(ampImages)
-    
+        return cubeToImage(self.ampCube(leadingRows=leadingRows))
+
+def cubeToImage(cube):
+    """ Lay a (namps, rows, cols) cube out side by side, as a (rows, namps*cols) image. """
+
+    namps, nrows, ncols = cube.shape
+    return cube.transpose(1, 0, 2).reshape(nrows, namps*ncols)
+
+def smoothLevels(levels, smoothRows):
+    """ Boxcar-smooth (namps, rows) levels along the rows, reflecting at the ends. """
+
+    nrows = levels.shape[1]
+    half = min(smoothRows//2, nrows-1)
+    if half <= 0:
+        return levels
+
+    padded = np.pad(levels, ((0, 0), (half, half)), mode='reflect')
+    csum = np.zeros((levels.shape[0], padded.shape[1]+1), dtype='f8')
+    np.cumsum(padded, axis=1, out=csum[:, 1:])
+
+    return (csum[:, 2*half+1:] - csum[:, :-2*half-1]) / (2*half+1)
+
+def _evenRuns(idx):
+    """ Split a sorted index array into slices with constant steps. """
+
+    i = 0
+    while i < len(idx):
+        j = i + 1
+        if j < len(idx):
+            d = idx[j] - idx[i]
+            while j+1 < len(idx) and idx[j+1] - idx[j] == d:
+                j += 1
+            yield slice(idx[i], idx[j]+1, d)
+        else:
+            yield slice(idx[i], idx[i]+1)
+        i = j + 1
+
 def clippedStats(a, nsig=3.0, niter=20):
-    a = a.reshape(-1)
-    keep = np.ones(a.size, dtype=np.bool)
+    """ Return the sigma-clipped mean, std, and kept fraction of all of a. """
+
+    mn, sd, frac = clippedStatsBatch(np.asarray(a).reshape(1, -1), nsig=nsig, niter=niter)
+    return mn[0], sd[0], frac[0]
+
+def clippedStatsBatch(a, nsig=3.0, niter=20, maxBins=1<<25):
+    """ Return the sigma-clipped mean, std, and kept fraction along the last axis of a.
+
+    Args
+    ----
+    a : array, shape (..., N)
+        E.g. (namps, npixels), or (nframes, namps, npixels)
+    nsig : float
+        Pixels more than nsig*std from the mean are rejected, iteratively.
+    niter : int
+        The most clipping iterations to run.
+    maxBins : int
+        The largest histogram to build for integer data.
+
+    Returns
+    -------
+    mean, std, frac : float64 arrays, shape a.shape[:-1]
+
+    Notes
+    -----
+    The pixels kept by clipping are always a contiguous range of values,
+    so instead of making masked copies each iteration we build running
+    sums over the sorted values once, and each iteration only needs the
+    range bounds. For integer-valued data (ADUs, and differences of
+    ADUs) the "sorted values" are a per-row histogram, and all rows are
+    bounded at once; otherwise the rows are sorted and bounded with
+    binary searches. Rows which are constant are not clipped.
+    """
+
+    a = np.asarray(a)
+    batchShape = a.shape[:-1]
+    npix = a.shape[-1]
+    if npix == 0 or a.size == 0:
+        nans = np.full(batchShape, np.nan)
+        return nans, nans.copy(), nans.copy()
+    rows = a.reshape(-1, npix)
+    nrows = rows.shape[0]
+    ridx = np.arange(nrows)
+
+    ints = None
+    if rows.dtype.kind in 'iub':
+        ints = rows.astype('i8')
+    elif rows.dtype.kind == 'f' and np.isfinite(rows).all():
+        ints = rows.astype('i8')
+        if not np.array_equal(ints, rows):
+            ints = None
+    if ints is not None:
+        mins = ints.min(axis=1)
+        span = int((ints.max(axis=1) - mins).max()) + 1
+        if span*nrows > maxBins:
+            ints = None
+
+    if ints is not None:
+        # Histogram path: position k in a row is the value mins + k.
+        ints -= (mins - ridx*span)[:, None]
+        counts = np.bincount(ints.ravel(), minlength=nrows*span).reshape(nrows, span)
+        del ints
+        mins = mins.astype('f8')
+        sum0 = np.zeros((nrows, span+1))
+        np.cumsum(counts, axis=1, out=sum0[:, 1:])
+        centerIdx = (sum0[:, 1:] < npix/2).sum(axis=1)
+        center = mins + centerIdx
+        d = np.arange(span) - centerIdx[:, None].astype('f8')
+        d *= counts
+        sum1 = np.zeros((nrows, span+1))
+        np.cumsum(d, axis=1, out=sum1[:, 1:])
+        d *= np.arange(span) - centerIdx[:, None]
+        sum2 = np.zeros((nrows, span+1))
+        np.cumsum(d, axis=1, out=sum2[:, 1:])
+        del d, counts
+
+        def bounds(act, lowVal, highVal):
+            lo = np.floor(lowVal - mins[act]).astype('i8') + 1
+            hi = np.ceil(highVal - mins[act]).astype('i8')
+            return np.clip(lo, 0, span), np.clip(hi, 0, span)
+    else:
+        # Sorted path: position k in a row is the kth smallest value.
+        srows = np.sort(rows, axis=1)
+        center = srows[:, npix//2].astype('f8')
+        d = srows.astype('f8')
+        d -= center[:, None]
+        sum0 = None
+        sum1 = np.zeros((nrows, npix+1))
+        np.cumsum(d, axis=1, out=sum1[:, 1:])
+        d *= d
+        sum2 = np.zeros((nrows, npix+1))
+        np.cumsum(d, axis=1, out=sum2[:, 1:])
+        del d
+
+        def bounds(act, lowVal, highVal):
+            return (_searchRows(srows, act, lowVal, side='right'),
+                    _searchRows(srows, act, highVal, side='left'))
+
+    def count(act, lo, hi):
+        if sum0 is None:
+            return np.maximum(hi - lo, 0).astype('f8')
+        return sum0[act, hi] - sum0[act, lo]
+
+    lo = np.zeros(nrows, dtype='i8')
+    hi = np.full(nrows, sum1.shape[1]-1, dtype='i8')
+    nkeep = np.full(nrows, float(npix))
+    mn = np.zeros(nrows)
+    sd = np.zeros(nrows)
+    active = np.ones(nrows, dtype=bool)
+
+    def rangeStats(act):
+        n = nkeep[act]
+        m1 = (sum1[act, hi[act]] - sum1[act, lo[act]]) / n
+        var = (sum2[act, hi[act]] - sum2[act, lo[act]]) / n - m1*m1
+        mn[act] = m1 + center[act]
+        sd[act] = np.sqrt(np.maximum(var, 0.0))
 
     for i in range(niter):
-        mn = a[keep].mean()
-        sd = a[keep].std()
-        nkeep0 = keep.sum()
-        keep &= np.abs(a - mn) < nsig*sd
-        nkeep1 = keep.sum()
+        act = ridx[active]
+        rangeStats(act)
+
+        clip = act[sd[act] > 0]
+        newLo, newHi = bounds(clip, mn[clip] - nsig*sd[clip], mn[clip] + nsig*sd[clip])
+        lo[clip] = np.maximum(lo[clip], newLo)
+        hi[clip] = np.maximum(np.minimum(hi[clip], newHi), lo[clip])
+        newKeep = nkeep.copy()
+        newKeep[clip] = count(clip, lo[clip], hi[clip])
+
+        active &= (newKeep != nkeep) & (newKeep > 0)
+        nkeep = newKeep
+        if not active.any():
+            break
+    else:
+        act = ridx[active]
+        logger = logging.getLogger('geom')
+        logger.warning("too many iterations (%d) for %d of %d rows", niter, len(act), nrows)
+        rangeStats(act)
+
+    frac = nkeep / npix
+
+    return mn.reshape(batchShape), sd.reshape(batchShape), frac.reshape(batchShape)
+
+def _searchRows(srows, rowIdx, values, side='left'):
+    """ np.searchsorted(srows[r], v, side) for each r, v in zip(rowIdx, values), vectorized. """
+
+    lo = np.zeros(len(rowIdx), dtype='i8')
+    hi = np.full(len(rowIdx), srows.shape[1], dtype='i8')
+    while np.any(lo < hi):
+        mid = (lo + hi) // 2
+        midVals = srows[rowIdx, np.minimum(mid, srows.shape[1]-1)]
+        goRight = (midVals <= values) if side == 'right' else (midVals < values)
+        goRight &= lo < hi
+        lo = np.where(goRight, mid + 1, lo)
+        hi = np.where(goRight | (lo >= hi), hi, mid)
+
+    return lo
+
+def imageMedian(im, bandRows=512):
+    """ Return np.median(im), reading the image in bands of rows.
 
-        if nkeep1 == nkeep0:
-            return mn, sd, float(nkeep1)/a.size
+    8- and 16-bit integer images are histogrammed, so only one band is
+    ever in memory. Other images are read whole.
+    """
+
+    if im.dtype.kind not in 'iu' or im.dtype.itemsize > 2:
+        return np.median(im[:, :])
+
+    offset = 0 if im.dtype.kind == 'u' else 1 << (8*im.dtype.itemsize - 1)
+    nbins = 1 << (8*im.dtype.itemsize)
+    counts = np.zeros(nbins, dtype='i8')
+    for y0 in range(0, im.shape[0], bandRows):
+        band = im[y0:y0+bandRows].ravel()
+        if offset:
+            band = band.astype('i4') + offset
+        counts += np.bincount(band, minlength=nbins)
+
+    # np.median averages the middle two pixels of even-sized images.
+    cumCounts = np.cumsum(counts)
+    npix = cumCounts[-1]
+    lower = np.searchsorted(cumCounts, (npix-1)//2, side='right')
+    upper = np.searchsorted(cumCounts, npix//2, side='right')
+
+    return (lower + upper)/2.0 - offset
 
-    print("too many iterations (%d): fullsize=%d clipped=%d lastclipped=%d" % (i, a.size,
-                                                                               float(nkeep0)/a.size,
-                                                                               float(nkeep1)/a.size))
-    return a[keep].mean(), a[keep].std(), float(nkeep1)/a.size
+def _medianCombine(band, nsig, niter):
+    return np.median(band, axis=0)
 
-def clippedStack(flist, dtype='i4'):
+def _meanCombine(band, nsig, niter):
+    return band.mean(axis=0, dtype='f8')
+
+def _clippedMeanCombine(band, nsig, niter):
+    # With only a few images per pixel, masked sums over the stack beat clippedStatsBatch()
+    keep = np.ones(band.shape, dtype=bool)
+    nkeep = np.full(band.shape[1:], band.shape[0])
+
+    def keptStats():
+        mn = np.sum(band, axis=0, where=keep, dtype='f8') / nkeep
+        dev = band - mn
+        sd = np.sqrt(np.sum(dev*dev, axis=0, where=keep) / nkeep)
+        return mn, dev, sd
+
+    for i in range(niter):
+        mn, dev, sd = keptStats()
+        keep &= (np.abs(dev) < nsig*sd) | (sd == 0)
+        newKeep = keep.sum(axis=0)
+        if np.array_equal(newKeep, nkeep):
+            return mn
+        nkeep = newKeep
+
+    return keptStats()[0]
+
+# The combine functions, and roughly how many times the size of the band they need.
+_stackCombiners = dict(median=(_medianCombine, 2),
+                       mean=(_meanCombine, 1),
+                       clippedMean=(_clippedMeanCombine, 6))
+
+def combineImages(images, offsets=None, combine='median', dtype='f4', outDtype='f8',
+                  memoryBudget=512*1024*1024, nworkers=None, nsig=3.0, niter=5):
+    """ Combine a stack of images pixel by pixel, one band of rows at a time.
+
+    Args
+    ----
+    images : list of 2-d arrays
+        Anything which can be sliced by rows: ndarrays, np.load(mmap_mode='r')
+        arrays, or LazyImages. All must have the same shape.
+    offsets : list of numbers
+        If set, subtracted from each image before combining.
+    combine : {'median', 'mean', 'clippedMean'}
+        How to combine each pixel's values.
+    dtype : dtype
+        The type the images are stacked as.
+    outDtype : dtype
+        The type of the returned image.
+    memoryBudget : int
+        Roughly how many bytes to use for all the bands being combined.
+    nworkers : int
+        How many bands to combine at once. Default is up to 4.
+    nsig, niter : float, int
+        For 'clippedMean', the clipping parameters.
+
+    Returns
+    -------
+    image : ndarray
+    """
+
+    try:
+        combineFunc, memFactor = _stackCombiners[combine]
+    except KeyError:
+        raise RuntimeError("unknown combine method %s. Known: %s" % (combine, sorted(_stackCombiners)))
+
+    imshape = images[0].shape
+    for im in images:
+        if im.shape != imshape:
+            raise RuntimeError("image shape %s does not match %s" % (im.shape, imshape))
+    if offsets is None:
+        offsets = np.zeros(len(images), dtype='i8')
+
+    nrows, ncols = imshape
+    if nworkers is None:
+        nworkers = min(4, os.cpu_count() or 1)
+    bytesPerRow = len(images) * ncols * np.dtype(dtype).itemsize * (1 + memFactor)
+    bandRows = int(max(1, min(nrows, memoryBudget // (nworkers * bytesPerRow))))
+    logger = logging.getLogger('geom')
+    logger.info('combining %d images in bands of %d rows with %d workers', len(images), bandRows, nworkers)
+
+    stackimg = np.empty(imshape, dtype=outDtype)
+
+    def stackBand(y0):
+        y1 = min(y0 + bandRows, nrows)
+        band = np.empty((len(images), y1-y0, ncols), dtype=dtype)
+        for i, im in enumerate(images):
+            np.subtract(im[y0:y1], offsets[i], out=band[i], casting='unsafe')
+        stackimg[y0:y1] = combineFunc(band, nsig, niter)
+
+    with ThreadPoolExecutor(max_workers=nworkers) as pool:
+        for _ in pool.map(stackBand, range(0, nrows, bandRows)):
+            pass
+
+    return stackimg
+
+def clippedStack(flist, dtype='i4', combine='median', memoryBudget=512*1024*1024,
+                 nworkers=None, nsig=3.0, niter=5):
     """ Return the median of a stack of images.
 
+    Args
+    ----
+    flist : list of paths
+        The images to stack.
+    dtype : dtype
+        The type the median-subtracted images are stacked as.
+    combine : {'median', 'mean', 'clippedMean'}
+        How to combine each pixel's values.
+    memoryBudget : int
+        Roughly how many bytes to use for all the bands being combined.
+    nworkers : int
+        How many bands to combine at once. Default is up to 4.
+    nsig, niter : float, int
+        For 'clippedMean', the clipping parameters, as for clippedStatsBatch().
+
     Notes:
     
-    The individual images are median-subtracted before medianed together, and 
-    the median offset is added back to the result.
+    The individual images are median-subtracted before being combined.
 
     All images must match the images type and exposure time of the first image.
-    
-    """
 
-    exp = Exposure(flist[0], dtype=dtype)
-    imshape = exp.image.shape
-    imtype = exp.header['IMAGETYP']
-    exptime = exp.header['EXPTIME']
+    The images are memory-mapped, and combined in bands of rows which
+    fit within memoryBudget, so the full stack is never in memory.
+    """
 
-    stack = np.zeros((len(flist), imshape[0], imshape[1]), dtype=dtype)
-    meds = np.zeros(len(flist))
+    exps = [Exposure(f, lazy=True) for f in flist]
+    imshape = exps[0].imageShape
+    imtype = exps[0].header['IMAGETYP']
+    exptime = exps[0].header['EXPTIME']
 
-    for i, f in enumerate(flist):
-        exp = Exposure(f)
+    for f, exp in zip(flist, exps):
         if exp.header['IMAGETYP'] != imtype or exp.header['EXPTIME'] != exptime:
             print("%s: unexpected imagetyp: %s(%0.2f) vs %s(%0.2f)"
                   % (f, 
                      exp.header['IMAGETYP'], exp.header['EXPTIME'],
                      imtype, exptime))
-            
-        meds[i] = np.median(exp.image)
-        stack[i] = exp.image - int(meds[i])
+        if exp.imageShape != imshape:
+            raise RuntimeError("%s: image shape %s does not match %s" % (f, exp.imageShape, imshape))
 
-    medimg = np.median(stack, axis=0)
+    meds = np.array([imageMedian(exp.pixels) for exp in exps])
 
-    return Exposure(medimg)
-                                                                                                            
-def superBias(flist):
-    biasParts = bias.splitImage(doTrim=False)
-    coreBiasParts = bias.splitImage(doTrim=True)
+    stackimg = combineImages([exp.pixels for exp in exps], offsets=meds.astype('i8'),
+                             combine=combine, dtype=dtype, memoryBudget=memoryBudget,
+                             nworkers=nworkers, nsig=nsig, niter=niter)
 
-    newAmps = []
-    newOverCols = []
-        
-    for a_i in range(self.namps):
-        biasOffset = int(np.median(coreBiasParts[1][a_i]) - np.median(coreParts[1][a_i]))
-        
-        newAmps.append(parts[0][a_i] - (biasParts[0][a_i] - biasOffset))
-        newOverCols.append(parts[1][a_i] - (biasParts[1][a_i] - biasOffset))
+    return Exposure(stackimg)
+                                                                                                            
+def superBias(flist, **kwargs):
+    """ Return the master bias image for some bias files. See calib.masterBias() for the arguments. """
+
+    from fpga import calib
+
+    return loadCalibImage(calib.masterBias(flist, **kwargs))
+
+def loadCalibImage(calib):
+    """ Return a calibration image from a FITS path, an Exposure, or an ndarray. None passes through. """
+
+    if calib is None or isinstance(calib, np.ndarray):
+        return calib
+    if isinstance(calib, Exposure):
+        return calib.image
+    if isinstance(calib, (str, pathlib.Path)):
+        return pyfits.getdata(calib)
+    raise RuntimeError("do not know how to get a calibration image from a %s" % (type(calib)))
+
+def finalImage(exp, bias=None, dark=None, flat=None, model='row'):
+    """ Return the overscan-corrected and calibrated active image of an exposure.
+
+    Args
+    ----
+    exp : Exposure, path, or ndarray
+        The exposure.
+    bias, dark, flat : path, Exposure, or ndarray
+        The master frames, as from the calib module. The dark is in ADU/s,
+        and is scaled by the exposure's EXPTIME.
+    model : str
+        The overscan model, as for Exposure.overscanCorrect().
+
+    Returns
+    -------
+    image : f4 ndarray, (rows, namps*cols)
+    """
 
-    print(newAmps[0].shape, newOverCols[0].shape)
-    return newAmps, newOverCols
-        
-def finalImage(exp, bias=None, dark=None, flat=None):
-    exp = Exposure(exp)
-    return exp.biasSubtract(bias)
+    if not isinstance(exp, Exposure):
+        exp = Exposure(exp, lazy=True)
+    im = exp.overscanCorrect(model, dtype='f4')
+
+    bias = loadCalibImage(bias)
+    if bias is not None:
+        im -= bias
+    dark = loadCalibImage(dark)
+    if dark is not None:
+        if exp.expTime < 0:
+            raise RuntimeError("cannot dark-correct an exposure without an EXPTIME")
+        im -= dark * np.float32(exp.expTime)
+    flat = loadCalibImage(flat)
+    if flat is not None:
+        im /= flat
+
+    return im
     
 def constructImage(ampIms, osColIms=None, osRowIms=None):
     orderedIms = []
@@ -544,18 +1366,14 @@ def constructImage(ampIms, osColIms=None, osRowIms=None):
 def normAmpLevels(exp, fullCol=False):
     """ Using the overscan region, crudely normalize all amps to min=0. """
 
-    retexp = Exposure(exp, copyExposure=True, dtype='f4')
+    if not isinstance(exp, Exposure):
+        exp = Exposure(exp)
 
-    for i in range(retexp.namps):
-        yr,xr = retexp.ampExtents(i, leadingCols=True, leadingRows=True, overscan=True)
-
-        overscanImage = retexp.overscanColImage(i, leadingRows=True, overscanRows=True)
-
-        if fullCol:
-            overscanMed = np.mean(overscanImage, axis=1)[:, np.newaxis]
-            retexp.image[:,xr] -= overscanMed
-        else:
-            overscanLevel = int(np.rint(np.median(overscanImage)))
-            retexp.image[yr,xr] -= overscanLevel
+    if fullCol:
+        levels = exp.overscanLevels('row', leadingRows=True, overscanRows=True,
+                                    colTrim=0, stat='mean')
+    else:
+        levels = np.rint(exp.overscanLevels('scalar', leadingRows=True, overscanRows=True,
+                                            rowTrim=0, colTrim=0))
 
-    return retexp.image
+    return exp.overscanCorrect(region='full', dtype='f4', levels=levels)
@@ -0,0 +1,287 @@
+""" Build FITS headers from compiled templates, reformatting only the values which change.
+
+The cards are written in the given order: unlike Header.append(),
+commentary cards are not moved to the end.
+
+The cards written for each exposure are nearly always the same
+keywords, in the same order, with the same comments. A HeaderTemplate
+is compiled from one such list of cards: it keeps each card's
+80-character image, and the fixed keyword and comment parts around
+the value. Filling the template with a later list of cards only
+formats the values which differ from the previous ones, and
+concatenates the images: no astropy Cards are made. fitsWriter writes
+such a string directly into plain uint16 image files; build() parses
+it into a pyfits.Header for anything else.
+
+Values are formatted exactly as astropy formats them. A card which
+the fast formatting cannot reproduce (long strings, commentary cards,
+anything whose compiled image did not match) is formatted by astropy
+each time its value changes.
+
+HeaderBuilder keeps the templates for the card lists it has seen, so
+a change of configuration (a different set of cards) just compiles
+another template.
+
+Examples
+--------
+
+>>> builder = headerTemplate.HeaderBuilder()
+>>> hdr = builder.build(cards)
+>>> builder.compare(cards)
+[]
+"""
+
+import logging
+import math
+
+import numpy as np
+
+import astropy.io.fits as pyfits
+
+logger = logging.getLogger('headerTemplate')
+
+_intTypes = (int, np.integer)
+_floatTypes = (float, np.floating)
+
+def cardParts(card):
+    """ Return the keyword, value and comment of a card, or of a (keyword, value[, comment]) tuple. """
+
+    if isinstance(card, pyfits.Card):
+        return card.keyword, card.value, card.comment
+    if len(card) == 2:
+        return card[0], card[1], ''
+    return card[0], card[1], card[2]
+
+def formatValue(value, hierarch=False):
+    """ Format a card value as astropy does, or return None if we cannot. """
+
+    if isinstance(value, str):
+        if not value:
+            valStr = "''"
+        elif not (value.isascii() and value.isprintable()):
+            return None
+        else:
+            valStr = "%-20s" % ("'%-8s'" % (value.replace("'", "''")))
+    elif isinstance(value, (bool, np.bool_)):
+        valStr = "%20s" % ('T' if value else 'F')
+    elif isinstance(value, _intTypes):
+        valStr = "%20d" % (value)
+    elif isinstance(value, _floatTypes):
+        if not math.isfinite(value):
+            return None
+        valStr = str(value).replace('e', 'E')
+        if len(valStr) > 20:
+            idx = valStr.find('E')
+            if idx < 0:
+                valStr = valStr[:20]
+            else:
+                valStr = valStr[:20 - (len(valStr) - idx)] + valStr[idx:]
+        valStr = "%20s" % (valStr)
+    else:
+        return None
+
+    if hierarch:
+        valStr = valStr.strip()
+    return valStr
+
+class HeaderTemplate(object):
+    def __init__(self, cards):
+        """ Compile a list of cards: their order, keywords and comments are fixed from now on.
+
+        Args
+        ----
+        cards : list of pyfits.Card or tuples
+           As for Header.append().
+        """
+
+        self.identity = self.cardIdentity(cards)
+        self.nCards = len(cards)
+        self.values = [None] * self.nCards
+        self.images = [''] * self.nCards
+        self.prefixes = [None] * self.nCards
+        self.suffixes = [None] * self.nCards
+        self.hierarch = [False] * self.nCards
+
+        for c_i, card in enumerate(cards):
+            keyword, value, comment = cardParts(card)
+            image = self._astropyImage(card)
+            self.values[c_i] = value
+            self.images[c_i] = image
+            if len(image) != 80:
+                continue
+
+            if image.startswith('HIERARCH '):
+                if keyword.startswith('HIERARCH '):
+                    keyword = keyword[9:]
+                prefix = 'HIERARCH %s = ' % (keyword)
+            else:
+                prefix = "%-8s= " % (keyword.upper())
+            # astropy only squeezes the values of keywords which need HIERARCH.
+            hierarch = len(keyword) > 8
+            suffix = ' / %s' % (comment) if comment else ''
+            if self._fastImage(prefix, suffix, value, hierarch) == image:
+                self.prefixes[c_i] = prefix
+                self.suffixes[c_i] = suffix
+                self.hierarch[c_i] = hierarch
+
+    def __str__(self):
+        nFast = sum(p is not None for p in self.prefixes)
+        return "HeaderTemplate(cards=%d, fast=%d)" % (self.nCards, nFast)
+
+    @staticmethod
+    def cardIdentity(cards):
+        """ Return what must match for a template to be reused: the keywords and comments, in order. """
+
+        identity = []
+        for card in cards:
+            keyword, value, comment = cardParts(card)
+            identity.append((keyword, comment))
+        return tuple(identity)
+
+    @staticmethod
+    def _fastImage(prefix, suffix, value, hierarch):
+        valStr = formatValue(value, hierarch=hierarch)
+        if valStr is None:
+            return None
+        image = prefix + valStr + suffix
+        if len(image) > 80:
+            return None
+        return "%-80s" % (image)
+
+    @staticmethod
+    def _astropyImage(card):
+        """ Return astropy's image for a card, possibly several 80-char cards, or '' if astropy rejects it. """
+
+        try:
+            if not isinstance(card, pyfits.Card):
+                card = pyfits.Card(*card)
+            return card.image
+        except Exception as e:
+            logger.warning("failed to add card to header: %s", e)
+            logger.warning("failed card: %r", card)
+            return ''
+
+    def fill(self, cards):
+        """ Return the header cards as one string, reformatting only the changed values.
+
+        The cards must have this template's identity.
+
+        Returns
+        -------
+        text : str
+           The card images, without END or padding.
+        nChanged : int
+           The number of values reformatted.
+        """
+
+        values = self.values
+        images = self.images
+        nChanged = 0
+        for c_i, card in enumerate(cards):
+            if isinstance(card, pyfits.Card):
+                value = card.value
+            else:
+                value = card[1]
+            old = values[c_i]
+            if type(value) is type(old) and value == old:
+                continue
+
+            nChanged += 1
+            values[c_i] = value
+            image = None
+            prefix = self.prefixes[c_i]
+            if prefix is not None:
+                image = self._fastImage(prefix, self.suffixes[c_i], value, self.hierarch[c_i])
+            if image is None:
+                image = self._astropyImage(card)
+            images[c_i] = image
+
+        return ''.join(images), nChanged
+
+class HeaderBuilder(object):
+    def __init__(self, maxTemplates=8):
+        """ Build headers, compiling a HeaderTemplate for each new list of keywords.
+
+        Args
+        ----
+        maxTemplates : int
+           The most templates kept. The least recently used is dropped.
+        """
+
+        self.logger = logging.getLogger('headerTemplate')
+        self.maxTemplates = maxTemplates
+        self.templates = dict()
+
+        self.nBuilt = 0
+        self.nCompiled = 0
+        self.nChanged = 0
+        self.nCards = 0
+
+    def __str__(self):
+        return ("HeaderBuilder(templates=%d, built=%d, compiled=%d)" %
+                (len(self.templates), self.nBuilt, self.nCompiled))
+
+    def template(self, cards):
+        """ Return the template for a list of cards, compiling it if it is new. """
+
+        identity = HeaderTemplate.cardIdentity(cards)
+        template = self.templates.pop(identity, None)
+        if template is None:
+            template = HeaderTemplate(cards)
+            self.nCompiled += 1
+            self.logger.debug('compiled %s', template)
+            if len(self.templates) >= self.maxTemplates:
+                del self.templates[next(iter(self.templates))]
+        self.templates[identity] = template
+        return template
+
+    def buildString(self, cards):
+        """ Return the header cards as one string, without END or padding. """
+
+        cards = list(cards)
+        template = self.template(cards)
+        text, nChanged = template.fill(cards)
+
+        self.nBuilt += 1
+        self.nChanged += nChanged
+        self.nCards += len(cards)
+        return text
+
+    def build(self, cards):
+        """ Return a pyfits.Header for a list of cards. """
+
+        return pyfits.Header.fromstring(self.buildString(cards))
+
+    def compare(self, cards):
+        """ Check our header against one built card by card by astropy.
+
+        Returns
+        -------
+        mismatches : list of (ours, astropys)
+           The differing 80-char cards.
+        """
+
+        cards = list(cards)
+        ours = self.buildString(cards)
+        hdr = pyfits.Header()
+        for card in cards:
+            try:
+                hdr.append(card, bottom=True)
+            except Exception:
+                pass
+        theirs = hdr.tostring(endcard=False, padding=False)
+
+        oursCards = [ours[i:i+80] for i in range(0, len(ours), 80)]
+        theirCards = [theirs[i:i+80] for i in range(0, len(theirs), 80)]
+        mismatches = [(a, b) for a, b in zip(oursCards, theirCards) if a != b]
+        if len(oursCards) != len(theirCards):
+            mismatches.append(('%d cards' % (len(oursCards)), '%d cards' % (len(theirCards))))
+        return mismatches
+
+    def metrics(self):
+        """ Return how many headers were built, and what fraction of their values had to be reformatted. """
+
+        return dict(built=self.nBuilt,
+                    compiled=self.nCompiled,
+                    templates=len(self.templates),
+                    changedFraction=self.nChanged/self.nCards if self.nCards else None)
@@ -482,10 +482,9 @@ def tuneLevels(ccd, fee, amps=None,
     offsets[amps] = startOffset.copy()
     if doZero:
         fee.zeroOffsets(amps)
-    if 'n' in legs:
-        fee.setOffsets(amps, offsets[amps], leg='n')
-    if 'p' in legs:
-        fee.setOffsets(amps, -offsets[amps], leg='p')
+    fee.setAllOffsets(amps,
+                      n=offsets[amps] if 'n' in legs else None,
+                      p=-offsets[amps] if 'p' in legs else None)
     time.sleep(sleepTime)
 
     done = np.ones(nAllAmps, dtype='i1')
@@ -585,10 +584,9 @@ def tuneLevels(ccd, fee, amps=None,
         
         lastOffset = thisOffset.copy()
         # lastLevels = newLevels
-        if 'n' in legs:
-            fee.setOffsets(amps, offsets[amps], leg='n')
-        if 'p' in legs:
-            fee.setOffsets(amps, -offsets[amps], leg='p')
+        fee.setAllOffsets(amps,
+                          n=offsets[amps] if 'n' in legs else None,
+                          p=-offsets[amps] if 'p' in legs else None)
         time.sleep(sleepTime)
         
     return offsets, devs, gains
@@ -619,8 +617,7 @@ def gainCurve(ccd=None, fee=None, amps=None,
     offset = 0.0
     while np.fabs(offset) <= offLimit:
         offsets.append(offset)
-        fee.setOffsets(amps, [offset]*namps, leg=leg)
-        fee.setOffsets(amps, [0.0]*namps, leg=otherLeg)
+        fee.setAllOffsets(amps, **{leg:[offset]*namps, otherLeg:[0.0]*namps})
         time.sleep(sleepTime)
 
         im, files = ccdFuncs.fullExposure('bias', ccd=ccd, feeControl=fee,
@@ -7,6 +7,7 @@ import numpy
 from importlib import reload
 
 import clocks
+from clocks import progfile
 
 from cython cimport view
 from libc.stdint cimport uint16_t, uint32_t
@@ -31,6 +32,7 @@ cdef extern from "fpga.h":
 
      int sendAllOpcodes(uint32_t *states, uint16_t *durations, int cnt)
      int sendOneOpcode(uint32_t states, uint16_t duration)
+     int sendProgram(const uint32_t *words, int cnt)
 
      int resetReadout(int force)
      int armReadout(int nrows, int doTest, int ard18bit)
@@ -91,24 +93,34 @@ cdef class FPGA:
         return resetReadout(1 if force else 0)
         
     def configureReadout(self, nrows, ncols, doTest=False,
-                         clockFunc=None, rowBinning=1):
+                         clockFunc=None, rowBinning=1, colBinning=1,
+                         program=None):
 
         """ Configure the detector for a readout.
 
+        nrows and ncols are the number of (possibly binned) rows and
+        per-amp columns to read.
+
+        If program is set, it is a precompiled (ticks, opcodes, rowTime)
+        row program, as from clocks.genRowClocks or a readout preset,
+        and clockFunc and the binning are ignored.
+
         Returns:
            Expected readout time (s).
         """
         
-        if clockFunc is None:
+        if clockFunc is None and program is None:
             raise RuntimeError("Must specify clocking")
         if not self.resetReadout(0):
             raise RuntimeError("failed to reset for readout")
 
-        ticks, opcodes, readTime = clocks.genRowClocks(ncols, clockFunc, rowBinning=rowBinning)
-        for i in range(len(ticks)):
-            ret = sendOneOpcode(opcodes[i], ticks[i])
-            if not ret:
-                raise RuntimeError("failed to send opcode %d" % (i))
+        if program is None:
+            program = clocks.genRowClocks(ncols, clockFunc,
+                                          rowBinning=rowBinning,
+                                          colBinning=colBinning)
+        ticks, opcodes, readTime = program
+        if not self.sendProgram(progfile.packProgram(ticks, opcodes)):
+            raise RuntimeError("failed to send program of %d opcodes" % (len(ticks)))
 
         if not armReadout(nrows, doTest, self.adc18bit):
             raise RuntimeError("failed to arm for readout)")
@@ -123,6 +135,14 @@ cdef class FPGA:
     
     def sendOneOpcode(self, int opcode, int ticks):
         return sendOneOpcode(opcode, ticks)
+
+    def sendProgram(self, words):
+        """ Load a complete packed program (states | duration) into the block RAM, in one call. """
+
+        cdef uint32_t[::1] wordView = numpy.ascontiguousarray(words, dtype=numpy.uint32)
+        if len(wordView) == 0:
+            raise RuntimeError("cannot send an empty program")
+        return sendProgram(&wordView[0], len(wordView))
         
     cpdef _readImage(self, int nrows=-1, int ncols=-1,  
                      doTest=False, debugLevel=1, 
@@ -0,0 +1,260 @@
+""" Batch-reduce raw exposures: overscan correction, trimming, and optional bias subtraction.
+
+The files are reduced by a pool of processes, with a bounded number of
+files in flight at once. Each output gets provenance cards, including a
+key made from the input file, the master bias, and the parameters. A
+file whose output already has the same key is skipped, so an
+interrupted run can just be restarted.
+
+Examples
+--------
+
+  reduce --outdir /data/reduced/2019-04-01 /data/pfs/2019-04-01/PFJA*.fits
+  reduce --outdir red --bias masterBias-0123456789abcdef.fits --list files.txt
+  reduce --outdir red --logbook darks --ccd b9 --imagetyp dark
+"""
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import glob
+import logging
+import os
+import re
+import sys
+import time
+
+import numpy as np
+
+import astropy.io.fits as pyfits
+
+from fpga import calib
+from fpga import geom
+
+logger = logging.getLogger('reduce')
+
+# Bump when the reduction changes, to force all outputs to be remade.
+reduceVersion = 1
+
+# The raw header cards which describe the raw file's layout, compression
+# or checksums, and which must not be copied to the reduced file.
+_rawOnlyCards = re.compile(r'^(SIMPLE|BITPIX|NAXIS\d*|EXTEND|BZERO|BSCALE|XTENSION|PCOUNT|GCOUNT'
+                           r'|CHECKSUM|DATASUM|TFIELDS|TTYPE\d+|TFORM\d+|THEAP'
+                           r'|Z(IMAGE|SIMPLE|EXTEND|BLOCKED|TENSION|BITPIX|NAXIS\d*|PCOUNT|GCOUNT'
+                           r'|TILE\d+|CMPTYPE|NAME\d+|VAL\d+|QUANTIZ|DITHER0|HECKSUM|DATASUM))$')
+
+# The master calibrations, per worker process.
+_calibImages = dict()
+
+def _calibImage(path):
+    if path is None:
+        return None
+    if path not in _calibImages:
+        _calibImages[path] = geom.loadCalibImage(path).astype('f4')
+    return _calibImages[path]
+
+def outputPath(path, outDir):
+    root, _ = os.path.splitext(os.path.basename(path))
+    return os.path.join(outDir, '%s_red.fits' % (root))
+
+def reduceKey(path, bias=None, model='row'):
+    """ Return the provenance key for reducing path with the given bias and parameters. """
+
+    return calib.productKey('reduce', [path], dict(model=model, version=reduceVersion),
+                            depends=(bias,))
+
+def isUpToDate(outPath, key):
+    """ Whether outPath exists and was made from the same inputs and parameters. """
+
+    if not os.path.exists(outPath):
+        return False
+    try:
+        return pyfits.getval(outPath, 'RED_KEY') == key
+    except (OSError, KeyError):
+        return False
+
+def reduceFile(path, outPath, bias=None, model='row'):
+    """ Reduce one raw exposure into outPath. Runs in the worker processes.
+
+    Returns
+    -------
+    (path, outPath, seconds)
+    """
+
+    t0 = time.time()
+    exp = geom.Exposure(path, lazy=True)
+    im = geom.finalImage(exp, bias=_calibImage(bias), model=model)
+
+    hdr = pyfits.Header([card for card in exp.header.cards
+                         if not _rawOnlyCards.match(card.keyword)])
+    hdr['RED_KEY'] = (reduceKey(path, bias=bias, model=model), 'hash of inputs and params')
+    hdr['RED_VERS'] = (reduceVersion, 'reduction version')
+    hdr['RED_DATE'] = (time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()), 'UTC time of reduction')
+    hdr['RED_MODL'] = (model, 'overscan model')
+    hdr['HIERARCH reduce.input'] = os.path.abspath(path)
+    hdr['HIERARCH reduce.bias'] = os.path.abspath(bias) if bias else 'none'
+
+    tmpPath = outPath + '.tmp'
+    pyfits.PrimaryHDU(im, header=hdr).writeto(tmpPath, overwrite=True, checksum=True)
+    os.replace(tmpPath, outPath)
+
+    return path, outPath, time.time() - t0
+
+def expandInputs(patterns=(), listFile=None):
+    """ Return the sorted, unique files matching some paths or glob patterns, and those in listFile. """
+
+    files = []
+    for pattern in patterns:
+        matches = glob.glob(pattern)
+        if not matches:
+            logger.warning('no files match %s', pattern)
+        files.extend(matches)
+    if listFile is not None:
+        with open(listFile) as f:
+            files.extend(line.strip() for line in f
+                         if line.strip() and not line.startswith('#'))
+
+    return sorted(set(files))
+
+def logbookFiles(sequence, ccd, experiment=None, imagetyp=None):
+    """ Return the files from a logbook experiment. """
+
+    from testing.logbook import retrieveExposures
+
+    exposures = retrieveExposures(sequence, ccd, experiment=experiment)
+    if imagetyp is not None:
+        exposures = exposures[exposures.exptype == imagetyp]
+    return list(exposures.filepath)
+
+def reduceFiles(files, outDir, bias=None, model='row', nprocs=None, maxInFlight=None,
+                force=False):
+    """ Reduce many files with a process pool.
+
+    Args
+    ----
+    files : list of paths
+        The raw exposures.
+    outDir : str
+        Where to write the reduced files.
+    bias : path
+        A master bias to subtract, as from calib.masterBias().
+    model : str
+        The overscan model, as for Exposure.overscanCorrect().
+    nprocs : int
+        The number of worker processes. Default is all cores.
+    maxInFlight : int
+        The most files being reduced or waiting to be, which bounds the
+        memory used. Default is 2*nprocs.
+    force : bool
+        Reduce files even if their outputs are up to date.
+
+    Returns
+    -------
+    dict with lists of 'reduced', 'skipped', and 'failed' input files.
+    """
+
+    os.makedirs(outDir, exist_ok=True)
+    if nprocs is None:
+        nprocs = os.cpu_count() or 1
+    if maxInFlight is None:
+        maxInFlight = 2*nprocs
+
+    results = dict(reduced=[], skipped=[], failed=[])
+    todo = []
+    for path in files:
+        outPath = outputPath(path, outDir)
+        if os.path.abspath(outPath) == os.path.abspath(path):
+            raise RuntimeError("output %s would overwrite its input" % (outPath))
+        if not force and isUpToDate(outPath, reduceKey(path, bias=bias, model=model)):
+            results['skipped'].append(path)
+        else:
+            todo.append((path, outPath))
+    logger.info('%d files to reduce, %d up to date, with %d processes',
+                len(todo), len(results['skipped']), nprocs)
+
+    t0 = time.time()
+    with ProcessPoolExecutor(max_workers=nprocs) as pool:
+        pending = dict()
+        todo = iter(todo)
+        while True:
+            for path, outPath in todo:
+                future = pool.submit(reduceFile, path, outPath, bias=bias, model=model)
+                pending[future] = path
+                if len(pending) >= maxInFlight:
+                    break
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    _, outPath, dt = future.result()
+                    results['reduced'].append(path)
+                    logger.info('reduced %s to %s in %0.1fs', path, outPath, dt)
+                except Exception as e:
+                    results['failed'].append(path)
+                    logger.error('failed to reduce %s: %s', path, e)
+
+    logger.info('reduced %d files in %0.1fs; %d skipped, %d failed',
+                len(results['reduced']), time.time() - t0,
+                len(results['skipped']), len(results['failed']))
+    return results
+
+def main(argv=None):
+    import argparse
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if isinstance(argv, str):
+        argv = argv.split()
+
+    parser = argparse.ArgumentParser(description="Reduce raw exposures: overscan correct, trim, and subtract a master bias.")
+    parser.add_argument('files', nargs='*',
+                        help='files or glob patterns to reduce')
+    parser.add_argument('--list', type=str, default=None,
+                        help='a file listing more files, one per line')
+    parser.add_argument('--logbook', type=str, default=None,
+                        help='a logbook sequence (e.g. biases) to reduce the files of. Requires --ccd')
+    parser.add_argument('--ccd', type=str, default=None,
+                        help='the logbook ccd name, e.g. b9')
+    parser.add_argument('--experiment', type=int, default=None,
+                        help='the logbook experiment. Default is the latest.')
+    parser.add_argument('--imagetyp', type=str, default=None,
+                        help='only reduce logbook exposures of this type')
+    parser.add_argument('--outdir', type=str, required=True,
+                        help='where to write the reduced files')
+    parser.add_argument('--bias', type=str, default=None,
+                        help='a master bias file to subtract')
+    parser.add_argument('--model', type=str, default='row',
+                        choices=('scalar', 'row', 'smooth'),
+                        help='the overscan model')
+    parser.add_argument('--nprocs', type=int, default=None,
+                        help='the number of processes. Default is all cores')
+    parser.add_argument('--maxInFlight', type=int, default=None,
+                        help='the most files in flight at once. Default is 2*nprocs')
+    parser.add_argument('--force', action='store_true',
+                        help='reduce files even if their outputs are up to date')
+    parser.add_argument('--debug', action='store_true',
+                        help='print more stuff')
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    files = expandInputs(args.files, listFile=args.list)
+    if args.logbook is not None:
+        if args.ccd is None:
+            parser.error('--logbook requires --ccd')
+        files = sorted(set(files) | set(logbookFiles(args.logbook, args.ccd,
+                                                     experiment=args.experiment,
+                                                     imagetyp=args.imagetyp)))
+    if not files:
+        parser.error('no files to reduce')
+
+    return reduceFiles(files, args.outdir, bias=args.bias, model=args.model,
+                       nprocs=args.nprocs, maxInFlight=args.maxInFlight,
+                       force=args.force)
+
+if __name__ == "__main__":
+    results = main()
+    sys.exit(1 if results['failed'] else 0)
@@ -0,0 +1,183 @@
+""" Write losslessly tile-compressed FITS images, compressing the tiles in parallel.
+
+The output is a standard tiled-image compression binary table, as
+written by fpack or pyfits.CompImageHDU, so pyfits, fitsio and cfitsio
+read it transparently. pyfits' CompImageHDU.section only decompresses
+the tiles a slice touches, which geom.Exposure(lazy=True) uses.
+
+Tiles are bands of full-width rows. The Rice coder releases the GIL and
+is reentrant, so RICE_1 tiles are compressed by a thread pool. cfitsio's
+HCOMPRESS coder keeps static state, so HCOMPRESS_1 tiles are compressed
+one at a time. Only lossless integer compression is done here; other
+image types fall back to pyfits.CompImageHDU.
+
+The tile coders are astropy's private codec classes, so they are only
+used with the astropy versions they have been checked against. With
+any other version, all images are compressed by pyfits.CompImageHDU.
+
+HCOMPRESS needs every tile, including the last, partial one, to be at
+least 4x4 pixels. The tile height is adjusted to leave no short last
+tile; images which cannot be tiled that way are RICE_1 compressed.
+
+Examples
+--------
+
+>>> tileCompress.writeCompressed('PFJA00012345.fits', im, hdr, compression='RICE_1')
+>>> pyfits.open('PFJA00012345.fits')[-1].section[2000:2100, 0:520]
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+
+import numpy as np
+
+import astropy
+import astropy.io.fits as pyfits
+
+logger = logging.getLogger('tileCompress')
+
+# The astropy versions, [min, max), whose private tile codecs we use.
+_codecVersions = ((8, 0), (9, 0))
+
+def _astropyVersion():
+    try:
+        return tuple(int(v) for v in astropy.__version__.split('.')[:2])
+    except ValueError:
+        return None
+
+Rice1 = HCompress1 = None
+if _astropyVersion() is not None and _codecVersions[0] <= _astropyVersion() < _codecVersions[1]:
+    try:
+        from astropy.io.fits.hdu.compressed._codecs import Rice1, HCompress1
+    except ImportError:
+        pass
+
+compressionTypes = ('RICE_1', 'HCOMPRESS_1')
+
+# Cards which describe the uncompressed image's layout, and which we must not copy.
+_structuralCards = {'SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2',
+                    'EXTEND', 'PCOUNT', 'GCOUNT', 'BZERO', 'BSCALE',
+                    'CHECKSUM', 'DATASUM'}
+
+def _storedPixels(im):
+    """ Return the pixels as FITS stores them, with the BZERO and bytepix to record. """
+
+    if im.dtype == np.dtype('u2'):
+        return (im ^ np.uint16(0x8000)).view('i2'), 32768, 2
+    if im.dtype.kind == 'i' and im.dtype.itemsize in {2, 4}:
+        return im.astype(im.dtype.newbyteorder('='), copy=False), 0, im.dtype.itemsize
+    return None, None, None
+
+def _tileCodec(compression, tile, bytepix):
+    if compression == 'RICE_1':
+        return Rice1(blocksize=32, bytepix=bytepix, tilesize=tile.size)
+    return HCompress1(scale=0, smooth=0, bytepix=8, nx=tile.shape[0], ny=tile.shape[1])
+
+def _hcompressTileRows(nrows, ncols, tileRows):
+    """ Return the tile height nearest tileRows which leaves no tile shorter than 4 rows, or None. """
+
+    if nrows < 4 or ncols < 4:
+        return None
+    for dt in range(nrows):
+        for t in (tileRows + dt, tileRows - dt):
+            if 4 <= t <= nrows and (nrows % t == 0 or nrows % t >= 4):
+                return t
+    return None
+
+def compressedHDU(im, header=None, compression='RICE_1', tileRows=16, nthreads=None):
+    """ Return a losslessly tile-compressed HDU for an image.
+
+    Args
+    ----
+    im : 2-d ndarray
+        The image. u2, i2 and i4 images are compressed by us; anything else
+        by pyfits.CompImageHDU.
+    header : pyfits.Header
+        The image's cards. Structural cards are replaced.
+    compression : {'RICE_1', 'HCOMPRESS_1'}
+        The lossless compression algorithm.
+    tileRows : int
+        The number of rows in each tile. HCOMPRESS_1 may adjust it, see above.
+    nthreads : int
+        The number of threads compressing RICE_1 tiles. Default is up to 4.
+
+    Returns
+    -------
+    hdu : pyfits.BinTableHDU or pyfits.CompImageHDU
+        To be written as an extension.
+    """
+
+    if compression not in compressionTypes:
+        raise RuntimeError("unknown compression %s. Known: %s" % (compression, compressionTypes))
+    if header is None:
+        header = pyfits.Header()
+    nrows, ncols = im.shape
+    tileRows = max(1, min(tileRows, nrows))
+    if compression == 'HCOMPRESS_1':
+        hcompressRows = _hcompressTileRows(nrows, ncols, tileRows)
+        if hcompressRows is None:
+            logger.warn('cannot HCOMPRESS a %dx%d image; using RICE_1', nrows, ncols)
+            compression = 'RICE_1'
+        else:
+            tileRows = hcompressRows
+
+    stored, bzero, bytepix = _storedPixels(im)
+    if stored is None or Rice1 is None:
+        logger.debug('compressing %s image with pyfits.CompImageHDU', im.dtype)
+        return pyfits.CompImageHDU(im, header=header, compression_type=compression,
+                                   tile_shape=(tileRows, ncols))
+
+    def compressTile(y0):
+        tile = np.ascontiguousarray(stored[y0:y0+tileRows])
+        return _tileCodec(compression, tile, bytepix).encode(tile)
+
+    starts = range(0, nrows, tileRows)
+    if compression == 'RICE_1':
+        if nthreads is None:
+            nthreads = min(4, os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            tiles = list(pool.map(compressTile, starts))
+    else:
+        tiles = [compressTile(y0) for y0 in starts]
+
+    heap = np.empty(len(tiles), dtype=object)
+    heap[:] = [np.frombuffer(t, dtype='u1') for t in tiles]
+    hdu = pyfits.BinTableHDU.from_columns([pyfits.Column(name='COMPRESSED_DATA',
+                                                         format='1PB()', array=heap)])
+
+    hdr = hdu.header
+    hdr['ZIMAGE'] = (True, 'extension contains compressed image')
+    hdr['ZTENSION'] = ('IMAGE', 'image extension')
+    hdr['ZBITPIX'] = (8*bytepix, 'data type of original image')
+    hdr['ZNAXIS'] = (2, 'dimension of original image')
+    hdr['ZNAXIS1'] = (ncols, 'length of original image axis')
+    hdr['ZNAXIS2'] = (nrows, 'length of original image axis')
+    hdr['ZPCOUNT'] = 0
+    hdr['ZGCOUNT'] = 1
+    hdr['ZTILE1'] = (ncols, 'size of tiles to be compressed')
+    hdr['ZTILE2'] = (tileRows, 'size of tiles to be compressed')
+    hdr['ZCMPTYPE'] = (compression, 'compression algorithm')
+    if compression == 'RICE_1':
+        hdr['ZNAME1'], hdr['ZVAL1'] = 'BLOCKSIZE', 32
+        hdr['ZNAME2'], hdr['ZVAL2'] = 'BYTEPIX', bytepix
+    else:
+        hdr['ZNAME1'], hdr['ZVAL1'] = 'SCALE', 0
+        hdr['ZNAME2'], hdr['ZVAL2'] = 'SMOOTH', 0
+    if bzero:
+        hdr['BZERO'] = bzero
+        hdr['BSCALE'] = 1
+
+    for card in header.cards:
+        if card.keyword not in _structuralCards:
+            hdr.append(card)
+
+    return hdu
+
+def writeCompressed(path, im, header=None, compression='RICE_1', tileRows=16,
+                    nthreads=None, checksum=True):
+    """ Write an image to a FITS file as a tile-compressed extension. See compressedHDU(). """
+
+    hdu = compressedHDU(im, header=header, compression=compression,
+                        tileRows=tileRows, nthreads=nthreads)
+    pyfits.HDUList([pyfits.PrimaryHDU(), hdu]).writeto(path, checksum=checksum)
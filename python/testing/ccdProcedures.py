@@ -4,13 +4,15 @@ import numpy as np
 import time
 
 import fpga.geom as geom
+import fpga.calib as calib
 
 import fpga.ccdFuncs as ccdFuncs
 import fpga.opticslab as opticslab
-from testing.logbook import storeExposures
+from testing.logbook import storeExposures, retrieveExposures
 from testing.scopeProcedures import calcOffsets1
 
 reload(geom)
+reload(calib)
 reload(ccdFuncs)
 reload(opticslab)
 
@@ -52,6 +54,40 @@ def stdExposures_base(ccd=None, feeControl=None, comment=None):
     return files
     
     
+def buildMasters(ccd, biasExperiment=None, darkExperiment=None, flatExperiment=None,
+                 withFlat=True, **kwargs):
+    """ Build the master calibrations from the logbook's standard sequences.
+
+    Args
+    ----
+    ccd : str
+       The logbook's ccd name, e.g. 'b9'
+    biasExperiment, darkExperiment, flatExperiment : int
+       The logbook experiments to use. Default is the latest of each sequence.
+    withFlat : bool
+       Whether to build the flat, from the master_flats sequence.
+    kwargs
+       Passed on to calib.buildMaster(), e.g. cacheDir, nprocs
+
+    Returns
+    -------
+    dict of product paths, by kind.
+    """
+
+    def sequenceFiles(sequence, exptype, experiment):
+        exposures = retrieveExposures(sequence, ccd, experiment=experiment)
+        return list(exposures.filepath[exposures.exptype == exptype])
+
+    products = dict()
+    products['bias'] = calib.masterBias(sequenceFiles('biases', 'bias', biasExperiment), **kwargs)
+    products['dark'] = calib.masterDark(sequenceFiles('darks', 'dark', darkExperiment),
+                                        bias=products['bias'], **kwargs)
+    if withFlat:
+        products['flat'] = calib.masterFlat(sequenceFiles('master_flats', 'flat', flatExperiment),
+                                            bias=products['bias'], dark=products['dark'], **kwargs)
+
+    return products
+
 def stdExposures_hours(ccd=None, feeControl=None, hours=4, comment=None):
     darkTime = 900
     files = []
@@ -94,8 +130,7 @@ def tuneOffsets(ccd=None, feeControl=None):
     print("applying master: %s" % (m))
     print("applying refs  : %s" % (r))
 
-    feeControl.setOffsets(amps, m, leg='n', doSave=False)
-    feeControl.setOffsets(amps, r, leg='p', doSave=True)
+    feeControl.setAllOffsets(amps, n=m, p=r)
     feeControl.setMode('offset')
     
     im, fname = ccdFuncs.fullExposure('bias', ccd=ccd,
@@ -544,7 +579,7 @@ def CTEStats(flist, bias, amps=None, useCols=None):
 
     # preload the files
     for f_i, fname in enumerate(flist):
-        exp = geom.Exposure(fname)
+        exp = geom.Exposure(fname, lazy=True)
 
         if f_i == 0:
             expTime = exp.expTime
@@ -564,7 +599,7 @@ def CTEStats(flist, bias, amps=None, useCols=None):
 
     if amps is None:
         amps = list(range(exp.namps))
-    biasexp = geom.Exposure(bias)
+    biasexp = geom.Exposure(bias, lazy=True)
     for a_i in amps:
     
         # Load the bias parts once.
@@ -660,47 +695,52 @@ statDtype = ([('amp', 'i2'),
 
 def areaStats(ampIm, osIm, exptime, ampNum=-1,
               hdr=None, asBias=False):
-    
-    stats = np.zeros(shape=(1,),
+    """ Return the statDtype stats for one amp, or for a (namps, rows, cols) stack of amps. """
+
+    ampIm = np.asarray(ampIm)
+    osIm = np.asarray(osIm)
+    namps = 1 if ampIm.ndim == 2 else ampIm.shape[0]
+    ampPix = ampIm.reshape(namps, -1)
+    osPix = osIm.reshape(namps, -1)
+
+    stats = np.zeros(shape=(namps,),
                      dtype=statDtype)
-    a_i = 0
 
-    stats[a_i]['amp'] = ampNum
-    stats[a_i]['npix'] = ampIm.size
+    stats['amp'] = ampNum
+    stats['npix'] = ampPix.shape[1]
 
-    ampSig = np.median(ampIm)
-    osSig = np.median(osIm)
-    if osSig is np.nan:
-        osSig = 0
-    stats[a_i]['adus'] = ampSig
-    stats[a_i]['signal'] = signal = ampSig - osSig
+    ampSig = np.median(ampPix, axis=1)
+    osSig = np.median(osPix, axis=1)
+    osSig[np.isnan(osSig)] = 0
+    stats['adus'] = ampSig
+    stats['signal'] = signal = ampSig - osSig
 
-    stats[a_i]['flux'] = signal/exptime
-    stats[a_i]['exptime'] = exptime
+    stats['flux'] = signal/exptime
+    stats['exptime'] = exptime
     if hdr is not None:
-        stats[a_i]['preamptemp'] = hdr['temps.PA']
-        stats[a_i]['ccd0temp'] = hdr['temps.CCD0']
+        stats['preamptemp'] = hdr['temps.PA']
+        stats['ccd0temp'] = hdr['temps.CCD0']
 
-    stats[a_i]['sqrtSig'] = np.sqrt(signal)
-    stats[a_i]['bias'] = osSig
+    stats['sqrtSig'] = np.sqrt(signal)
+    stats['bias'] = osSig
 
-    sig1 = 0.741 * np.subtract.reduce(np.percentile(ampIm, [75,25]))
-    sig2 = 0.741 * np.subtract.reduce(np.percentile(osIm, [75,25]))
-    _, trusig1, _ = geom.clippedStats(ampIm)
-    _, trusig2, _ = geom.clippedStats(osIm)
+    sig1 = 0.741 * np.subtract(*np.percentile(ampPix, [75,25], axis=1))
+    sig2 = 0.741 * np.subtract(*np.percentile(osPix, [75,25], axis=1))
+    _, trusig1, _ = geom.clippedStatsBatch(ampPix)
+    _, trusig2, _ = geom.clippedStatsBatch(osPix)
     if asBias:
-        stats[a_i]['readnoise'] = sig1
-        stats[a_i]['readnoiseM'] = trusig1
+        stats['readnoise'] = sig1
+        stats['readnoiseM'] = trusig1
     else:
-        stats[a_i]['readnoise'] = sig2
-        stats[a_i]['readnoiseM'] = trusig2
+        stats['readnoise'] = sig2
+        stats['readnoiseM'] = trusig2
 
-    stats[a_i]['shotnoise'] = sig = np.sqrt(np.abs(sig1**2 - sig2**2))
-    stats[a_i]['shotnoiseM'] = trusig = np.sqrt(np.abs(trusig1**2 - trusig2**2))
+    stats['shotnoise'] = sig = np.sqrt(np.abs(sig1**2 - sig2**2))
+    stats['shotnoiseM'] = trusig = np.sqrt(np.abs(trusig1**2 - trusig2**2))
 
-    stats[a_i]['gain'] = gain = signal/sig**2
-    stats[a_i]['gainM'] = signal/trusig**2
-    stats[a_i]['noise'] = sig2*gain
+    stats['gain'] = gain = signal/sig**2
+    stats['gainM'] = signal/trusig**2
+    stats['noise'] = sig2*gain
 
     return stats
 
@@ -711,35 +751,43 @@ def ampStats(ampIm, osIm, hdr=None, exptime=0.0, asBias=False):
     return stats
 
 def ampDiffStats(ampIm1, ampIm2, osIm1, osIm2, exptime=0.0):
-    stats = np.zeros(shape=(1,),
+    """ Return the statDtype stats and difference images for one pair of amps, or for (namps, rows, cols) stacks. """
+
+    ampIm1 = np.asarray(ampIm1)
+    namps = 1 if ampIm1.ndim == 2 else ampIm1.shape[0]
+    def pix(im):
+        return np.asarray(im).reshape(namps, -1)
+
+    stats = np.zeros(shape=(namps,),
                      dtype=statDtype)
 
-    a_i = 0
-    _s1 = np.median(ampIm1) - np.median(osIm1)
-    _s2 = np.median(ampIm2) - np.median(osIm2)
-    stats[a_i]['signal'] = signal = (_s1 + _s2)/2
-    stats[a_i]['npix'] = ampIm1.size
-    stats[a_i]['sqrtSig'] = np.sqrt(signal)
-    stats[a_i]['bias'] = (np.median(osIm1) + np.median(osIm2))/2
+    osMed1 = np.median(pix(osIm1), axis=1)
+    osMed2 = np.median(pix(osIm2), axis=1)
+    _s1 = np.median(pix(ampIm1), axis=1) - osMed1
+    _s2 = np.median(pix(ampIm2), axis=1) - osMed2
+    stats['signal'] = signal = (_s1 + _s2)/2
+    stats['npix'] = pix(ampIm1).shape[1]
+    stats['sqrtSig'] = np.sqrt(signal)
+    stats['bias'] = (osMed1 + osMed2)/2
 
     ampIm = ampIm2.astype('f4') - ampIm1
     osIm = osIm2.astype('f4') - osIm1
 
-    sig1 = (0.741/np.sqrt(2)) * np.subtract.reduce(np.percentile(ampIm, [75,25]))
-    sig2 = (0.741/np.sqrt(2)) * np.subtract.reduce(np.percentile(osIm, [75,25]))
-    _, trusig1, _ = geom.clippedStats(ampIm) / np.sqrt(2)
-    _, trusig2, _ = geom.clippedStats(osIm) / np.sqrt(2)
+    sig1 = (0.741/np.sqrt(2)) * np.subtract(*np.percentile(pix(ampIm), [75,25], axis=1))
+    sig2 = (0.741/np.sqrt(2)) * np.subtract(*np.percentile(pix(osIm), [75,25], axis=1))
+    trusig1 = geom.clippedStatsBatch(pix(ampIm))[1] / np.sqrt(2)
+    trusig2 = geom.clippedStatsBatch(pix(osIm))[1] / np.sqrt(2)
 
-    stats[a_i]['readnoise'] = sig2
-    stats[a_i]['readnoiseM'] = trusig2
+    stats['readnoise'] = sig2
+    stats['readnoiseM'] = trusig2
 
-    stats[a_i]['shotnoise'] = sig = np.sqrt(np.abs(sig1**2 - sig2**2))
-    stats[a_i]['shotnoiseM'] = trusig = np.sqrt(np.abs(trusig1**2 - trusig2**2))
+    stats['shotnoise'] = sig = np.sqrt(np.abs(sig1**2 - sig2**2))
+    stats['shotnoiseM'] = trusig = np.sqrt(np.abs(trusig1**2 - trusig2**2))
 
-    stats[a_i]['gain'] = gain = signal/sig**2
-    stats[a_i]['gainM'] = signal/trusig**2
-    stats[a_i]['noise'] = sig2*gain
-    stats[a_i]['flux'] = signal/exptime if exptime != 0 else 0.0
+    stats['gain'] = gain = signal/sig**2
+    stats['gainM'] = signal/trusig**2
+    stats['noise'] = sig2*gain
+    stats['flux'] = signal/exptime if exptime != 0 else 0.0
 
     return stats, ampIm, osIm
 
@@ -752,20 +800,19 @@ def imStats(im, asBias=False,
     
     ampIms, osIms, _ = exp.splitImage()
 
-    stats = []
-
     ampRows = slice(rowTrim[0], None if rowTrim[-1] in {0,None} else -rowTrim[1])
     ampCols = slice(colTrim[0], None if colTrim[-1] in {0,None} else -colTrim[1])
 
     osRows = ampRows
     osCols = slice(osColTrim[0], None if osColTrim[-1] in {0,None} else -osColTrim[1])
 
-    for a_i in range(8):
-        stats1 = ampStats(ampIms[a_i][ampRows,ampCols], osIms[a_i][osRows,osCols], exp.header,
-                          exptime=exp.header['EXPTIME'],
-                          asBias=asBias)
-        stats1['amp'] = a_i
-        stats.append(stats1)
+    allStats = ampStats(np.stack([ampIm[ampRows,ampCols] for ampIm in ampIms]),
+                        np.stack([osIm[osRows,osCols] for osIm in osIms]),
+                        exp.header,
+                        exptime=exp.header['EXPTIME'],
+                        asBias=asBias)
+    allStats['amp'] = np.arange(len(ampIms))
+    stats = [allStats[a_i:a_i+1] for a_i in range(len(ampIms))]
 
     return expTime, ampIms, osIms, stats
 
@@ -821,8 +868,8 @@ def flatStats(f1name, f2name):
 
     """
 
-    exp1 = geom.Exposure(f1name)
-    exp2 = geom.Exposure(f2name)
+    exp1 = geom.Exposure(f1name, lazy=True)
+    exp2 = geom.Exposure(f2name, lazy=True)
 
     f1AmpIms, f1OsIms, _ = exp1.splitImage(doTrim=True)
     f2AmpIms, f2OsIms, _ = exp2.splitImage(doTrim=True)
@@ -835,19 +882,13 @@ def flatStats(f1name, f2name):
                            % (exp1.expType, exp1.expTime,
                               exp2.expType, exp2.expTime))
 
-    stats = []
-    diffAmpIms = []
-    diffOsIms = []
-    for a_i in range(8):
-        stats1, ampIm1, osIm1 = ampDiffStats(f1AmpIms[a_i], f2AmpIms[a_i],
-                                             f1OsIms[a_i], f2OsIms[a_i],
-                                             exptime=exp1.expTime)
-        stats1['amp'] = a_i
-        stats.append(stats1)
-        diffAmpIms.append(ampIm1)
-        diffOsIms.append(osIm1)
-        
-    return diffAmpIms, diffOsIms, stats
+    allStats, diffAmpIms, diffOsIms = ampDiffStats(np.stack(f1AmpIms), np.stack(f2AmpIms),
+                                                   np.stack(f1OsIms), np.stack(f2OsIms),
+                                                   exptime=exp1.expTime)
+    allStats['amp'] = np.arange(len(f1AmpIms))
+    stats = [allStats[a_i:a_i+1] for a_i in range(len(f1AmpIms))]
+
+    return list(diffAmpIms), list(diffOsIms), stats
 
 def printStats(stats):
 
@@ -1883,7 +1883,67 @@ def sigplot(waves,
     
     return fig, plist
 
-def clockplot(fig, plot, waves, clocks):
-    pass
+def clockplot(fig, plot, waves, clocks,
+              signals=('S1', 'S2', 'RG', 'SW', 'IR', 'DCR'),
+              alignChannel=None, alignSignal=None, offset=0.0,
+              xscale=1e-6, xoffset=0, level=1.0, spacing=1.5, base=None):
+    """ Overlay the intended clock signals on a sigplot() axis.
+
+    Args
+    ----
+    fig, plot : the figure and axis, from sigplot()
+    waves : the scope waveforms passed to sigplot()
+    clocks : a Clocks instance or a compiled (ticks, opcodes) program
+    signals : the clock names to draw
+    alignChannel : int
+       If set, the 0-indexed scope channel which shows alignSignal. The
+       program is cross-correlated against that trace to find its offset.
+    offset : float
+       Otherwise, the program time at trace time 0, in seconds.
+    xscale, xoffset : as passed to sigplot()
+    level, spacing, base : the height of a high clock, the vertical
+       gap between the clocks, and the level of the lowest clock.
+
+    Returns
+    -------
+    offset : float
+       The program time at trace time 0.
+    delays : dict
+       Keyed by alignSignal: the scope-minus-program delays of its
+       matched rising edges. Empty if not aligning.
+    """
+
+    from clocks import render
+
+    chan = waves['ch%d' % ((alignChannel if alignChannel is not None else 0)+1)]
+    x = chan['x'] - xoffset
+    delays = dict()
+
+    if alignChannel is not None:
+        if alignSignal is None:
+            raise RuntimeError("must specify the alignSignal shown on the alignChannel")
+        offset, score = render.alignToWave(clocks, alignSignal, x, chan['data'])
+        rising, _ = render.programEdges(clocks, alignSignal)
+        waveRising, _ = render.waveEdges(x, chan['data'])
+        _, delays[alignSignal] = render.matchEdges(rising, waveRising, offset)
+        logging.getLogger('testrig').info('%s aligned at %g s (score=%0.3f); median delay=%g s',
+                                          alignSignal, offset, score,
+                                          np.median(delays[alignSignal]) if len(delays[alignSignal]) else np.nan)
+
+    samplePeriod = (x[-1] - x[0])/(len(x) - 1)
+    times, samples = render.renderProgram(clocks, samplePeriod, signals=list(signals),
+                                          t0=x[0] + offset, tmax=x[-1] + offset)
+    if base is None:
+        base = plot.get_ylim()[0] - spacing*len(signals)
+    for i, sig in enumerate(signals):
+        y0 = base + i*spacing
+        plot.step((times - offset)/xscale, y0 + level*samples[i], where='post',
+                  color='r', alpha=0.6, linewidth=0.8)
+        plot.text(x[0]/xscale, y0 + level/2, str(sig), fontsize=8,
+                  verticalalignment='center', horizontalalignment='right')
+
+    fig.canvas.draw_idle()
+
+    return offset, delays
 
 